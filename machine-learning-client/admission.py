@@ -0,0 +1,137 @@
+"""Module for admission control in front of inference"""
+
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Overloaded(Exception):
+    """Raised instead of admitting a recording that would not finish in time."""
+
+    def __init__(self, message, status, retry_after):
+        """
+        Args:
+            message (str): Why the recording was turned away.
+            status (int): 503 when the queue is full, 429 when the wait would
+                run past the request's deadline.
+            retry_after (int): Whole seconds until a retry should succeed.
+        """
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Bounds the recordings admitted for inference and predicts how long a
+    new one would take before admitting it.
+
+    Inference time is proportional to audio length, so the controller keeps
+    the seconds of audio admitted but not yet classified, and a running
+    estimate of the seconds of compute each second of audio costs, learned
+    from the batches as they run. A recording whose predicted finish falls
+    after its deadline is turned away at once, instead of waiting in the
+    queue for work nobody will collect.
+    """
+
+    def __init__(self, max_pending=32, max_wait=30.0, cost=0.25, smoothing=0.2):
+        """
+        Args:
+            max_pending (int): Most recordings admitted at once.
+            max_wait (float): Deadline in seconds for requests without one.
+            cost (float): Initial estimate of compute seconds per second of
+                audio, until batches have been observed.
+            smoothing (float): Weight of each new observation in the estimate.
+        """
+        self.max_pending = max(1, max_pending)
+        self.max_wait = max_wait
+        self.cost = cost
+        self.smoothing = smoothing
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._pending_audio = 0.0
+
+    def deadline(self, timeout=None):
+        """
+        Turn a client's timeout into a deadline on the monotonic clock.
+        Args:
+            timeout (float): Seconds the client will wait, or None for
+                max_wait.
+        Returns:
+            float: The deadline.
+        """
+        # A client's own timeout is honoured in full: capping it would turn
+        # away long recordings that it is prepared to wait for
+        return time.monotonic() + (self.max_wait if timeout is None else timeout)
+
+    def estimate(self, audio_seconds):
+        """Predicted seconds until a new recording of that length is classified."""
+        with self._lock:
+            return (self._pending_audio + audio_seconds) * self.cost
+
+    @contextmanager
+    def admit(self, audio_seconds, deadline=None):
+        """
+        Hold a place for a recording while it is classified.
+        Usage:
+            with admission.admit(len(speech) / SAMPLE_RATE, deadline):
+                emotion = scheduler.classify(speech, deadline=deadline)
+        Args:
+            audio_seconds (float): Length of the audio to classify.
+            deadline (float): time.monotonic() by which the result is
+                needed, or None to only apply max_pending.
+        Raises:
+            Overloaded: If max_pending recordings are already admitted, or
+                the predicted finish is after the deadline.
+        """
+        with self._lock:
+            if self._pending >= self.max_pending:
+                # About one recording's worth of work has to finish first
+                raise Overloaded(
+                    "Too many recordings waiting",
+                    503,
+                    _seconds(self._pending_audio * self.cost / self._pending),
+                )
+            finish = (self._pending_audio + audio_seconds) * self.cost
+            remaining = math.inf if deadline is None else deadline - time.monotonic()
+            if finish > remaining:
+                raise Overloaded(
+                    "The recording could not be classified before its deadline",
+                    429,
+                    _seconds(finish - max(remaining, 0.0)),
+                )
+            self._pending += 1
+            self._pending_audio += audio_seconds
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._pending -= 1
+                self._pending_audio = max(0.0, self._pending_audio - audio_seconds)
+
+    def observe(self, audio_seconds, seconds):
+        """
+        Update the cost estimate from a finished forward pass.
+        Args:
+            audio_seconds (float): Total audio classified in the pass.
+            seconds (float): How long the pass took.
+        """
+        if audio_seconds <= 0:
+            return
+        with self._lock:
+            self.cost += self.smoothing * (seconds / audio_seconds - self.cost)
+
+    def stats(self):
+        """Recordings and seconds of audio admitted, and the cost estimate."""
+        with self._lock:
+            return {
+                "pending": self._pending,
+                "pendingAudioSeconds": round(self._pending_audio, 3),
+                "secondsPerAudioSecond": round(self.cost, 4),
+            }
+
+
+def _seconds(value):
+    # Retry-After takes whole seconds
+    return max(1, math.ceil(value))
@@ -0,0 +1,242 @@
+"""Module for decoding and encoding audio in memory"""
+
+import io
+import os
+import tempfile
+
+import av
+import librosa
+import numpy as np
+import soundfile
+
+from metrics import stage
+
+# Leading bytes of each container, checked in order. Browsers send WebM or
+# Ogg with Opus from MediaRecorder whatever the upload is labelled as.
+SIGNATURES = (
+    ("wav", 0, b"RIFF"),
+    ("flac", 0, b"fLaC"),
+    ("ogg", 0, b"OggS"),
+    ("webm", 0, b"\x1a\x45\xdf\xa3"),
+    ("mp4", 4, b"ftyp"),
+)
+# Containers libsndfile reads, straight from memory
+SOUNDFILE_FORMATS = ("wav", "flac", "ogg")
+# Containers libav demuxes and decodes in-process
+AV_FORMATS = ("webm", "ogg", "mp4")
+# Containers MediaRecorder streams, which StreamDecoder decodes packet by packet
+STREAM_FORMATS = ("webm", "ogg")
+
+
+def sniff_format(stream):
+    """
+    Identify an upload's container from its first bytes, ignoring its name
+    or label, and rewind the stream.
+    Args:
+        stream: A seekable binary stream.
+    Returns:
+        str: One of the names in SIGNATURES, or None if none match.
+    """
+    header = stream.read(12)
+    stream.seek(0)
+    for name, offset, magic in SIGNATURES:
+        if header[offset : offset + len(magic)] == magic:
+            return name
+    return None
+
+
+def decode_audio(source, sample_rate):
+    """
+    Decode audio bytes or a readable stream into a mono float32 waveform.
+
+    The container is sniffed from the data. WAV, FLAC and Ogg are read by
+    libsndfile and WebM/Opus by libav, both straight from memory; audio
+    already at sample_rate is not resampled. Anything else, or a file those
+    libraries reject, falls back to librosa, which needs a real path,
+    through a temporary file that is always removed afterwards.
+    Args:
+        source: bytes, bytearray, memoryview or a seekable binary stream such
+            as a GridFS GridOut.
+        sample_rate (int): The sample rate the waveform is resampled to.
+    Returns:
+        np.ndarray: A contiguous 1-D float32 waveform.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+    container = sniff_format(source)
+    if container in SOUNDFILE_FORMATS:
+        try:
+            return _decode_with_soundfile(source, sample_rate)
+        except soundfile.LibsndfileError:
+            source.seek(0)
+    if container in AV_FORMATS:
+        try:
+            return _decode_with_av(source, sample_rate)
+        except av.FFmpegError:  # pylint: disable=no-member
+            source.seek(0)
+    return _decode_with_librosa(source, sample_rate)
+
+
+def _decode_with_soundfile(stream, sample_rate):
+    samples, native_rate = soundfile.read(stream, dtype="float32", always_2d=True)
+    # Down-mix to mono the same way librosa does
+    speech = samples.mean(axis=1) if samples.shape[1] > 1 else samples[:, 0]
+    if native_rate != sample_rate:
+        speech = librosa.resample(speech, orig_sr=native_rate, target_sr=sample_rate)
+    return np.ascontiguousarray(speech, dtype=np.float32)
+
+
+def _decode_with_av(stream, sample_rate):
+    # libswresample converts to planar float at sample_rate as it decodes;
+    # the channels are then averaged, as librosa would
+    resampler = av.AudioResampler(format="fltp", rate=sample_rate)
+    pieces = []
+    with av.open(stream, mode="r") as container:
+        for frame in container.decode(audio=0):
+            pieces.extend(part.to_ndarray() for part in resampler.resample(frame))
+        pieces.extend(part.to_ndarray() for part in resampler.resample(None))
+    if not pieces:
+        return np.zeros(0, dtype=np.float32)
+    samples = np.concatenate(pieces, axis=1)
+    return np.ascontiguousarray(samples.mean(axis=0), dtype=np.float32)
+
+
+def _decode_with_librosa(stream, sample_rate):
+    with stage("temp_file"), tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file.write(stream.read())
+        temp_file_path = temp_file.name
+    try:
+        speech, _ = librosa.load(temp_file_path, sr=sample_rate)
+    finally:
+        os.remove(temp_file_path)
+    return speech
+
+
+class StreamDecoder:  # pylint: disable=too-few-public-methods
+    """
+    Decodes a recording that arrives a slice at a time, as MediaRecorder
+    uploads it, so each part of it is decoded only once.
+
+    Only the first slice carries the container header, so every call
+    demuxes the bytes received so far from the start. That only parses the
+    container. The packets are decoded by one codec context kept between
+    calls, starting from the first one not decoded yet, so the output is
+    the same as decoding the whole recording at once. The last packet is
+    held back until more data arrives, as it may have been cut short.
+    Other containers are decoded whole on every call, and only the samples
+    not returned before are given back.
+    """
+
+    def __init__(self, sample_rate):
+        """
+        Args:
+            sample_rate (int): The sample rate the waveform is resampled to.
+        """
+        self.sample_rate = sample_rate
+        self._state = {"codec": None, "resampler": None, "packets": 0, "samples": 0}
+
+    def decode(self, data, final=False):
+        """
+        Args:
+            data (bytes): The whole recording received so far.
+            final (bool): Whether the recording is complete, so the packet
+                held back and the samples the decoder buffers are flushed.
+        Returns:
+            np.ndarray: The mono float32 samples decoded since the last call.
+        """
+        if sniff_format(io.BytesIO(data)) not in STREAM_FORMATS:
+            speech = decode_audio(data, self.sample_rate)
+            new = speech[self._state["samples"] :]
+            self._state["samples"] = len(speech)
+            return np.ascontiguousarray(new)
+        packets = self._new_packets(data)
+        if not final:
+            packets = packets[:-1]
+        pieces = []
+        for number, packet in packets:
+            pieces.extend(self._resample(self._state["codec"].decode(packet)))
+            self._state["packets"] = number + 1
+        if final and self._state["codec"] is not None:
+            pieces.extend(self._resample(self._state["codec"].decode(None)))
+            pieces.extend(
+                part.to_ndarray() for part in self._resampler().resample(None)
+            )
+            self._state["codec"] = None
+        if not pieces:
+            return np.zeros(0, dtype=np.float32)
+        samples = np.concatenate(pieces, axis=1)
+        return np.ascontiguousarray(samples.mean(axis=0), dtype=np.float32)
+
+    def _new_packets(self, data):
+        # The packets not decoded yet, numbered from the start of the stream.
+        # A container cut short ends the list early instead of failing.
+        packets = []
+        try:
+            with av.open(io.BytesIO(data), mode="r") as container:
+                if not container.streams.audio:
+                    return []
+                stream = container.streams.audio[0]
+                if self._state["codec"] is None and not self._state["packets"]:
+                    codec = av.CodecContext.create(stream.codec_context.name, "r")
+                    codec.extradata = stream.codec_context.extradata
+                    codec.sample_rate = stream.codec_context.sample_rate
+                    codec.layout = stream.codec_context.layout
+                    self._state["codec"] = codec
+                for number, packet in enumerate(container.demux(stream)):
+                    if packet.size and number >= self._state["packets"]:
+                        packets.append((number, packet))
+        except av.FFmpegError:  # pylint: disable=no-member
+            pass
+        return packets if self._state["codec"] is not None else []
+
+    def _resampler(self):
+        if self._state["resampler"] is None:
+            self._state["resampler"] = av.AudioResampler(
+                format="fltp", rate=self.sample_rate
+            )
+        return self._state["resampler"]
+
+    def _resample(self, frames):
+        return [
+            part.to_ndarray()
+            for frame in frames
+            for part in self._resampler().resample(frame)
+        ]
+
+
+def encode_audio(speech, audio_format, sample_rate, bit_rate=None):
+    """
+    Encode a mono waveform.
+    Args:
+        speech (np.ndarray): 1-D float32 waveform.
+        audio_format (str): "wav" or "flac" for 16-bit PCM, or "webm" for
+            Opus in WebM, as MediaRecorder records it.
+        sample_rate (int): The waveform's sample rate. Opus takes 8, 12, 16,
+            24 or 48 kHz.
+        bit_rate (int): Opus bits per second, or None for libopus's default.
+    Returns:
+        bytes: The encoded file.
+    """
+    buffer = io.BytesIO()
+    if audio_format in ("wav", "flac"):
+        soundfile.write(
+            buffer, speech, sample_rate, format=audio_format.upper(), subtype="PCM_16"
+        )
+        return buffer.getvalue()
+    with av.open(buffer, mode="w", format="webm") as container:
+        stream = container.add_stream("libopus", rate=sample_rate, layout="mono")
+        if bit_rate:
+            stream.bit_rate = bit_rate
+        # Opus works in 20 ms frames
+        step = sample_rate // 50
+        for start in range(0, len(speech), step):
+            frame = av.AudioFrame.from_ndarray(
+                np.ascontiguousarray(speech[None, start : start + step]),
+                format="flt",
+                layout="mono",
+            )
+            frame.sample_rate = sample_rate
+            frame.pts = start
+            container.mux(stream.encode(frame))
+        container.mux(stream.encode(None))
+    return buffer.getvalue()
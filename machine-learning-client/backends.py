@@ -0,0 +1,267 @@
+"""Module for the inference backends the emotion model can run on"""
+
+# pylint: disable=too-few-public-methods
+
+import os
+
+import torch
+
+BACKENDS = ("eager", "int8", "compile", "onnx")
+
+
+class EagerBackend:
+    """The fp32 PyTorch model run eagerly, as loaded by from_pretrained."""
+
+    name = "eager"
+
+    def __init__(self, model):
+        """
+        Args:
+            model: A Wav2Vec2ForSequenceClassification instance.
+        """
+        self.model = model
+        self.pooled = _PooledOutputs(model)
+
+    def __call__(self, input_values, attention_mask=None):
+        """
+        Args:
+            input_values (torch.Tensor): Waveforms of shape (batch, samples).
+            attention_mask (torch.Tensor): Marks real samples when padded.
+        Returns:
+            torch.Tensor: Logits of shape (batch, labels).
+        """
+        with torch.no_grad():
+            return self.model(input_values, attention_mask=attention_mask).logits
+
+    def embed(self, input_values, attention_mask=None):
+        """
+        Args:
+            input_values (torch.Tensor): Waveforms of shape (batch, samples).
+            attention_mask (torch.Tensor): Marks real samples when padded.
+        Returns:
+            tuple: Logits of shape (batch, labels) and the pooled encoder
+                embeddings of shape (batch, hidden_size).
+        """
+        if attention_mask is None:
+            attention_mask = torch.ones(input_values.shape, dtype=torch.long)
+        with torch.no_grad():
+            return self.pooled(input_values, attention_mask)
+
+    def head(self, embeddings):
+        """
+        Args:
+            embeddings (torch.Tensor): Pooled encoder embeddings from embed().
+        Returns:
+            torch.Tensor: Logits of shape (batch, labels).
+        """
+        with torch.no_grad():
+            return self.pooled.head(embeddings)
+
+
+class QuantizedBackend(EagerBackend):
+    """Linear layers dynamically quantized to int8; activations stay fp32."""
+
+    name = "int8"
+
+    def __init__(self, model):
+        super().__init__(
+            torch.ao.quantization.quantize_dynamic(
+                model, {torch.nn.Linear}, dtype=torch.qint8
+            )
+        )
+
+
+class CompiledBackend(EagerBackend):
+    """The model traced and optimized by torch.compile on first use."""
+
+    name = "compile"
+
+    def __init__(self, model):
+        # Clip lengths vary on every request, so avoid one graph per length
+        super().__init__(torch.compile(model, dynamic=True))
+        self.pooled = torch.compile(_PooledOutputs(model), dynamic=True)
+
+
+class _Head(torch.nn.Module):
+    """The layers after pooling: the projector, then the classifier."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.projector = model.projector
+        self.classifier = model.classifier
+
+    def forward(self, embeddings):
+        """Map pooled encoder embeddings to logits."""
+        return self.classifier(self.projector(embeddings))
+
+
+class _PooledOutputs(torch.nn.Module):
+    """
+    The sequence classification forward pass, also returning the pooled
+    encoder embedding the logits were computed from.
+
+    Hugging Face projects every frame and then mean-pools. The projector is
+    linear, so pooling the encoder output first gives the same logits and
+    an embedding that only needs _Head to be classified again.
+
+    Hugging Face also zeroes padded frames with an in-place boolean index,
+    which the ONNX exporter traces with fixed shapes. Pooling with a
+    multiply and sum gives the same result and stays dynamic.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+        self.head = _Head(model)
+
+    def forward(self, input_values, attention_mask):
+        """Return the logits and the pooled embeddings."""
+        hidden_states = self.model.wav2vec2(
+            input_values, attention_mask=attention_mask
+        )[0]
+        # pylint: disable-next=protected-access
+        padding_mask = self.model._get_feature_vector_attention_mask(
+            hidden_states.shape[1], attention_mask
+        ).to(hidden_states.dtype)
+        pooled = (hidden_states * padding_mask.unsqueeze(-1)).sum(dim=1)
+        pooled = pooled / padding_mask.sum(dim=1, keepdim=True)
+        return self.head(pooled), pooled
+
+
+class OnnxBackend:
+    """The model exported to ONNX and run on onnxruntime's CPU provider."""
+
+    name = "onnx"
+
+    def __init__(self, model, onnx_path):
+        """
+        Args:
+            model: A Wav2Vec2ForSequenceClassification instance, exported to
+                onnx_path unless that file already exists.
+            onnx_path (str): Where the exported graph is cached.
+        """
+        # Optional dependency, only needed for this backend
+        import onnxruntime  # pylint: disable=import-outside-toplevel
+
+        if not os.path.exists(onnx_path):
+            export_onnx(model, onnx_path)
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = torch.get_num_threads()
+        self.session = onnxruntime.InferenceSession(
+            onnx_path, options, providers=["CPUExecutionProvider"]
+        )
+        if "embedding" not in [output.name for output in self.session.get_outputs()]:
+            # Cached before embeddings were exported
+            export_onnx(model, onnx_path)
+            self.session = onnxruntime.InferenceSession(
+                onnx_path, options, providers=["CPUExecutionProvider"]
+            )
+        # Only the small head is kept in PyTorch, for head()
+        self.head_module = _Head(model).eval()
+        # onnxruntime holds about as much as the graph file it loaded
+        self.graph_bytes = os.path.getsize(onnx_path)
+
+    def __call__(self, input_values, attention_mask=None):
+        """
+        Args:
+            input_values (torch.Tensor): Waveforms of shape (batch, samples).
+            attention_mask (torch.Tensor): Marks real samples when padded.
+        Returns:
+            torch.Tensor: Logits of shape (batch, labels).
+        """
+        return self._run(["logits"], input_values, attention_mask)[0]
+
+    def embed(self, input_values, attention_mask=None):
+        """See EagerBackend.embed."""
+        return tuple(self._run(["logits", "embedding"], input_values, attention_mask))
+
+    def head(self, embeddings):
+        """See EagerBackend.head."""
+        with torch.no_grad():
+            return self.head_module(embeddings)
+
+    def _run(self, outputs, input_values, attention_mask):
+        if attention_mask is None:
+            attention_mask = torch.ones(input_values.shape, dtype=torch.long)
+        results = self.session.run(
+            outputs,
+            {
+                "input_values": input_values.numpy(),
+                "attention_mask": attention_mask.numpy(),
+            },
+        )
+        return [torch.from_numpy(result) for result in results]
+
+
+def export_onnx(model, onnx_path):
+    """
+    Export the model to ONNX with dynamic batch and sample axes. The graph
+    outputs both the logits and the pooled embeddings.
+    Args:
+        model: A Wav2Vec2ForSequenceClassification instance.
+        onnx_path (str): Where to write the graph.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(onnx_path)), exist_ok=True)
+    sample = torch.zeros((1, 16000), dtype=torch.float32)
+    axes = {0: "batch", 1: "samples"}
+    torch.onnx.export(
+        _PooledOutputs(model).eval(),
+        (sample, torch.ones(sample.shape, dtype=torch.long)),
+        onnx_path,
+        input_names=["input_values", "attention_mask"],
+        output_names=["logits", "embedding"],
+        dynamic_axes={
+            "input_values": axes,
+            "attention_mask": axes,
+            "logits": {0: "batch"},
+            "embedding": {0: "batch"},
+        },
+        opset_version=17,
+        dynamo=False,
+    )
+
+
+def model_bytes(model):
+    """
+    Bytes held by a PyTorch model's weights and buffers. Dynamically
+    quantized layers keep their int8 weights in packed (weight, bias)
+    tuples, which are counted as well.
+    """
+    total = 0
+    for value in model.state_dict().values():
+        for tensor in value if isinstance(value, tuple) else (value,):
+            if isinstance(tensor, torch.Tensor):
+                total += tensor.numel() * tensor.element_size()
+    return total
+
+
+def backend_bytes(backend):
+    """
+    Bytes a loaded backend keeps resident: its model's weights, or for onnx
+    the graph onnxruntime loaded and the head kept in PyTorch.
+    """
+    if isinstance(backend, OnnxBackend):
+        return backend.graph_bytes + model_bytes(backend.head_module)
+    return model_bytes(backend.model)
+
+
+def load_backend(name, model, onnx_path="models/emotion.onnx"):
+    """
+    Wrap the model in the configured inference backend.
+    Args:
+        name (str): One of BACKENDS.
+        model: A Wav2Vec2ForSequenceClassification instance in eval mode.
+        onnx_path (str): Where the onnx backend caches its exported graph.
+    Returns:
+        callable: Maps (input_values, attention_mask=None) to logits, with
+            embed() and head() methods as on EagerBackend.
+    """
+    if name == "eager":
+        return EagerBackend(model)
+    if name == "int8":
+        return QuantizedBackend(model)
+    if name == "compile":
+        return CompiledBackend(model)
+    if name == "onnx":
+        return OnnxBackend(model, onnx_path)
+    raise ValueError(f"Unknown inference backend {name!r}, expected one of {BACKENDS}")
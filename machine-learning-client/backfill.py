@@ -0,0 +1,397 @@
+"""
+Batch reclassification of recordings already stored in GridFS.
+
+Finds fs.files documents whose emotion is missing or was stamped by a
+different MODEL_VERSION, for example after MODEL_NAME or EMOTION_LABELS
+changed. Recordings classified by one of EXTRA_MODELS are left alone.
+Recordings whose pooled encoder embedding is already stored are classified
+first, by running only the classifier head on the embeddings.
+The rest are read a page at a time in _id order. Each page is
+decoded in a process pool while the previous one runs through the model.
+Silence is trimmed as /detect-emotion trims it, so the emotions and
+embeddings match what the live service would store, and recordings with
+no speech are left unclassified. Clips are sorted by length and batched,
+so a batch pads as little as possible. Results are written back with one
+bulk_write per page. The last _id of every finished page is saved in the
+backfill_checkpoints collection, so an interrupted run picks up where it
+stopped.
+Finally, every recording classified by MODEL_VERSION with a stored
+embedding is added to the similarity index, or has its emotion there
+brought up to date, so the index covers recordings it missed.
+
+Usage:
+    python backfill.py --page-size 256 --batch-size 8 --decoders 4
+"""
+
+import argparse
+import datetime
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from audio_decode import decode_audio
+from emotion_detector import (
+    EXTRA_MODELS,
+    MODEL_ID,
+    MODEL_VERSION,
+    SAMPLE_RATE,
+    WINDOWED_MIN_SECONDS,
+    classify_embeddings,
+    classify_speech_windowed,
+    db,
+    embed_emotions_batch,
+    embedding_store,
+    fs,
+    model_loader,
+    similarity_index,
+    trim_speech,
+    write_results,
+)
+from vad import NoSpeechError
+
+checkpoints = db["backfill_checkpoints"]
+
+
+def stale_query(model_version, after=None, other_models=(), need_audio=True):
+    """
+    Build the fs.files filter for recordings that need classifying.
+    Copies left behind by an interrupted compaction are never matched: they
+    are not recordings of their own, and storage.py finishes or removes them.
+    Args:
+        model_version (str): The version results should be stamped with.
+        after (ObjectId): Only match documents after this _id, if given.
+        other_models (list): Ids of other served models, whose results
+            are not stale.
+        need_audio (bool): Whether to leave out recordings whose audio was
+            pruned, which cannot be decoded.
+    Returns:
+        dict: A filter matching documents stamped with any other version,
+            or with none at all.
+    """
+    query = {
+        "modelVersion": {"$ne": model_version},
+        "compactedFrom": {"$exists": False},
+    }
+    if need_audio:
+        query["audioDeletedAt"] = {"$exists": False}
+    if other_models:
+        query["modelId"] = {"$nin": list(other_models)}
+    if after is not None:
+        query["_id"] = {"$gt": after}
+    return query
+
+
+def decode_file(data):
+    """
+    Decode one recording in a pool process.
+    Returns:
+        np.ndarray: The waveform, or None if the audio cannot be decoded.
+    """
+    try:
+        return decode_audio(data, SAMPLE_RATE)
+    except Exception:  # pylint: disable=broad-exception-caught
+        return None
+
+
+def length_buckets(speeches, batch_size):
+    """
+    Group clip indices into batches of similar length.
+    Args:
+        speeches (list): Decoded waveforms.
+        batch_size (int): The most clips per batch.
+    Returns:
+        list: Lists of indices into speeches, shortest clips first.
+    """
+    order = sorted(range(len(speeches)), key=lambda index: len(speeches[index]))
+    return [order[i : i + batch_size] for i in range(0, len(order), batch_size)]
+
+
+def classify_page(speeches, batch_size):
+    """
+    Classify one page of decoded recordings as /detect-emotion would.
+    Silence is trimmed first, and recordings with no speech are left
+    unclassified. Those whose speech is longer than WINDOWED_MIN_SECONDS
+    are classified window by window; the rest go through length buckets.
+    Args:
+        speeches (list): Waveforms, with None for recordings that failed
+            to decode.
+        batch_size (int): The most clips per forward pass.
+    Returns:
+        tuple: The emotion for each recording, or None where decoding
+            failed or there was no speech, the embedding for each recording
+            classified in a single pass, or None, and how many recordings
+            had no speech.
+    """
+    emotions = [None] * len(speeches)
+    embeddings = [None] * len(speeches)
+    trimmed = {}
+    no_speech = 0
+    for index, speech in enumerate(speeches):
+        if speech is None:
+            continue
+        try:
+            speech_only = trim_speech(speech)
+        except NoSpeechError:
+            no_speech += 1
+            continue
+        if len(speech_only) > WINDOWED_MIN_SECONDS * SAMPLE_RATE:
+            # Window times are given in the recording as it was made
+            emotions[index], _ = classify_speech_windowed(speech)
+        else:
+            trimmed[index] = speech_only
+    short = list(trimmed)
+    for bucket in length_buckets(list(trimmed.values()), batch_size):
+        batch = [short[position] for position in bucket]
+        results = embed_emotions_batch([trimmed[index] for index in batch])
+        for index, (label, embedding) in zip(batch, results):
+            emotions[index] = label
+            embeddings[index] = embedding
+    return emotions, embeddings, no_speech
+
+
+def paged(cursor, page_size):
+    """Yield the documents of a cursor in lists of page_size."""
+    page = []
+    for document in cursor:
+        page.append(document)
+        if len(page) == page_size:
+            yield page
+            page = []
+    if page:
+        yield page
+
+
+def stale_pages(after, page_size, limit=0, need_audio=True):
+    """
+    Yield pages of stale fs.files documents, with only the fields the
+    backfill needs.
+    Args:
+        after (ObjectId): Resume after this _id, or None to start over.
+        page_size (int): Documents per page.
+        limit (int): Stop after this many documents, or 0 for no limit.
+        need_audio (bool): See stale_query.
+    """
+    cursor = db.fs.files.find(
+        stale_query(MODEL_VERSION, after, EXTRA_MODELS, need_audio),
+        {"_id": 1, "sha256": 1, "emotion": 1, "uploadDate": 1},
+    )
+    cursor = cursor.sort("_id", 1).batch_size(page_size)
+    if limit:
+        cursor = cursor.limit(limit)
+    yield from paged(cursor, page_size)
+
+
+def read_pages(after, page_size, limit):
+    """
+    Yield (documents, raw audio) for each page of stale recordings.
+    Args:
+        after (ObjectId): Resume after this _id, or None to start over.
+        page_size (int): Recordings per page.
+        limit (int): Stop after this many recordings, or 0 for no limit.
+    """
+    for page in stale_pages(after, page_size, limit):
+        yield page, [fs.get(document["_id"]).read() for document in page]
+
+
+def reclassify_from_embeddings(page_size):
+    """
+    Classify stale recordings that have a stored embedding by running only
+    the classifier head, skipping the audio and the encoder entirely.
+    Args:
+        page_size (int): Documents looked up per query.
+    Returns:
+        int: How many recordings were classified.
+    """
+    classified = 0
+    # Pruned recordings keep their embeddings, so they can still be classified
+    for page in stale_pages(None, page_size, need_audio=False):
+        found = embedding_store.get_many(
+            [document["sha256"] for document in page if document.get("sha256")]
+        )
+        documents = [document for document in page if document.get("sha256") in found]
+        if not documents:
+            continue
+        emotions = classify_embeddings(
+            np.stack([found[document["sha256"]] for document in documents])
+        )
+        write_results(page_results(documents, emotions))
+        classified += len(documents)
+    return classified
+
+
+def index_stored(page_size):
+    """
+    Add the recordings classified by MODEL_VERSION to similarity_index
+    from their stored embeddings, and update the emotions of those it has.
+    Args:
+        page_size (int): Documents looked up per query.
+    Returns:
+        int: How many recordings were added.
+    """
+    added = 0
+    cursor = db.fs.files.find(
+        {"modelVersion": MODEL_VERSION, "sha256": {"$exists": True}},
+        {"_id": 1, "sha256": 1, "emotion": 1},
+    )
+    for page in paged(cursor.batch_size(page_size), page_size):
+        missing = set(
+            similarity_index.relabel_many(
+                (document["_id"], document["emotion"]) for document in page
+            )
+        )
+        documents = [document for document in page if document["_id"] in missing]
+        found = embedding_store.get_many([document["sha256"] for document in documents])
+        items = [
+            (document["_id"], found[document["sha256"]], document["emotion"])
+            for document in documents
+            if document["sha256"] in found
+        ]
+        similarity_index.add_many(items)
+        added += len(items)
+    return added
+
+
+def decode_ahead(pool, pages):
+    """
+    Yield (documents, waveforms) for each page, decoding the next page in
+    the pool while the caller classifies the current one.
+    Args:
+        pool (ProcessPoolExecutor): The decoder processes.
+        pages: The (documents, raw audio) pairs from read_pages.
+    """
+    page = next(pages, None)
+    if page is None:
+        return
+    decoded = pool.map(decode_file, page[1])
+    model_loader.get()
+    while page is not None:
+        documents, speeches = page[0], list(decoded)
+        page = next(pages, None)
+        decoded = pool.map(decode_file, page[1]) if page else None
+        yield documents, speeches
+
+
+def page_results(documents, emotions):
+    """
+    Pair a page of recordings with their new emotions for write_results.
+    Args:
+        documents (list): The fs.files documents from stale_pages.
+        emotions (list): The new emotion for each, or None to skip it.
+    Returns:
+        list: The results to stamp, stamped with the served model.
+    """
+    return [
+        {
+            "_id": document["_id"],
+            "emotion": emotion,
+            "modelId": MODEL_ID,
+            "modelVersion": MODEL_VERSION,
+        }
+        for document, emotion in zip(documents, emotions)
+        if emotion is not None
+    ]
+
+
+def save_checkpoint(last_id, counts):
+    """Record how far this model version's backfill has got."""
+    checkpoints.update_one(
+        {"_id": MODEL_VERSION},
+        {
+            "$set": {
+                "lastId": last_id,
+                "updatedAt": datetime.datetime.now(datetime.timezone.utc),
+            },
+            "$inc": counts,
+        },
+        upsert=True,
+    )
+
+
+def run(options):
+    """
+    Reclassify every stale recording, resuming from the last checkpoint.
+    Args:
+        options (dict): page_size, batch_size, decoders, limit (0 for all)
+            and restart (ignore the checkpoint).
+    Returns:
+        dict: How many recordings were classified from stored embeddings,
+            how many from their audio, how many had no speech, how many
+            failed to decode, and how many were added to the similarity
+            index.
+    """
+    checkpoint = (
+        None if options["restart"] else checkpoints.find_one({"_id": MODEL_VERSION})
+    )
+    after = checkpoint["lastId"] if checkpoint else None
+    if after is not None:
+        print(f"Resuming {MODEL_VERSION} backfill after {after}")
+
+    with ProcessPoolExecutor(max_workers=options["decoders"]) as pool:
+        # Fork the decoders before anything loads the model, so they do not
+        # inherit PyTorch's thread pool
+        list(pool.map(abs, range(options["decoders"])))
+
+        started = time.perf_counter()
+        totals = {
+            "from_embeddings": reclassify_from_embeddings(options["page_size"]),
+            "classified": 0,
+            "no_speech": 0,
+            "failed": 0,
+        }
+        print(
+            f"{totals['from_embeddings']} files classified from stored embeddings "
+            f"in {time.perf_counter() - started:.1f}s"
+        )
+
+        started = time.perf_counter()
+        pages = read_pages(after, options["page_size"], options["limit"])
+        for documents, speeches in decode_ahead(pool, pages):
+            emotions, embeddings, no_speech = classify_page(
+                speeches, options["batch_size"]
+            )
+            write_results(page_results(documents, emotions))
+            embedding_store.put_many(
+                (document["sha256"], embedding)
+                for document, embedding in zip(documents, embeddings)
+                if embedding is not None and document.get("sha256")
+            )
+            counts = {
+                "classified": len(emotions) - emotions.count(None),
+                "no_speech": no_speech,
+                "failed": emotions.count(None) - no_speech,
+            }
+            save_checkpoint(documents[-1]["_id"], counts)
+            for key, value in counts.items():
+                totals[key] += value
+            report_progress(totals, time.perf_counter() - started)
+    totals["indexed"] = index_stored(options["page_size"])
+    return totals
+
+
+def report_progress(totals, elapsed):
+    """Print how many files are done and the throughput so far."""
+    done = totals["classified"] + totals["no_speech"] + totals["failed"]
+    print(
+        f"{done} files ({totals['no_speech']} without speech, "
+        f"{totals['failed']} undecodable) in {elapsed:.1f}s, "
+        f"{done / elapsed:.1f} files/sec"
+    )
+
+
+def main():
+    """Parse arguments and run the backfill."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", maxsplit=1)[0])
+    parser.add_argument("--page-size", type=int, default=256)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--decoders", type=int, default=4)
+    parser.add_argument("--limit", type=int, default=0)
+    parser.add_argument(
+        "--restart", action="store_true", help="ignore the saved checkpoint"
+    )
+    totals = run(vars(parser.parse_args()))
+    print(f"Backfill of {MODEL_VERSION} finished: {totals}")
+
+
+if __name__ == "__main__":
+    main()
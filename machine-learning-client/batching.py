@@ -0,0 +1,149 @@
+"""Module for batching concurrent inference requests"""
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import torch
+
+
+class DeadlineExceeded(Exception):
+    """Raised for a request whose deadline passed before its batch ran."""
+
+
+def pad_batch(speeches):
+    """
+    Zero-pad a list of waveforms into one batch with an attention mask.
+    Args:
+        speeches (list): 1-D float32 waveforms of any length.
+    Returns:
+        tuple: (input_values, attention_mask), both of shape (batch, longest).
+    """
+    longest = max(len(speech) for speech in speeches)
+    input_values = torch.zeros((len(speeches), longest), dtype=torch.float32)
+    attention_mask = torch.zeros((len(speeches), longest), dtype=torch.long)
+    for row, speech in enumerate(speeches):
+        input_values[row, : len(speech)] = torch.as_tensor(speech)
+        attention_mask[row, : len(speech)] = 1
+    return input_values, attention_mask
+
+
+class MicroBatchScheduler:
+    """
+    Collects requests that arrive close together and classifies them in one
+    forward pass.
+
+    A single worker thread waits for the first request, then keeps taking
+    requests until either max_batch_size is reached or max_wait_ms has passed
+    since the first one arrived. Each caller gets a Future for its own result.
+    Requests whose deadline has passed by then are dropped from the batch.
+    """
+
+    def __init__(
+        self, classify_batch, max_batch_size=8, max_wait_ms=10.0, observe_wait=None
+    ):
+        """
+        Args:
+            classify_batch (callable): Takes a list of waveforms and returns a
+                list of labels in the same order.
+            max_batch_size (int): Largest number of requests per forward pass.
+            max_wait_ms (float): Longest time to hold a request while waiting
+                for others to join its batch.
+            observe_wait (callable): Called with the seconds each request
+                spent queued before its batch started, if given.
+        """
+        self.classify_batch = classify_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self.observe_wait = observe_wait
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker = None
+
+    def submit(self, speech, deadline=None):
+        """
+        Queue a waveform for classification.
+        Args:
+            speech (np.ndarray): 1-D float32 waveform at the model sample rate.
+            deadline (float): time.monotonic() after which the result is no
+                longer wanted, or None.
+        Returns:
+            Future: Resolves to the predicted emotion label, or raises
+                DeadlineExceeded if the deadline passed before its batch.
+        """
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((speech, future, time.perf_counter(), deadline))
+        return future
+
+    def classify(self, speech, timeout=None, deadline=None):
+        """
+        Classify a waveform and block until its batch has run.
+        Args:
+            speech (np.ndarray): 1-D float32 waveform at the model sample rate.
+            timeout (float): Seconds to wait for the result, None for no limit.
+            deadline (float): See submit().
+        Returns:
+            str: The predicted emotion label.
+        Raises:
+            DeadlineExceeded: If the deadline passed before its batch ran.
+        """
+        return self.submit(speech, deadline).result(timeout=timeout)
+
+    def qsize(self):
+        """Number of requests waiting for a batch slot."""
+        return self._queue.qsize()
+
+    def _ensure_worker(self):
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(
+                    target=self._run, name="micro-batcher", daemon=True
+                )
+                self._worker.start()
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._drop_expired(self._collect())
+            if not batch:
+                continue
+            if self.observe_wait is not None:
+                started = time.perf_counter()
+                for _, _, queued, _ in batch:
+                    self.observe_wait(started - queued)
+            speeches = [speech for speech, _, _, _ in batch]
+            try:
+                labels = self.classify_batch(speeches)
+            except Exception as exc:  # pylint: disable=broad-exception-caught
+                for _, future, _, _ in batch:
+                    future.set_exception(exc)
+                continue
+            for (_, future, _, _), label in zip(batch, labels):
+                future.set_result(label)
+
+    @staticmethod
+    def _drop_expired(batch):
+        # Nobody is waiting for these any more, so they never reach the model
+        now = time.monotonic()
+        live = []
+        for item in batch:
+            deadline = item[3]
+            if deadline is not None and deadline <= now:
+                item[1].set_exception(DeadlineExceeded("Deadline passed in the queue"))
+            else:
+                live.append(item)
+        return live
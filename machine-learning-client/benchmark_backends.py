@@ -0,0 +1,113 @@
+"""
+Benchmark for the inference backends in backends.py.
+
+Each backend is loaded in its own subprocess through emotion_detector with
+INFERENCE_BACKEND set, so load time and resident memory are measured in
+isolation. Every backend classifies the same synthetic clips; latency is
+timed per clip and logits are compared against the fp32 eager backend.
+
+Usage:
+    python benchmark_backends.py --backends eager int8 onnx --clips 20
+"""
+
+import argparse
+import importlib
+import multiprocessing
+import os
+import time
+
+import numpy as np
+import torch
+
+
+def rss_mb():
+    """Current resident set size of this process in MiB."""
+    with open("/proc/self/status", encoding="utf-8") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024.0
+    return float("nan")
+
+
+def make_clips(count, seconds, seed=0):
+    """Random noise clips of a fixed length at 16 kHz."""
+    rng = np.random.default_rng(seed)
+    return [
+        (rng.standard_normal(int(seconds * 16000)) * 0.1).astype(np.float32)
+        for _ in range(count)
+    ]
+
+
+def measure(backend_name, clips, results):
+    """Load one backend, time it on every clip and report through results."""
+    os.environ["INFERENCE_BACKEND"] = backend_name
+    started = time.perf_counter()
+    detector = importlib.import_module("emotion_detector")
+    load_seconds = time.perf_counter() - started
+
+    # The first call pays for graph capture or session initialisation
+    detector.predict_logits(torch.from_numpy(clips[0]).unsqueeze(0))
+
+    latencies = []
+    logits = []
+    for clip in clips:
+        started = time.perf_counter()
+        logits.append(detector.predict_logits(torch.from_numpy(clip).unsqueeze(0)))
+        latencies.append(time.perf_counter() - started)
+    results.put(
+        {
+            "backend": backend_name,
+            "load_s": load_seconds,
+            "latencies": latencies,
+            "logits": torch.cat(logits).numpy(),
+            "rss_mb": rss_mb(),
+        }
+    )
+
+
+def run_isolated(backend_name, clips):
+    """Run measure in a fresh interpreter and return its result."""
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=measure, args=(backend_name, clips, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def main():
+    """Parse arguments, benchmark each backend and print a comparison."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", maxsplit=1)[0])
+    parser.add_argument(
+        "--backends", nargs="+", default=["eager", "int8", "compile", "onnx"]
+    )
+    parser.add_argument("--clips", type=int, default=20)
+    parser.add_argument("--seconds", type=float, default=4.0)
+    args = parser.parse_args()
+
+    clips = make_clips(args.clips, args.seconds)
+    reference = run_isolated("eager", clips)
+
+    print(
+        f"{'backend':<10} {'load s':>8} {'p50 ms':>8} {'p95 ms':>8} "
+        f"{'RSS MiB':>9} {'labels':>8} {'max dlogit':>11}"
+    )
+    for backend_name in args.backends:
+        result = (
+            reference if backend_name == "eager" else run_isolated(backend_name, clips)
+        )
+        latencies = np.asarray(result["latencies"]) * 1000.0
+        agreement = np.mean(
+            result["logits"].argmax(axis=-1) == reference["logits"].argmax(axis=-1)
+        )
+        max_diff = np.abs(result["logits"] - reference["logits"]).max()
+        print(
+            f"{backend_name:<10} {result['load_s']:>8.1f} "
+            f"{np.percentile(latencies, 50):>8.1f} {np.percentile(latencies, 95):>8.1f} "
+            f"{result['rss_mb']:>9.0f} {agreement:>8.0%} {max_diff:>11.4f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Benchmark for micro-batched inference against the per-request path.
+
+Runs the same synthetic workload twice with a fixed number of concurrent
+callers: once calling classify_speech directly for every request (one
+batch-size-1 forward pass each, as /detect-emotion used to), and once
+going through the MicroBatchScheduler. Prints throughput and latency
+percentiles for both.
+
+Usage:
+    python benchmark_batching.py --concurrency 8 --requests 64
+"""
+
+import argparse
+
+import numpy as np
+
+from batching import MicroBatchScheduler
+from emotion_detector import SAMPLE_RATE, classify_emotions_batch, classify_speech
+from load_generator import percentile, run_load
+
+
+def make_clips(count, min_seconds, max_seconds, seed=0):
+    """Generate random noise clips with lengths spread over the given range."""
+    rng = np.random.default_rng(seed)
+    lengths = rng.uniform(min_seconds, max_seconds, size=count) * SAMPLE_RATE
+    return [rng.standard_normal(int(n)).astype(np.float32) * 0.1 for n in lengths]
+
+
+def report(name, wall, latencies):
+    """Print one result row."""
+    print(
+        f"{name:<14} {len(latencies) / wall:>10.2f} "
+        f"{percentile(latencies, 50):>10.1f} {percentile(latencies, 99):>10.1f}"
+    )
+
+
+def main():
+    """Parse arguments and run both configurations."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", maxsplit=1)[0])
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=64)
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument("--max-wait-ms", type=float, default=10.0)
+    parser.add_argument("--min-seconds", type=float, default=2.0)
+    parser.add_argument("--max-seconds", type=float, default=5.0)
+    args = parser.parse_args()
+
+    clips = make_clips(args.requests, args.min_seconds, args.max_seconds)
+    batcher = MicroBatchScheduler(
+        classify_emotions_batch,
+        max_batch_size=args.max_batch_size,
+        max_wait_ms=args.max_wait_ms,
+    )
+
+    # Warm both paths so neither pays for first-call initialisation
+    classify_speech(clips[0])
+    batcher.classify(clips[0])
+
+    print(f"{'mode':<14} {'req/s':>10} {'p50 ms':>10} {'p99 ms':>10}")
+    report("per-request", *run_load(classify_speech, clips, args.concurrency))
+    report("micro-batch", *run_load(batcher.classify, clips, args.concurrency))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,391 @@
+"""
+End-to-end load test of the ML client and the web app.
+
+Starts both Flask apps in this process on threaded local servers, with the
+web app's /stop pointed at the ML client's /classify. By default Mongo is
+replaced by mongomock and the model by a tiny randomly initialised
+wav2vec2 with a fixed seed, so the run needs no database, no download and
+no GPU and every run classifies the same audio the same way. Pass --mongo
+with a URI to use a real mongod, and --real-model to load MODEL_PATH or
+MODEL_NAME as the service would.
+
+For every clip length and format it generates one synthetic recording per
+request, each different, so the result cache never answers. It then
+measures these stages at each concurrency level:
+
+    decode             decode_audio on the raw bytes, in this process
+    ml.classify        POST the bytes to the ML client's /classify
+    ml.detect_emotion  store the clip in GridFS, POST its id to /detect-emotion
+    web.stop           upload the clip to the web app's /stop
+
+Each row reports throughput and p50/p95/p99 latency. The rows are written
+as JSON to --output. With --compare, rows are matched against an earlier
+run, and the command exits with status 1 if throughput fell, or p95
+latency rose, by more than --tolerance.
+
+Usage:
+    python benchmark_e2e.py --seconds 2 10 --concurrency 1 8 --output run.json
+    python benchmark_e2e.py --compare baseline.json --tolerance 0.2
+"""
+
+import argparse
+import contextlib
+import datetime
+import importlib
+import io
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import threading
+from types import SimpleNamespace
+
+import numpy as np
+import requests
+import torch
+from transformers import Wav2Vec2Config, Wav2Vec2ForSequenceClassification
+from werkzeug.serving import make_server
+
+from audio_decode import decode_audio, encode_audio
+from load_generator import percentile, run_load
+
+SAMPLE_RATE = 16000
+STAGES = ("decode", "ml.classify", "ml.detect_emotion", "web.stop")
+WEB_APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "web-app")
+
+
+def make_recording(seconds, seed):
+    """
+    Synthesise a speech-like recording: a few harmonics of a wandering
+    pitch under a syllable-rate envelope, with a little noise.
+    """
+    rng = np.random.default_rng(seed)
+    times = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+    pitch = rng.uniform(90, 250) * (1 + 0.1 * np.sin(2 * np.pi * 0.5 * times))
+    phase = 2 * np.pi * np.cumsum(pitch) / SAMPLE_RATE
+    voice = sum(np.sin(k * phase) / k for k in range(1, 5))
+    envelope = np.clip(np.sin(2 * np.pi * rng.uniform(2, 5) * times), 0, None)
+    noise = rng.standard_normal(len(times)) * 0.01
+    return (0.3 * voice * envelope + noise).astype(np.float32)
+
+
+def encode_recording(speech, audio_format):
+    """
+    Encode a waveform as it would be uploaded.
+    Args:
+        speech (np.ndarray): 16 kHz mono float32 samples.
+        audio_format (str): "wav" or "flac" for 16-bit PCM, as the browser
+            uploads with UPLOAD_FORMAT=pcm16, or "webm" for Opus in WebM
+            as MediaRecorder records it.
+    Returns:
+        bytes: The encoded file.
+    """
+    return encode_audio(speech, audio_format, SAMPLE_RATE)
+
+
+def make_fixtures(fixture, count, first_seed):
+    """
+    Build count distinct recordings of one format and length.
+    Args:
+        fixture (tuple): The format and the length in seconds.
+        count (int): How many recordings to build.
+        first_seed (int): Seed of the first recording; the rest follow it,
+            so runs given different seeds never send the same audio.
+    Returns:
+        list: The encoded recordings.
+    """
+    audio_format, seconds = fixture
+    return [
+        encode_recording(make_recording(seconds, seed), audio_format)
+        for seed in range(first_seed, first_seed + count)
+    ]
+
+
+def save_stand_in_model(path, num_labels):
+    """
+    Save a two-layer wav2vec2 classifier with seeded random weights. It has
+    the real model's inputs and outputs at a tiny fraction of the cost.
+    """
+    torch.manual_seed(0)
+    config = Wav2Vec2Config(
+        hidden_size=32,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        intermediate_size=64,
+        conv_dim=(16,) * 7,
+        num_conv_pos_embeddings=16,
+        num_conv_pos_embedding_groups=2,
+        classifier_proj_size=16,
+        num_labels=num_labels,
+        feat_extract_norm="layer",
+        do_stable_layer_norm=True,
+    )
+    Wav2Vec2ForSequenceClassification(config).save_pretrained(path)
+
+
+def mongomock_bulk_write(collection, operations, ordered=True, **_kwargs):
+    """
+    Apply UpdateOne operations one at a time. mongomock's own bulk_write
+    does not accept the operations that current pymongo versions build.
+    """
+    del ordered
+    modified = 0
+    for operation in operations:
+        # pylint: disable-next=protected-access
+        fields = operation._filter, operation._doc, operation._upsert
+        modified += collection.update_one(*fields[:2], upsert=fields[2]).modified_count
+    return SimpleNamespace(modified_count=modified)
+
+
+def use_mongomock():
+    """Make every pymongo.MongoClient created from now on a shared mongomock one."""
+    import mongomock  # pylint: disable=import-outside-toplevel
+    import mongomock.gridfs  # pylint: disable=import-outside-toplevel
+    import pymongo  # pylint: disable=import-outside-toplevel
+
+    mongomock.gridfs.enable_gridfs_integration()
+    mongomock.Collection.bulk_write = mongomock_bulk_write
+    shared = mongomock.MongoClient()
+    pymongo.MongoClient = lambda *args, **kwargs: shared
+
+
+def serve(flask_app):
+    """Run a WSGI app on a free local port in a daemon thread."""
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", 0, flask_app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def import_web_app():
+    """
+    Import the web app's app module. Modules it shares a name with, such
+    as metrics, are set aside so it gets its own, then put back.
+    """
+    names = {name[:-3] for name in os.listdir(WEB_APP_DIR) if name.endswith(".py")}
+    ml_modules = {name: sys.modules.pop(name) for name in names & set(sys.modules)}
+    sys.path.insert(0, WEB_APP_DIR)
+    try:
+        return importlib.import_module("app")
+    finally:
+        sys.path.remove(WEB_APP_DIR)
+        sys.modules.update(ml_modules)
+
+
+def start_services(args, workdir):
+    """
+    Set up the stand-ins, then import and start the ML client and the web app.
+    Returns:
+        tuple: The emotion_detector module, the two servers and their URLs.
+    """
+    if args.mongo == "mongomock":
+        use_mongomock()
+    else:
+        os.environ["MONGO_URI"] = args.mongo
+    if not args.real_model:
+        os.environ["MODEL_PATH"] = os.path.join(workdir, "model")
+        save_stand_in_model(os.environ["MODEL_PATH"], 7)
+
+    detector = importlib.import_module("emotion_detector")
+    ml_server, ml_url = serve(detector.create_flask_app())
+    detector.model_loader.get()
+
+    os.environ.update({"ML_CLIENT_URL": ml_url, "STOP_MODE": "sync"})
+    web_app = import_web_app()
+    web_server, web_url = serve(web_app.create_flask_app())
+    return detector, (ml_server, web_server), {"ml": ml_url, "web": web_url}
+
+
+def make_sender(stage, urls, session, errors):
+    """
+    Build the function run_load calls for each request of a stage. Failed
+    requests are counted in errors instead of raising.
+    """
+    targets = {
+        "ml.classify": lambda payload: session.post(
+            urls["ml"] + "/classify", data=payload
+        ),
+        "ml.detect_emotion": lambda payload: session.post(
+            urls["ml"] + "/detect-emotion", json={"fileId": payload}
+        ),
+        "web.stop": lambda payload: session.post(
+            urls["web"] + "/stop", files={"file": ("recording", payload)}
+        ),
+    }
+
+    def send(payload):
+        if stage == "decode":
+            decode_audio(payload, SAMPLE_RATE)
+            return
+        try:
+            ok = targets[stage](payload).ok
+        except requests.RequestException:
+            ok = False
+        if not ok:
+            errors.append(stage)
+
+    return send
+
+
+def summarize(stage, fixture, concurrency, load, errors):
+    """
+    Turn one load run into a result row.
+    Args:
+        load (tuple): What run_load returned.
+        errors (int): How many requests failed.
+    """
+    wall, latencies = load
+    return {
+        "stage": stage,
+        "format": fixture[0],
+        "seconds": fixture[1],
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput": len(latencies) / wall,
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+    }
+
+
+def find_regressions(results, baseline, tolerance):
+    """
+    Compare result rows with a baseline run's rows.
+    Args:
+        results (list): Rows from this run.
+        baseline (list): Rows from the earlier run.
+        tolerance (float): The fraction a metric may worsen by, e.g. 0.2.
+    Returns:
+        list: A description of every metric that worsened too much.
+    """
+
+    def key(row):
+        return row["stage"], row["format"], row["seconds"], row["concurrency"]
+
+    earlier = {key(row): row for row in baseline}
+    regressions = []
+    for row in results:
+        before = earlier.get(key(row))
+        if before is None:
+            continue
+        name = f"{row['stage']} {row['format']}/{row['seconds']}s x{row['concurrency']}"
+        if row["throughput"] < before["throughput"] * (1 - tolerance):
+            regressions.append(
+                f"{name}: throughput {before['throughput']:.1f} -> "
+                f"{row['throughput']:.1f} req/s"
+            )
+        if row["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            regressions.append(
+                f"{name}: p95 {before['p95_ms']:.1f} -> {row['p95_ms']:.1f} ms"
+            )
+    return regressions
+
+
+def print_row(row):
+    """Print one result row under the table header."""
+    fixture = f"{row['format']}/{row['seconds']}s"
+    print(
+        f"{row['stage']:<18} {fixture:<10} {row['concurrency']:>4} "
+        f"{row['throughput']:>8.1f} {row['p50_ms']:>8.1f} {row['p95_ms']:>8.1f} "
+        f"{row['p99_ms']:>8.1f} {row['errors']:>6}"
+    )
+
+
+def run_stages(args, detector, urls):
+    """
+    Run every stage against every fixture at every concurrency level. Each
+    run gets its own recordings, so none is answered by the result cache.
+    Returns:
+        list: A result row per run.
+    """
+    results = []
+    print(
+        f"{'stage':<18} {'fixture':<10} {'conc':>4} {'req/s':>8} "
+        f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>6}"
+    )
+    with requests.Session() as session:
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(args.concurrency))
+        session.mount("http://", adapter)
+        fixtures = [
+            (audio_format, seconds)
+            for audio_format in args.formats
+            for seconds in args.seconds
+        ]
+        for fixture in fixtures:
+            for stage in args.stages:
+                for concurrency in args.concurrency:
+                    payloads = make_fixtures(
+                        fixture, args.requests, len(results) * args.requests
+                    )
+                    if stage == "ml.detect_emotion":
+                        payloads = [str(detector.fs.put(data)) for data in payloads]
+                    errors = []
+                    send = make_sender(stage, urls, session, errors)
+                    # The services print a line per request
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        load = run_load(send, payloads, concurrency)
+                    results.append(
+                        summarize(stage, fixture, concurrency, load, len(errors))
+                    )
+                    print_row(results[-1])
+    return results
+
+
+def main():
+    """Parse arguments, run the benchmark and save or compare the results."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", maxsplit=1)[0])
+    parser.add_argument("--requests", type=int, default=32)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--seconds", type=float, nargs="+", default=[2.0, 10.0])
+    parser.add_argument(
+        "--formats", nargs="+", choices=("wav", "flac", "webm"), default=["wav", "webm"]
+    )
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=list(STAGES))
+    parser.add_argument("--mongo", default="mongomock", help="mongomock or a URI")
+    parser.add_argument("--real-model", action="store_true")
+    parser.add_argument("--output", default="benchmark-results.json")
+    parser.add_argument("--compare", help="JSON results of an earlier run")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        detector, servers, urls = start_services(args, workdir)
+        results = run_stages(args, detector, urls)
+        for server in servers:
+            server.shutdown()
+
+    with open(args.output, "w", encoding="utf-8") as output:
+        json.dump(
+            {
+                "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                "config": vars(args),
+                "environment": {
+                    "python": platform.python_version(),
+                    "torch": torch.__version__,
+                    "cpus": os.cpu_count(),
+                    "backend": detector.INFERENCE_BACKEND,
+                    "model": detector.MODEL_PATH if args.real_model else "stand-in",
+                },
+                "results": results,
+            },
+            output,
+            indent=2,
+        )
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as baseline:
+            regressions = find_regressions(
+                results, json.load(baseline)["results"], args.tolerance
+            )
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""
+Benchmark of fast mode's latency and accuracy against the full model.
+
+Fits probes to the model on three in four fixture recordings, as
+calibrate_early_exit.py does, then classifies the rest with the full
+model and in fast mode at every --thresholds. For each threshold it
+prints how many recordings each layer answered, the share labelled as
+the full model labels them, and the p50/p95 latency and speedup over the
+full model.
+
+Without --real-model it runs a stand-in wav2vec2 classifier with seeded
+random weights and --stand-in-layers encoder layers; its latencies are
+meaningful, but a random model is unusually easy to agree with. Without
+--fixtures it synthesises speech-like recordings.
+
+Usage:
+    python benchmark_early_exit.py --real-model --fixtures recordings/
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+from transformers import Wav2Vec2Config, Wav2Vec2ForSequenceClassification
+
+import emotion_detector as detector
+from calibrate_early_exit import load_fixtures
+from early_exit import fit_probes
+from load_generator import percentile
+
+LABELS = 7
+
+
+def stand_in_model(layers):
+    """A wav2vec2 classifier as wide as XLSR, with seeded random weights."""
+    torch.manual_seed(0)
+    config = Wav2Vec2Config(
+        hidden_size=1024,
+        num_hidden_layers=layers,
+        num_attention_heads=16,
+        intermediate_size=4096,
+        classifier_proj_size=256,
+        num_labels=LABELS,
+        feat_extract_norm="layer",
+        do_stable_layer_norm=True,
+    )
+    return Wav2Vec2ForSequenceClassification(config).eval()
+
+
+def time_full(model, speeches):
+    """
+    Classify each recording with the model's own forward pass.
+    Returns:
+        tuple: The labels and the seconds each took.
+    """
+    labels, latencies = [], []
+    for speech in speeches:
+        started = time.perf_counter()
+        with torch.no_grad():
+            logits = model(torch.from_numpy(speech).unsqueeze(0)).logits
+        latencies.append(time.perf_counter() - started)
+        labels.append(logits.argmax(-1).item())
+    return labels, latencies
+
+
+def time_fast(probes, model, speeches, threshold):
+    """
+    Classify each recording in fast mode.
+    Returns:
+        tuple: The labels, the layers that answered and the seconds each
+            took.
+    """
+    labels, layers, latencies = [], [], []
+    for speech in speeches:
+        started = time.perf_counter()
+        label, _, layer = probes.classify(
+            model, torch.from_numpy(speech).unsqueeze(0), threshold
+        )
+        latencies.append(time.perf_counter() - started)
+        labels.append(label)
+        layers.append(layer)
+    return labels, layers, latencies
+
+
+def main():
+    """Parse arguments, fit the probes and compare fast mode to the model."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", maxsplit=1)[0])
+    parser.add_argument("--real-model", action="store_true")
+    parser.add_argument("--stand-in-layers", type=int, default=24)
+    parser.add_argument("--fixtures", help="a directory of recordings")
+    parser.add_argument("--synthetic", type=int, default=160)
+    parser.add_argument("--layers", nargs="+", type=int)
+    parser.add_argument(
+        "--thresholds", nargs="+", type=float, default=[0.5, 0.7, 0.8, 0.9, 0.95, 0.99]
+    )
+    args = parser.parse_args()
+
+    if args.real_model:
+        model = detector.load_weights(None).eval()
+    else:
+        model = stand_in_model(args.stand_in_layers)
+    speeches = load_fixtures(args.fixtures, args.synthetic)
+    calibration = [s for i, s in enumerate(speeches) if i % 4 != 3]
+    evaluation = [s for i, s in enumerate(speeches) if i % 4 == 3]
+    probes, _ = fit_probes(model, calibration, "benchmark", args.layers)
+    print(
+        f"{len(calibration)} recordings to fit, {len(evaluation)} to evaluate, "
+        f"probes after layers {probes.layers} of {model.config.num_hidden_layers}"
+    )
+
+    # Once to warm up, as a running server would be
+    time_full(model, evaluation[:1])
+    reference, full = time_full(model, evaluation)
+    print(
+        f"{'threshold':>9} {'agree':>7} {'mean layer':>10} "
+        f"{'p50 ms':>9} {'p95 ms':>9} {'speedup':>8}  exits by layer"
+    )
+    print(
+        f"{'full':>9} {1:>7.1%} {model.config.num_hidden_layers:>10.1f} "
+        f"{percentile(full, 50):>9.1f} {percentile(full, 95):>9.1f} {1:>8.2f}"
+    )
+    for threshold in args.thresholds:
+        labels, layers, latencies = time_fast(probes, model, evaluation, threshold)
+        agree = np.mean(np.array(labels) == np.array(reference))
+        exits = dict(zip(*np.unique(layers, return_counts=True)))
+        print(
+            f"{threshold:>9.2f} {agree:>7.1%} {np.mean(layers):>10.1f} "
+            f"{percentile(latencies, 50):>9.1f} {percentile(latencies, 95):>9.1f} "
+            f"{np.mean(full) / np.mean(latencies):>8.2f}  "
+            + " ".join(f"{layer}:{count}" for layer, count in exits.items())
+        )
+
+
+if __name__ == "__main__":
+    main()
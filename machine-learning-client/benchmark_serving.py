@@ -0,0 +1,131 @@
+"""
+Benchmark for serve mode's throughput as the number of workers grows.
+
+Stores one set of synthetic clips in GridFS, then for each worker count
+starts gunicorn with gunicorn.conf.py, waits for /readyz and sends every
+clip to /detect-emotion from a pool of concurrent callers. By default the
+cores are split evenly between the workers. With --torch-threads 1, each
+worker uses one core, so --workers 1 2 4 ... N measures scaling from 1 to
+N cores. The clips are stored without a sha256, so the result cache never
+answers for the model. Proportional set size (PSS) is summed over the
+master and its workers to show how much of the weights they share. Needs
+MongoDB at MONGO_URI.
+
+Usage:
+    python benchmark_serving.py --workers 1 2 4 --torch-threads 1
+"""
+
+import argparse
+import io
+import os
+import subprocess
+import time
+
+import requests
+import soundfile
+
+from benchmark_batching import make_clips
+from emotion_detector import SAMPLE_RATE, fs
+from load_generator import percentile, run_load
+
+
+def store_clips(clips):
+    """Write each clip to GridFS as a WAV file and return the file ids."""
+    file_ids = []
+    for index, clip in enumerate(clips):
+        buffer = io.BytesIO()
+        soundfile.write(buffer, clip, SAMPLE_RATE, format="WAV")
+        file_ids.append(fs.put(buffer.getvalue(), filename=f"benchmark-{index}.wav"))
+    return file_ids
+
+
+def start_server(workers, torch_threads, port):
+    """Start gunicorn and wait until every worker can serve requests."""
+    env = dict(os.environ, SERVE_WORKERS=str(workers), SERVE_BIND=f"127.0.0.1:{port}")
+    if torch_threads:
+        env["TORCH_THREADS_PER_WORKER"] = str(torch_threads)
+    server = subprocess.Popen(  # pylint: disable=consider-using-with
+        ["gunicorn", "-c", "gunicorn.conf.py"],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 300
+    while time.monotonic() < deadline:
+        try:
+            # The master loads the model before forking, so one ready worker
+            # means they are all ready
+            if requests.get(f"http://127.0.0.1:{port}/readyz", timeout=1).ok:
+                return server
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    server.terminate()
+    raise RuntimeError("gunicorn did not become ready")
+
+
+def pss_mb(pid):
+    """Proportional set size of a process and its children, in MiB."""
+    with open(f"/proc/{pid}/task/{pid}/children", encoding="utf-8") as children:
+        pids = [pid] + [int(child) for child in children.read().split()]
+    total = 0
+    for each in pids:
+        with open(f"/proc/{each}/smaps_rollup", encoding="utf-8") as rollup:
+            for line in rollup:
+                if line.startswith("Pss:"):
+                    total += int(line.split()[1])
+    return total / 1024.0
+
+
+def main():
+    """Parse arguments, benchmark each worker count and print a comparison."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", maxsplit=1)[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--torch-threads", type=int, default=0)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=64)
+    parser.add_argument("--min-seconds", type=float, default=2.0)
+    parser.add_argument("--max-seconds", type=float, default=5.0)
+    parser.add_argument("--port", type=int, default=4100)
+    args = parser.parse_args()
+
+    file_ids = store_clips(
+        make_clips(args.requests, args.min_seconds, args.max_seconds)
+    )
+    url = f"http://127.0.0.1:{args.port}/detect-emotion"
+
+    def classify(file_id):
+        requests.post(
+            url, json={"fileId": str(file_id)}, timeout=300
+        ).raise_for_status()
+
+    print(
+        f"{'workers':>7} {'req/s':>10} {'speedup':>8} "
+        f"{'p50 ms':>10} {'p99 ms':>10} {'PSS MiB':>9}"
+    )
+    baseline = None
+    try:
+        for workers in args.workers:
+            server = start_server(workers, args.torch_threads, args.port)
+            try:
+                # Touch every worker once so none pays first-request costs
+                run_load(classify, file_ids[:workers], workers)
+                wall, latencies = run_load(classify, file_ids, args.concurrency)
+                memory = pss_mb(server.pid)
+            finally:
+                server.terminate()
+                server.wait()
+            throughput = len(latencies) / wall
+            baseline = baseline or throughput
+            print(
+                f"{workers:>7} {throughput:>10.2f} {throughput / baseline:>7.2f}x "
+                f"{percentile(latencies, 50):>10.1f} {percentile(latencies, 99):>10.1f} "
+                f"{memory:>9.0f}"
+            )
+    finally:
+        for file_id in file_ids:
+            fs.delete(file_id)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Benchmark for searching the similarity index.
+
+Fills an EmbeddingIndex in a temporary directory with random unit vectors
+of the model's embedding size, then times /similar's search for one query
+and for a batch of queries, at every --sizes. Random vectors are as hard
+to search as real ones: every row is scored either way. It prints the time
+to append the rows, the bytes on disk, and the p50/p95 latency of a search.
+
+Usage:
+    python benchmark_similarity.py --sizes 100000 1000000 --dim 1024
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+from bson import ObjectId
+
+from embedding_index import BLOCK_ROWS, EmbeddingIndex
+from load_generator import percentile
+
+LABELS = ["angry", "disgust", "fear", "happy", "neutral", "sad", "surprise"]
+
+
+def fill(index, rows, dim, seed=0):
+    """Append rows random vectors to index, in chunks; returns the seconds."""
+    rng = np.random.default_rng(seed)
+    started = time.perf_counter()
+    for start in range(0, rows, 50000):
+        count = min(50000, rows - start)
+        vectors = rng.standard_normal((count, dim), dtype=np.float32)
+        emotions = rng.choice(LABELS, count)
+        index.add_many(zip((ObjectId() for _ in range(count)), vectors, emotions))
+    return time.perf_counter() - started
+
+
+def time_searches(index, queries, batch, k):
+    """
+    Search for every query, batch of them at a time.
+    Returns:
+        list: Seconds per search call.
+    """
+    latencies = []
+    for start in range(0, len(queries), batch):
+        started = time.perf_counter()
+        index.search(queries[start : start + batch], k)
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+def main():
+    """Parse arguments, then fill and search an index of each size."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", maxsplit=1)[0])
+    parser.add_argument("--sizes", nargs="+", type=int, default=[100000, 1000000])
+    parser.add_argument("--dim", type=int, default=1024)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--batches", nargs="+", type=int, default=[1, 32])
+    parser.add_argument("--queries", type=int, default=64)
+    parser.add_argument("--block-rows", type=int, default=BLOCK_ROWS)
+    args = parser.parse_args()
+
+    queries = np.random.default_rng(1).standard_normal((args.queries, args.dim))
+    print(
+        f"{'rows':>9} {'append s':>9} {'MiB':>7} {'batch':>6} "
+        f"{'p50 ms':>9} {'p95 ms':>9} {'ms/query':>9}"
+    )
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            index = EmbeddingIndex(directory, "benchmark", LABELS, args.block_rows)
+            seconds = fill(index, size, args.dim)
+            mib = sum(
+                os.path.getsize(os.path.join(directory, name))
+                for name in os.listdir(directory)
+            ) / (1 << 20)
+            # Once to page the vectors in, as a running server would have
+            index.search(queries[0], args.k)
+            for batch in args.batches:
+                latencies = time_searches(index, queries, batch, args.k)
+                print(
+                    f"{size:>9} {seconds:>9.1f} {mib:>7.0f} {batch:>6} "
+                    f"{percentile(latencies, 50):>9.1f} "
+                    f"{percentile(latencies, 95):>9.1f} "
+                    f"{percentile(latencies, 50) / batch:>9.2f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
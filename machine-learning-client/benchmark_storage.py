@@ -0,0 +1,117 @@
+"""
+Benchmark for compacting the recordings stored in GridFS.
+
+Stores synthetic uploads as the web app would: 48 kHz WebM/Opus as
+MediaRecorder records it, 48 kHz WAV, or 16 kHz WAV as the browser sends
+with UPLOAD_FORMAT=pcm16. Then it compacts them with storage.compact to
+each codec in turn. For every combination it prints the bytes stored before
+and after, and the p50/p95 latency of what classify_stored_file does before
+inference: fs.get and reading the file, then decoding it to 16 kHz. Mongo is
+mongomock unless --mongo gives a URI; only a real mongod gives meaningful
+read latencies.
+
+Usage:
+    python benchmark_storage.py --mongo mongodb://localhost:27017 --count 50
+"""
+
+import argparse
+import importlib
+import os
+import time
+
+import librosa
+
+from audio_decode import decode_audio, encode_audio
+from benchmark_e2e import SAMPLE_RATE, make_recording, use_mongomock
+from load_generator import percentile
+
+# The name of each upload format, its container and its sample rate
+UPLOADS = {"webm48": ("webm", 48000), "wav48": ("wav", 48000), "wav16": ("wav", 16000)}
+
+
+def make_uploads(upload, seconds, count):
+    """Encode count different recordings the way one kind of upload arrives."""
+    audio_format, rate = UPLOADS[upload]
+    uploads = []
+    for seed in range(count):
+        speech = make_recording(seconds, seed)
+        if rate != SAMPLE_RATE:
+            speech = librosa.resample(speech, orig_sr=SAMPLE_RATE, target_sr=rate)
+        uploads.append(encode_audio(speech, audio_format, rate))
+    return uploads
+
+
+def time_reads(storage, file_ids):
+    """
+    Time fs.get and read, then decoding, for every stored recording.
+    Returns:
+        tuple: Read and decode latencies in seconds.
+    """
+    reads, decodes = [], []
+    for file_id in file_ids:
+        started = time.perf_counter()
+        data = storage.fs.get(file_id).read()
+        read = time.perf_counter()
+        decode_audio(data, SAMPLE_RATE)
+        reads.append(read - started)
+        decodes.append(time.perf_counter() - read)
+    return reads, decodes
+
+
+def measure(storage, file_ids, label):
+    """Print the stored bytes and read latencies of one state of the files."""
+    stored = sum(
+        document["length"]
+        for document in storage.db.fs.files.find({"_id": {"$in": file_ids}})
+    )
+    reads, decodes = time_reads(storage, file_ids)
+    print(
+        f"{label:<16} {stored:>12} {percentile(reads, 50):>8.2f} "
+        f"{percentile(reads, 95):>8.2f} {percentile(decodes, 50):>9.2f} "
+        f"{percentile(decodes, 95):>9.2f}"
+    )
+    return stored
+
+
+def main():
+    """Parse arguments, then store, measure, compact and measure again."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", maxsplit=1)[0])
+    parser.add_argument("--mongo", default="mongomock")
+    parser.add_argument(
+        "--uploads", nargs="+", choices=sorted(UPLOADS), default=["webm48", "wav48"]
+    )
+    parser.add_argument(
+        "--codecs", nargs="+", choices=["flac", "opus"], default=["flac", "opus"]
+    )
+    parser.add_argument("--bit-rate", type=int, default=24000)
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--count", type=int, default=20)
+    args = parser.parse_args()
+
+    if args.mongo == "mongomock":
+        use_mongomock()
+    else:
+        os.environ["MONGO_URI"] = args.mongo
+    storage = importlib.import_module("storage")
+
+    print(
+        f"{'files':<16} {'bytes':>12} {'get p50':>8} {'get p95':>8} "
+        f"{'dec p50':>9} {'dec p95':>9}  (ms)"
+    )
+    for upload in args.uploads:
+        uploads = make_uploads(upload, args.seconds, args.count)
+        for codec in args.codecs:
+            file_ids = [
+                storage.fs.put(data, filename=f"benchmark-{upload}-{index}")
+                for index, data in enumerate(uploads)
+            ]
+            before = measure(storage, file_ids, upload)
+            storage.compact(codec, bit_rate=args.bit_rate)
+            after = measure(storage, file_ids, f"{upload}->{codec}")
+            print(f"{'':<16} saved {before - after} bytes ({1 - after / before:.0%})")
+            for file_id in file_ids:
+                storage.fs.delete(file_id)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+Benchmark for voice-activity trimming before inference.
+
+Builds recordings as they come from the Start/Stop buttons: synthetic
+speech with silence before it, after it and in a long pause in the middle.
+Each one is classified twice with the configured backend: over every
+sample, as before trimming, and over what vad.trim_silence keeps. Prints
+the audio and inference time saved per recording, whether the two labels
+agree, and how long it takes to reject recordings with no speech at all.
+
+Usage:
+    python benchmark_vad.py --recordings 20 --silent 5
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from benchmark_e2e import make_recording
+from emotion_detector import (
+    EMOTION_LABELS,
+    SAMPLE_RATE,
+    VAD_OPTIONS,
+    model_loader,
+    predict_logits,
+)
+from vad import NoSpeechError, trim_silence
+
+
+def make_silence(seconds, rng):
+    """Background noise about 60 dB below full scale, like a quiet room."""
+    return (rng.standard_normal(int(seconds * SAMPLE_RATE)) * 0.001).astype(np.float32)
+
+
+def make_padded_recording(seed):
+    """Two stretches of speech with silence around and between them."""
+    rng = np.random.default_rng(seed)
+    return np.concatenate(
+        (
+            make_silence(rng.uniform(0.5, 3), rng),
+            make_recording(rng.uniform(1, 4), seed),
+            make_silence(rng.uniform(1, 3), rng),
+            make_recording(rng.uniform(1, 4), seed + 1),
+            make_silence(rng.uniform(1, 4), rng),
+        )
+    )
+
+
+def classify(speech):
+    """Classify one waveform, returning its label and the seconds taken."""
+    started = time.perf_counter()
+    logits = predict_logits(torch.from_numpy(speech).unsqueeze(0))
+    seconds = time.perf_counter() - started
+    return EMOTION_LABELS[int(torch.argmax(logits, dim=-1).item())], seconds
+
+
+def compare(seed):
+    """
+    Classify one padded recording with and without trimming.
+    Returns:
+        tuple: The recording, what trimming kept, the full, trimming and
+            trimmed seconds, and both labels.
+    """
+    speech = make_padded_recording(seed * 2)
+    full_label, full_seconds = classify(speech)
+    started = time.perf_counter()
+    trimmed = trim_silence(speech, VAD_OPTIONS)
+    vad_seconds = time.perf_counter() - started
+    trimmed_label, trimmed_seconds = classify(trimmed)
+    return (
+        speech,
+        trimmed,
+        np.array((full_seconds, vad_seconds, trimmed_seconds)),
+        (full_label, trimmed_label),
+    )
+
+
+def main():
+    """Parse arguments, classify every recording both ways and report."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", maxsplit=1)[0])
+    parser.add_argument("--recordings", type=int, default=20)
+    parser.add_argument("--silent", type=int, default=5)
+    args = parser.parse_args()
+
+    model_loader.get()
+    print(
+        f"{'seed':>4} {'audio s':>8} {'kept s':>8} {'full ms':>8} "
+        f"{'vad ms':>7} {'trim ms':>8} {'saved':>6}  labels"
+    )
+    agree = 0
+    totals = np.zeros(3)
+    for seed in range(args.recordings):
+        speech, trimmed, seconds, labels = compare(seed)
+        agree += labels[0] == labels[1]
+        totals += seconds
+        print(
+            f"{seed:>4} {len(speech) / SAMPLE_RATE:>8.2f} "
+            f"{len(trimmed) / SAMPLE_RATE:>8.2f} {seconds[0] * 1000:>8.1f} "
+            f"{seconds[1] * 1000:>7.2f} {seconds[2] * 1000:>8.1f} "
+            f"{1 - seconds[1:].sum() / seconds[0]:>6.1%}  {labels[0]} / {labels[1]}"
+        )
+
+    print(
+        f"\ncompute saved {1 - totals[1:].sum() / totals[0]:.1%}, "
+        f"labels agree on {agree}/{args.recordings} recordings"
+    )
+
+    rng = np.random.default_rng(0)
+    rejected = 0
+    started = time.perf_counter()
+    for _ in range(args.silent):
+        try:
+            trim_silence(make_silence(rng.uniform(2, 10), rng), VAD_OPTIONS)
+        except NoSpeechError:
+            rejected += 1
+    elapsed = (time.perf_counter() - started) / max(1, args.silent)
+    print(
+        f"rejected {rejected}/{args.silent} silent recordings in "
+        f"{elapsed * 1000:.2f} ms each, without calling the model"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Fit fast mode's probes to the served model on local recordings.
+
+Every recording in --fixtures is decoded and trimmed as the ML client
+would, then run through the whole model; one in early_exit.HOLDOUT is held
+out to calibrate the probes and report how often each one agrees with
+the model. Without --fixtures it synthesises speech-like recordings,
+which only exercise the pipeline. The probes are saved to
+FAST_PROBES_PATH unless --output is given.
+
+Usage:
+    python calibrate_early_exit.py --fixtures recordings/ --layers 6 12 18
+"""
+
+import argparse
+import os
+
+import numpy as np
+
+import emotion_detector as detector
+from benchmark_e2e import make_recording
+from early_exit import fit_probes
+
+
+def load_fixtures(directory, synthetic):
+    """
+    Decode and trim every recording in directory, or synthesise
+    recordings if there is none.
+    Args:
+        directory (str): A directory of recordings, or None.
+        synthetic (int): How many to synthesise without a directory.
+    Returns:
+        list: 1-D float32 waveforms.
+    """
+    if directory is None:
+        rng = np.random.default_rng(0)
+        return [make_recording(rng.uniform(1, 8), seed) for seed in range(synthetic)]
+    speeches = []
+    for name in sorted(os.listdir(directory)):
+        try:
+            speeches.append(
+                detector.trim_speech(
+                    detector.load_speech(os.path.join(directory, name))
+                )
+            )
+        except (detector.NoSpeechError, ValueError, RuntimeError) as exc:
+            print(f"Skipping {name}: {exc}")
+    return speeches
+
+
+def main():
+    """Parse arguments, then fit and save the served model's probes."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", maxsplit=1)[0])
+    parser.add_argument("--fixtures", help="a directory of recordings")
+    parser.add_argument("--synthetic", type=int, default=200)
+    parser.add_argument("--layers", nargs="+", type=int)
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    model = detector.load_weights(None).eval()
+    speeches = load_fixtures(args.fixtures, args.synthetic)
+    print(f"Fitting probes on {len(speeches)} fixtures")
+    probes, agreement = fit_probes(model, speeches, detector.MODEL_VERSION, args.layers)
+    for layer, share in agreement.items():
+        print(f"layer {layer:>3}: agrees with the model on {share:.1%} held out")
+    output = args.output or detector.FAST_PROBES_PATH
+    probes.save(output)
+    print(f"Saved the probes to {output}")
+
+
+if __name__ == "__main__":
+    main()
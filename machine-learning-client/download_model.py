@@ -0,0 +1,22 @@
+"""
+Bakes the emotion model into the image as memory-mappable safetensors.
+
+Usage:
+    python download_model.py <model name> <output directory>
+"""
+
+import sys
+
+from transformers import Wav2Vec2ForSequenceClassification
+
+
+def main():
+    """Download the model and save it with safetensors serialization."""
+    model_name, output_dir = sys.argv[1:3]
+    model = Wav2Vec2ForSequenceClassification.from_pretrained(model_name)
+    model.save_pretrained(output_dir, safe_serialization=True)
+    print(f"Saved {model_name} to {output_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,341 @@
+"""
+Module for classifying with probes on the encoder's intermediate layers.
+
+A probe is a linear classifier on one layer's mean-pooled output, trained
+to agree with the full model on a set of fixture recordings. Fast mode
+runs the encoder one layer at a time and answers with the first probe
+that is at least FAST_THRESHOLD sure, so clear-cut recordings skip the
+rest of the layers. Recordings no probe is sure about go through the
+whole encoder and the model's own head.
+See calibrate_early_exit.py for fitting the probes of the served model.
+"""
+
+import os
+import threading
+
+import torch
+
+from metrics import EARLY_EXITS, stage
+
+PROBE_FIELDS = ("mean", "scale", "weight", "bias", "temperature")
+# One fixture in HOLDOUT is kept out of fitting, to calibrate the
+# temperature of the probes and report how often they agree with the model
+HOLDOUT = 4
+
+
+def supported(model):
+    """
+    Whether fast mode can run a model layer by layer.
+    Args:
+        model: A Wav2Vec2ForSequenceClassification, or None.
+    """
+    config = getattr(model, "config", None)
+    return (
+        config is not None
+        and hasattr(model, "wav2vec2")
+        and not config.use_weighted_layer_sum
+        and not config.add_adapter
+    )
+
+
+def encoder_layers(model, input_values):
+    """
+    Run the wav2vec2 encoder of a sequence classifier one layer at a time,
+    as model.wav2vec2 does in eval mode for an unpadded waveform.
+    Args:
+        model: A Wav2Vec2ForSequenceClassification in eval mode.
+        input_values (torch.Tensor): One waveform of shape (1, samples).
+    Yields:
+        tuple: The number of each encoder layer, from 1, and its output of
+            shape (1, frames, hidden_size).
+    """
+    wav2vec2 = model.wav2vec2
+    encoder = wav2vec2.encoder
+    features = wav2vec2.feature_extractor(input_values).transpose(1, 2)
+    hidden_states = wav2vec2.feature_projection(features)[0]
+    hidden_states = hidden_states + encoder.pos_conv_embed(hidden_states)
+    if not model.config.do_stable_layer_norm:
+        hidden_states = encoder.layer_norm(hidden_states)
+    for number, layer in enumerate(encoder.layers, 1):
+        hidden_states = layer(hidden_states)[0]
+        yield number, hidden_states
+
+
+def head_logits(model, hidden_states):
+    """
+    The model's own logits from the output of its last encoder layer.
+    Args:
+        model: A Wav2Vec2ForSequenceClassification in eval mode.
+        hidden_states (torch.Tensor): The last layer's output from
+            encoder_layers.
+    Returns:
+        torch.Tensor: Logits of shape (1, labels).
+    """
+    if model.config.do_stable_layer_norm:
+        hidden_states = model.wav2vec2.encoder.layer_norm(hidden_states)
+    # The projector is linear, so pooling first gives the same logits
+    return model.classifier(model.projector(hidden_states.mean(dim=1)))
+
+
+class ExitProbes:
+    """
+    The probes of one model, keyed on the encoder layer they read.
+    Each probe standardises the layer's mean-pooled output with the mean
+    and scale of the fixtures, then applies a linear layer and divides
+    the logits by a temperature fitted on the held-out fixtures, so its
+    softmax is about as sure as it is right.
+    """
+
+    def __init__(self, encoder, probes):
+        """
+        Args:
+            encoder (str): Identifies the model the probes were fitted to.
+            probes (dict): For each layer number, a dict of PROBE_FIELDS
+                tensors.
+        """
+        self.encoder = encoder
+        self.probes = dict(sorted(probes.items()))
+
+    @property
+    def layers(self):
+        """The numbers of the probed layers, in order."""
+        return list(self.probes)
+
+    def save(self, path):
+        """Write the probes to path, replacing it whole."""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temporary = f"{path}.tmp"
+        torch.save({"encoder": self.encoder, "probes": self.probes}, temporary)
+        os.replace(temporary, path)
+
+    @classmethod
+    def load(cls, path, encoder):
+        """
+        Args:
+            path (str): A file written by save.
+            encoder (str): The model the probes must have been fitted to.
+        Returns:
+            ExitProbes: The probes, or None if there is no file or it was
+                fitted to another model.
+        """
+        if not os.path.exists(path):
+            return None
+        saved = torch.load(path, weights_only=True)
+        if saved["encoder"] != encoder:
+            print(f"Ignoring the probes in {path}, fitted to {saved['encoder']}")
+            return None
+        return cls(encoder, saved["probes"])
+
+    def probabilities(self, layer, pooled):
+        """
+        Args:
+            layer (int): A probed layer.
+            pooled (torch.Tensor): Its mean-pooled outputs, one per row.
+        Returns:
+            torch.Tensor: The probe's label probabilities, one row each.
+        """
+        probe = self.probes[layer]
+        logits = (pooled - probe["mean"]) / probe["scale"] @ probe["weight"].T
+        return torch.softmax((logits + probe["bias"]) / probe["temperature"], -1)
+
+    def classify(self, model, input_values, threshold):
+        """
+        Classify one waveform, stopping at the first probed layer that is
+        at least threshold sure.
+        Args:
+            model: The Wav2Vec2ForSequenceClassification the probes fit.
+            input_values (torch.Tensor): One waveform of shape (1, samples).
+            threshold (float): The top probability a probe needs to answer;
+                above 1 always runs the whole model.
+        Returns:
+            tuple: The label index, its probability and the number of the
+                layer that answered, the last one for the model's own head.
+        """
+        number, hidden_states = 0, None
+        with torch.no_grad():
+            for number, hidden_states in encoder_layers(model, input_values):
+                if number in self.probes:
+                    probabilities = self.probabilities(
+                        number, hidden_states.mean(dim=1)
+                    )[0]
+                    if probabilities.max() >= threshold:
+                        break
+            else:
+                probabilities = torch.softmax(head_logits(model, hidden_states)[0], -1)
+        confidence, label = probabilities.max(dim=-1)
+        return label.item(), confidence.item(), number
+
+
+class EarlyExit:
+    """
+    Fast mode of the served model: its probes, loaded on first use, and
+    the threshold they answer at.
+    """
+
+    def __init__(self, path, encoder, threshold):
+        """
+        Args:
+            path (str): Where the probes are saved.
+            encoder (str): The model they must have been fitted to.
+            threshold (float): See ExitProbes.classify.
+        """
+        self.path = path
+        self.encoder = encoder
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._loaded = {}
+
+    def probes(self):
+        """The ExitProbes in path, or None if there are none for encoder."""
+        with self._lock:
+            if "probes" not in self._loaded:
+                self._loaded["probes"] = ExitProbes.load(self.path, self.encoder)
+            return self._loaded["probes"]
+
+    def usable(self, backend):
+        """Whether backend's model can run in fast mode with the probes."""
+        return self.probes() is not None and supported(getattr(backend, "model", None))
+
+    def classify(self, backend, speech, labels):
+        """
+        Args:
+            backend: An inference backend that usable accepts.
+            speech (np.ndarray): 1-D float32 waveform.
+            labels (list): The emotion of each label index.
+        Returns:
+            tuple: The emotion and the number of the layer that answered.
+        """
+        with stage("inference"):
+            label, _, layer = self.probes().classify(
+                backend.model, torch.from_numpy(speech).unsqueeze(0), self.threshold
+            )
+        EARLY_EXITS.labels(str(layer)).inc()
+        return labels[label], layer
+
+
+def default_layers(num_layers):
+    """A probe after each quarter of the encoder, except the last."""
+    return sorted({max(1, num_layers * i // 4) for i in (1, 2, 3)} - {num_layers})
+
+
+def collect(model, speeches, layers):
+    """
+    Run every fixture through the whole model.
+    Args:
+        model: A Wav2Vec2ForSequenceClassification in eval mode.
+        speeches (list): 1-D float32 waveforms.
+        layers (list): The layers whose pooled outputs to keep.
+    Returns:
+        tuple: For each layer, its pooled outputs as one row per fixture,
+            and the label the model gives each fixture.
+    """
+    pooled = {layer: [] for layer in layers}
+    targets = []
+    hidden_states = None
+    with torch.no_grad():
+        for speech in speeches:
+            input_values = torch.from_numpy(speech).unsqueeze(0)
+            for number, hidden_states in encoder_layers(model, input_values):
+                if number in pooled:
+                    pooled[number].append(hidden_states.mean(dim=1)[0])
+            targets.append(head_logits(model, hidden_states).argmax(-1).item())
+    return {layer: torch.stack(rows) for layer, rows in pooled.items()}, torch.tensor(
+        targets
+    )
+
+
+def minimize(parameters, loss, steps=100):
+    """Fit parameters to minimise loss() with L-BFGS."""
+    optimizer = torch.optim.LBFGS(
+        parameters, max_iter=steps, line_search_fn="strong_wolfe"
+    )
+
+    def closure():
+        optimizer.zero_grad()
+        value = loss()
+        value.backward()
+        return value
+
+    optimizer.step(closure)
+
+
+def fit_probe(features, targets, num_labels, held_out, l2=1e-2):
+    """
+    Fit one probe by L2-regularised logistic regression on the fixtures
+    not held out, then its temperature on those that are.
+    Args:
+        features (torch.Tensor): A layer's pooled outputs, one row each.
+        targets (torch.Tensor): The full model's label for each row.
+        num_labels (int): The model's label count.
+        held_out (torch.Tensor): Boolean mask of the rows held out.
+        l2 (float): Weight of the L2 penalty on the probe's weights.
+    Returns:
+        dict: The probe's PROBE_FIELDS tensors.
+    """
+    train = ~held_out
+    mean = features[train].mean(dim=0)
+    scale = features[train].std(dim=0).nan_to_num(1.0).clamp_min(1e-6)
+    inputs = (features - mean) / scale
+    weight = torch.zeros(num_labels, features.shape[1], requires_grad=True)
+    bias = torch.zeros(num_labels, requires_grad=True)
+    minimize(
+        [weight, bias],
+        lambda: torch.nn.functional.cross_entropy(
+            inputs[train] @ weight.T + bias, targets[train]
+        )
+        + l2 * weight.pow(2).sum(),
+    )
+    log_temperature = torch.zeros(1, requires_grad=True)
+    if held_out.any():
+        logits = (inputs[held_out] @ weight.T + bias).detach()
+        minimize(
+            [log_temperature],
+            lambda: torch.nn.functional.cross_entropy(
+                logits / log_temperature.exp(), targets[held_out]
+            ),
+        )
+    return {
+        "mean": mean,
+        "scale": scale,
+        "weight": weight.detach(),
+        "bias": bias.detach(),
+        "temperature": log_temperature.detach().exp(),
+    }
+
+
+def fit_probes(model, speeches, encoder, layers=None):
+    """
+    Fit a probe to each of layers on fixture recordings.
+    Args:
+        model: A Wav2Vec2ForSequenceClassification in eval mode.
+        speeches (list): 1-D float32 waveforms, at least two.
+        encoder (str): Identifies the model, see ExitProbes.
+        layers (list): Layer numbers to probe, default_layers if None.
+    Returns:
+        tuple: The ExitProbes, and for each probed layer how many of the
+            held-out fixtures it labels as the model does.
+    """
+    if layers is None:
+        layers = default_layers(model.config.num_hidden_layers)
+    pooled, targets = collect(model, speeches, layers)
+    held_out = torch.arange(len(targets)) % HOLDOUT == HOLDOUT - 1
+    probes = ExitProbes(
+        encoder,
+        {
+            layer: fit_probe(features, targets, model.config.num_labels, held_out)
+            for layer, features in pooled.items()
+        },
+    )
+    agreement = {
+        layer: (
+            probes.probabilities(layer, features[held_out]).argmax(-1)
+            == targets[held_out]
+        )
+        .float()
+        .mean()
+        .item()
+        for layer, features in pooled.items()
+    }
+    return probes, agreement
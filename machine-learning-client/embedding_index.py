@@ -0,0 +1,327 @@
+"""Module for finding stored recordings with similar pooled embeddings"""
+
+import fcntl
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+
+from metrics import stage
+
+# Rows scored per matrix product, which bounds the scores a search holds
+BLOCK_ROWS = 8192
+FILES = ("vectors", "ids", "labels")
+
+
+def normalize(vectors):
+    """Scale rows to unit length, so a dot product is their cosine."""
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1)
+
+
+def vote(neighbours):
+    """
+    Pick the emotion most of the neighbours agree on, weighted by score.
+    Args:
+        neighbours (list): Results of EmbeddingIndex.search for one query.
+    Returns:
+        tuple: The emotion, or None if no neighbour has one, and its share
+            of the votes.
+    """
+    weights = {}
+    for neighbour in neighbours:
+        if neighbour["emotion"] is not None and neighbour["score"] > 0:
+            weights[neighbour["emotion"]] = (
+                weights.get(neighbour["emotion"], 0.0) + neighbour["score"]
+            )
+    if not weights:
+        return None, 0.0
+    emotion = max(weights, key=weights.get)
+    return emotion, weights[emotion] / sum(weights.values())
+
+
+class EmbeddingIndex:
+    """
+    Pooled embeddings of stored recordings, keyed on their fs.files id,
+    in memory-mapped .npy files so the operating system pages them in and
+    every process on the machine shares one copy.
+
+    Vectors are kept unit length in float16, 2 bytes per dimension, next to
+    the 12 bytes of each id and the index of its emotion in labels. A
+    search scores every row with one matrix product per BLOCK_ROWS rows,
+    in float16 straight from the mapping: PyTorch's half-precision kernels
+    are an order of magnitude faster than converting the rows to float32
+    first, and scores within about 1e-3 of each other may swap places.
+    Rows are appended under a file lock, so the ML client's workers and the
+    job workers can all add to the same directory; each process picks up
+    the others' rows on its next call. Adding a recording again replaces
+    its row.
+    """
+
+    def __init__(self, directory, encoder, labels, block_rows=BLOCK_ROWS):
+        """
+        Args:
+            directory (str): Where the index is kept; created on first add.
+            encoder (str): Identifies the encoder. An index written by another
+                encoder is discarded on first add.
+            labels (list): The emotions the labels of rows refer to.
+            block_rows (int): Rows scored per matrix product.
+        """
+        self.directory = directory
+        self.encoder = encoder
+        self.labels = list(labels)
+        self.block_rows = block_rows
+        self._lock = threading.Lock()
+        self._meta = {"count": 0, "capacity": 0}
+        # This process's mappings of the files, the meta.json they were
+        # mapped for, and the row of each fs.files id
+        self._mapped = {"arrays": {}, "stamp": None, "rows": {}}
+
+    def __len__(self):
+        with self._lock:
+            self._refresh()
+            return self._meta["count"]
+
+    def path(self, name):
+        """The path of one of the index's files."""
+        return os.path.join(self.directory, name)
+
+    def get(self, file_id):
+        """
+        Returns:
+            np.ndarray: The recording's unit-length float32 vector, or None
+                if it is not indexed.
+        """
+        with self._lock:
+            self._refresh()
+            row = self._mapped["rows"].get(file_id.binary)
+            if row is None:
+                return None
+            return self._mapped["arrays"]["vectors"][row].astype(np.float32)
+
+    def add_many(self, items):
+        """
+        Append recordings, or replace the rows of ones already indexed.
+        Indexing is best effort, so a full disk never fails classification.
+        Args:
+            items (list): (file_id, vector, emotion) triples, emotion being
+                one of labels or None.
+        """
+        items = list(items)
+        if not items:
+            return
+        try:
+            self._append(items, normalize([vector for _, vector, _ in items]))
+        except OSError as exc:
+            print(f"Failed to index embeddings: {exc}")
+
+    def _append(self, items, vectors):
+        with self._locked():
+            if self._meta.get("encoder") not in (None, self.encoder):
+                print(f"Discarding the similarity index of {self._meta['encoder']}")
+                self._reset()
+            if not self._meta["count"]:
+                self._meta.update(
+                    encoder=self.encoder, dim=vectors.shape[1], labels=self.labels
+                )
+            count, rows = self._meta["count"], self._mapped["rows"]
+            self._reserve(count + len({item[0].binary for item in items} - set(rows)))
+            arrays = self._mapped["arrays"]
+            for (file_id, _, emotion), vector in zip(items, vectors):
+                row = rows.get(file_id.binary)
+                if row is None:
+                    row = rows[file_id.binary] = count
+                    count += 1
+                arrays["vectors"][row] = vector
+                arrays["ids"][row] = np.frombuffer(file_id.binary, np.uint8)
+                arrays["labels"][row] = self._label(emotion)
+            # Readers only look at rows below count, so it goes last
+            self._meta["count"] = count
+            self._write_meta()
+
+    def add(self, file_id, vector, emotion):
+        """Append one recording, see add_many."""
+        self.add_many([(file_id, vector, emotion)])
+
+    def relabel_many(self, items):
+        """
+        Change the emotion of recordings already indexed.
+        Args:
+            items (list): (file_id, emotion) pairs.
+        Returns:
+            list: The ids of the recordings that are not indexed.
+        """
+        items = list(items)
+        with self._locked():
+            missing = []
+            for file_id, emotion in items:
+                row = self._mapped["rows"].get(file_id.binary)
+                if row is None:
+                    missing.append(file_id)
+                else:
+                    self._mapped["arrays"]["labels"][row] = self._label(emotion)
+            return missing
+
+    def search(self, queries, k=10, exclude=()):
+        """
+        Find the indexed recordings closest to each query by cosine
+        similarity.
+        Args:
+            queries (np.ndarray): One vector, or one per row.
+            k (int): How many neighbours to return per query.
+            exclude (list): fs.files ids to leave out, such as the query's.
+        Returns:
+            list: For each query, up to k dicts of fileId, emotion and
+                score, best first.
+        """
+        queries = normalize(queries)
+        with self._lock:
+            self._refresh()
+            count, rows = self._meta["count"], self._mapped["rows"]
+            arrays = dict(self._mapped["arrays"])
+            excluded = [rows[i.binary] for i in exclude if i.binary in rows]
+        if not count or k <= 0:
+            return [[] for _ in queries]
+        scores, rows = self._scan(queries, arrays["vectors"][:count], k, excluded)
+        ids, labels = arrays["ids"], arrays["labels"]
+        order = np.argsort(-scores, axis=1)[:, :k]
+        return [
+            [
+                {
+                    "fileId": ids[row].tobytes().hex(),
+                    "emotion": self._emotion(labels[row]),
+                    "score": float(score),
+                }
+                for row, score in zip(rows[query, picked], scores[query, picked])
+                if np.isfinite(score)
+            ]
+            for query, picked in enumerate(order)
+        ]
+
+    def similar(self, vector, k=10, exclude=()):
+        """
+        The indexed recordings closest to one vector and the emotion they
+        vote for.
+        Args:
+            vector (np.ndarray): A pooled embedding from the same encoder.
+            k (int): How many neighbours to return.
+            exclude (list): fs.files ids to leave out, such as the vector's.
+        Returns:
+            dict: The neighbours, best first, the emotion most of them share
+                by score and its share, and how many recordings are indexed.
+        """
+        with stage("similarity_search"):
+            neighbours = self.search(vector, k, exclude)[0]
+        emotion, share = vote(neighbours)
+        return {
+            "neighbours": neighbours,
+            "vote": {"emotion": emotion, "share": round(share, 3)},
+            "indexed": len(self),
+        }
+
+    def _scan(self, queries, vectors, k, excluded):
+        # Each block's k best rows, then the candidates of every block
+        best_scores, best_rows = [], []
+        queries = torch.from_numpy(queries).half()
+        for start in range(0, len(vectors), self.block_rows):
+            block = torch.from_numpy(vectors[start : start + self.block_rows])
+            with torch.no_grad():
+                scores = (queries @ block.T).float().numpy()
+            for row in excluded:
+                if start <= row < start + len(block):
+                    scores[:, row - start] = -np.inf
+            if len(block) > k:
+                top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+                scores = np.take_along_axis(scores, top, axis=1)
+            else:
+                top = np.broadcast_to(np.arange(len(block)), scores.shape)
+            best_scores.append(scores)
+            best_rows.append(top + start)
+        return np.concatenate(best_scores, axis=1), np.concatenate(best_rows, axis=1)
+
+    def _label(self, emotion):
+        return self.labels.index(emotion) if emotion in self.labels else -1
+
+    def _emotion(self, label):
+        labels = self._meta.get("labels", self.labels)
+        return labels[label] if 0 <= label < len(labels) else None
+
+    @contextmanager
+    def _locked(self):
+        # The thread lock, then the file lock the other processes take
+        os.makedirs(self.directory, exist_ok=True)
+        with self._lock, open(self.path("lock"), "w", encoding="utf-8") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self._refresh()
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _refresh(self):
+        # Caller holds the lock. Picks up rows other processes appended
+        try:
+            status = os.stat(self.path("meta.json"))
+        except FileNotFoundError:
+            return
+        stamp = (status.st_mtime_ns, status.st_size, status.st_ino)
+        if stamp == self._mapped["stamp"]:
+            return
+        with open(self.path("meta.json"), encoding="utf-8") as file:
+            meta = json.load(file)
+        mapped = self._mapped
+        if meta["capacity"] != self._meta["capacity"] or not mapped["arrays"]:
+            mapped["arrays"] = {
+                name: np.load(self.path(f"{name}.npy"), mmap_mode="r+")
+                for name in FILES
+                if meta["capacity"]
+            }
+            mapped["rows"] = {}
+        for row in range(len(mapped["rows"]), meta["count"]):
+            mapped["rows"][mapped["arrays"]["ids"][row].tobytes()] = row
+        self._meta, mapped["stamp"] = meta, stamp
+
+    def _reserve(self, rows):
+        # Caller holds _locked. Grows the files by doubling, copying into
+        # new ones that replace the old; mappings of the old stay valid
+        capacity = self._meta["capacity"]
+        if rows <= capacity:
+            return
+        capacity = max(rows, 2 * capacity, 1024)
+        shapes = {
+            "vectors": ((capacity, self._meta["dim"]), np.float16),
+            "ids": ((capacity, 12), np.uint8),
+            "labels": ((capacity,), np.int8),
+        }
+        count = self._meta["count"]
+        for name, (shape, dtype) in shapes.items():
+            temporary = self.path(f"{name}.tmp.npy")
+            array = np.lib.format.open_memmap(temporary, "w+", dtype, shape)
+            if count:
+                array[:count] = self._mapped["arrays"][name][:count]
+            array.flush()
+            os.replace(temporary, self.path(f"{name}.npy"))
+            self._mapped["arrays"][name] = array
+        self._meta["capacity"] = capacity
+
+    def _reset(self):
+        # Caller holds _locked
+        for name in FILES:
+            if os.path.exists(self.path(f"{name}.npy")):
+                os.remove(self.path(f"{name}.npy"))
+        self._meta = {"count": 0, "capacity": 0}
+        self._mapped.update(arrays={}, rows={})
+        self._write_meta()
+
+    def _write_meta(self):
+        # Replaced whole, so readers never see half of it
+        temporary = self.path("meta.json.tmp")
+        with open(temporary, "w", encoding="utf-8") as file:
+            json.dump(self._meta, file)
+        os.replace(temporary, self.path("meta.json"))
+        status = os.stat(self.path("meta.json"))
+        self._mapped["stamp"] = (status.st_mtime_ns, status.st_size, status.st_ino)
@@ -0,0 +1,102 @@
+"""Module for storing pooled encoder embeddings by audio content hash"""
+
+import numpy as np
+from bson.binary import Binary
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+
+
+def encode_embedding(vector):
+    """Pack an embedding into float16 bytes, 2 bytes per dimension."""
+    return Binary(np.asarray(vector, dtype=np.float16).tobytes())
+
+
+def decode_embedding(data):
+    """Unpack bytes written by encode_embedding into a float32 vector."""
+    return np.frombuffer(data, dtype=np.float16).astype(np.float32)
+
+
+class EmbeddingStore:
+    """
+    Pooled wav2vec2 encoder embeddings kept in a Mongo collection, one
+    document per distinct recording and encoder, keyed on the SHA-256 of
+    the audio and the encoder that produced it. Several models can share
+    the collection without replacing each other's embeddings.
+
+    A new classifier head or label set can then be applied to stored
+    recordings by reading the embeddings back, without decoding audio or
+    running the encoder again. Documents written before the encoder was
+    part of the key, keyed on the digest alone, are still read.
+    """
+
+    def __init__(self, collection, encoder):
+        """
+        Args:
+            collection: The Mongo collection holding the embeddings.
+            encoder (str): Identifies the encoder; only embeddings written
+                with the same value are returned.
+        """
+        self.collection = collection
+        self.encoder = encoder
+
+    def key(self, digest):
+        """The _id of this encoder's embedding of the audio with digest."""
+        return {"sha256": digest, "encoder": self.encoder}
+
+    def put_many(self, items):
+        """
+        Save embeddings, replacing any earlier ones for the same audio.
+        Storage is best effort, so a Mongo error never fails classification.
+        Args:
+            items (list): (sha256, vector) pairs.
+        """
+        updates = [
+            UpdateOne(
+                {"_id": self.key(digest)},
+                {
+                    "$set": {
+                        "encoder": self.encoder,
+                        "embedding": encode_embedding(vector),
+                    }
+                },
+                upsert=True,
+            )
+            for digest, vector in items
+        ]
+        if not updates:
+            return
+        try:
+            self.collection.bulk_write(updates, ordered=False)
+        except PyMongoError as exc:
+            print(f"Failed to store embeddings: {exc}")
+
+    def put(self, digest, vector):
+        """Save one embedding, see put_many."""
+        self.put_many([(digest, vector)])
+
+    def get_many(self, digests):
+        """
+        Args:
+            digests (list): SHA-256 hex digests of recordings.
+        Returns:
+            dict: Maps each digest with a stored embedding from this
+                encoder to its float32 vector.
+        """
+        digests = list(digests)
+        documents = self.collection.find(
+            {
+                "$or": [
+                    {"_id": {"$in": [self.key(digest) for digest in digests]}},
+                    {"_id": {"$in": digests}, "encoder": self.encoder},
+                ]
+            }
+        )
+        found = {}
+        # Legacy documents, keyed on the digest alone, sort first so that
+        # this encoder's current ones replace them
+        for document in sorted(documents, key=lambda doc: isinstance(doc["_id"], dict)):
+            digest = document["_id"]
+            if isinstance(digest, dict):
+                digest = digest["sha256"]
+            found[digest] = decode_embedding(document["embedding"])
+        return found
@@ -1,21 +1,97 @@
 """Module for audio stuff"""
 
+# pylint: disable=too-many-lines
+
+import atexit
+import datetime
+import hashlib
+import json
+import math
 import os
-import tempfile
+import re
+import signal
+import sys
+import threading
+import time
+import functools
 import pyaudio
 import torch
 from transformers import Wav2Vec2ForSequenceClassification
 import librosa
+import numpy as np
 from flask import Flask, request, jsonify
 import pymongo
 import gridfs
 from bson import ObjectId, errors
+from pymongo import UpdateOne
 from pymongo.errors import ConnectionFailure, OperationFailure
 from gridfs.errors import NoFile
+from admission import AdmissionController, Overloaded
+from audio_decode import StreamDecoder, decode_audio
+from backends import backend_bytes, load_backend
+from batching import DeadlineExceeded, MicroBatchScheduler, pad_batch
+from early_exit import EarlyExit
+from embedding_index import EmbeddingIndex
+from embedding_store import EmbeddingStore
+from metrics import (
+    AUDIO_SECONDS,
+    NO_SPEECH,
+    SHED,
+    QUEUE_DEPTH,
+    instrument,
+    metrics_response,
+    observe,
+    stage,
+)
+from model_loader import ModelLoader
+from model_registry import ModelRegistry, UnknownModel
+import request_profiler
+from result_cache import ResultCache
+from rollups import record_emotions
+from streaming import StreamDecodeError, StreamRegistry
+from vad import NoSpeechError, trim_silence
+from windowing import AGGREGATIONS, classify_windowed
+from write_buffer import WriteBuffer, write_concern
+
+# The Wav2Vec2 model for emotion classification, loaded by model_loader
+MODEL_NAME = os.getenv(
+    "MODEL_NAME", "ehcalabres/wav2vec2-lg-xlsr-en-speech-emotion-recognition"
+)
+# Local safetensors copy baked into the image by download_model.py
+MODEL_PATH = os.getenv("MODEL_PATH", "/models/emotion")
+
+# Other models served next to MODEL_NAME, as a JSON object of model id to
+# Hugging Face name or local directory, e.g. {"fr": "/models/emotion-fr"}.
+# A request picks one by id in MODEL_HEADER; the rest get MODEL_ID, which
+# is MODEL_NAME. They are loaded on first use and the least recently used
+# is evicted when the weights resident would exceed MODEL_MEMORY_BUDGET_MB
+# (0 for no limit). MODEL_ID itself is never evicted.
+MODEL_ID = os.getenv("MODEL_ID", "default")
+EXTRA_MODELS = json.loads(os.getenv("EXTRA_MODELS", "{}"))
+MODEL_MEMORY_BUDGET_MB = float(os.getenv("MODEL_MEMORY_BUDGET_MB", "0"))
+MODEL_HEADER = "X-Model"
+
+# Identifies the encoder behind stored embeddings; a model that only changes
+# the classifier head can keep the same value and reuse them
+EMBEDDING_ENCODER = os.getenv("EMBEDDING_ENCODER", MODEL_NAME)
 
-# Load the Wav2Vec2 model for emotion classification
-MODEL_NAME = "ehcalabres/wav2vec2-lg-xlsr-en-speech-emotion-recognition"
-model = Wav2Vec2ForSequenceClassification.from_pretrained(MODEL_NAME)
+# Memory-mapped index of the default model's embeddings by fs.files id,
+# shared by every process that can see the directory, see /similar
+SIMILARITY_INDEX_DIR = os.getenv("SIMILARITY_INDEX_DIR", "similarity_index")
+# Neighbours whose emotions are voted on by mode "knn", and when /detect-emotion
+# is shed with KNN_FALLBACK on
+KNN_NEIGHBOURS = int(os.getenv("KNN_NEIGHBOURS", "10"))
+KNN_FALLBACK = os.getenv("KNN_FALLBACK", "1") == "1"
+SIMILAR_MAX_K = 100
+
+# One of eager, int8, compile or onnx, see backends.py
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "eager")
+ONNX_MODEL_PATH = os.getenv("ONNX_MODEL_PATH", "models/emotion.onnx")
+
+# Mode "fast" stops at the first probed encoder layer that is at least
+# FAST_THRESHOLD sure; calibrate_early_exit.py fits the probes
+FAST_PROBES_PATH = os.getenv("FAST_PROBES_PATH", "models/exit_probes.pt")
+FAST_THRESHOLD = float(os.getenv("FAST_THRESHOLD", "0.9"))
 
 # Constants for audio recording
 SAMPLE_RATE = 16000
@@ -24,44 +100,807 @@ FORMAT = pyaudio.paInt16
 CHUNK_SIZE = 1024
 RECORD_SECONDS = 15
 
+# Emotion labels based on the model's fine-tuning
+EMOTION_LABELS = ["angry", "disgust", "fear", "happy", "neutral", "sad", "surprise"]
+
+
+def model_version(source):
+    """
+    Stamped on fs.files next to each emotion, so backfill.py can find
+    results from an older model or label set.
+    Args:
+        source (str): The Hugging Face name or directory of the model.
+    Returns:
+        str: The source and a digest of EMOTION_LABELS.
+    """
+    return (
+        source + ":" + hashlib.sha256(",".join(EMOTION_LABELS).encode()).hexdigest()[:8]
+    )
+
+
+MODEL_VERSION = model_version(MODEL_NAME)
+
+# Micro-batching of concurrent /detect-emotion requests
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "8"))
+BATCH_MAX_WAIT_MS = float(os.getenv("BATCH_MAX_WAIT_MS", "10"))
+
+# Number of results kept in the in-process cache in front of Mongo
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "1024"))
+
+# Emotions are saved on fs.files after the request is answered, in batches
+# of up to RESULT_WRITE_BATCH_SIZE held at most RESULT_WRITE_MAX_WAIT_MS;
+# RESULT_WRITE_BEHIND=0 saves each one before answering instead
+RESULT_WRITE_BEHIND = os.getenv("RESULT_WRITE_BEHIND", "1") == "1"
+RESULT_WRITE_BATCH_SIZE = int(os.getenv("RESULT_WRITE_BATCH_SIZE", "64"))
+RESULT_WRITE_MAX_WAIT_MS = float(os.getenv("RESULT_WRITE_MAX_WAIT_MS", "50"))
+RESULT_WRITE_MAX_PENDING = int(os.getenv("RESULT_WRITE_MAX_PENDING", "10000"))
+# The write concern of those writes: w is a node count or "majority"
+RESULT_WRITE_W = os.getenv("RESULT_WRITE_W", "1")
+RESULT_WRITE_JOURNAL = os.getenv("RESULT_WRITE_JOURNAL", "0") == "1"
+
+# On-demand profiling, see request_profiler.py: requests sending
+# PROFILE_TOKEN in request_profiler.PROFILE_HEADER, and PROFILE_SAMPLE_RATE
+# of all requests, write their profiles to PROFILE_DIR, which keeps the
+# newest PROFILE_KEEP. With neither set no request is profiled
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "20"))
+
+# Sliding-window inference for long recordings
+WINDOW_SECONDS = float(os.getenv("WINDOW_SECONDS", "10"))
+WINDOW_HOP_SECONDS = float(os.getenv("WINDOW_HOP_SECONDS", "5"))
+WINDOW_BATCH_SIZE = int(os.getenv("WINDOW_BATCH_SIZE", "4"))
+WINDOWED_MIN_SECONDS = float(os.getenv("WINDOWED_MIN_SECONDS", "30"))
+
+# Incremental classification of recordings streamed in while recording
+STREAM_WINDOW_SECONDS = float(os.getenv("STREAM_WINDOW_SECONDS", "3"))
+STREAM_MIN_TAIL_SECONDS = float(os.getenv("STREAM_MIN_TAIL_SECONDS", "1"))
+STREAM_IDLE_SECONDS = float(os.getenv("STREAM_IDLE_SECONDS", "120"))
+STREAM_MAX_BYTES = int(os.getenv("STREAM_MAX_BYTES", str(50 * 1024 * 1024)))
+SESSION_ID_PATTERN = re.compile(r"[A-Za-z0-9-]{1,64}")
+
+# Admission control: at most ADMISSION_MAX_PENDING recordings in inference,
+# and none admitted that would finish after its deadline. Clients send the
+# seconds they will wait in DEADLINE_HEADER; ADMISSION_MAX_WAIT_SECONDS is
+# the deadline of requests that send none. The cost of a second of audio starts at
+# ADMISSION_INITIAL_COST and is then learned from each forward pass.
+ADMISSION_MAX_PENDING = int(os.getenv("ADMISSION_MAX_PENDING", "32"))
+ADMISSION_MAX_WAIT_SECONDS = float(os.getenv("ADMISSION_MAX_WAIT_SECONDS", "30"))
+ADMISSION_INITIAL_COST = float(os.getenv("ADMISSION_INITIAL_COST", "0.25"))
+DEADLINE_HEADER = "X-Request-Timeout"
+
+# Voice-activity trimming before inference, see vad.DEFAULTS
+VAD_ENABLED = os.getenv("VAD_ENABLED", "1") == "1"
+VAD_OPTIONS = {
+    "sample_rate": SAMPLE_RATE,
+    "threshold_db": float(os.getenv("VAD_THRESHOLD_DB", "-50")),
+    "relative_db": float(os.getenv("VAD_RELATIVE_DB", "40")),
+    "zcr_threshold": float(os.getenv("VAD_ZCR_THRESHOLD", "0.25")),
+    "pad_ms": int(os.getenv("VAD_PAD_MS", "150")),
+    "max_pause_ms": int(os.getenv("VAD_MAX_PAUSE_MS", "500")),
+    "min_speech_ms": int(os.getenv("VAD_MIN_SPEECH_MS", "100")),
+}
+
 # database connection
 uri = os.getenv("MONGO_URI", "mongodb://localhost:27017/emotions")
-client = pymongo.MongoClient(uri)
+# Connect on first use, so workers forked by gunicorn.conf.py open their own
+client = pymongo.MongoClient(uri, connect=False)
 db = client["audio-analysis"]
 fs = gridfs.GridFS(db)
+result_cache = ResultCache(
+    db["inference_cache"], MODEL_VERSION, max_entries=RESULT_CACHE_SIZE
+)
+embedding_store = EmbeddingStore(db["embeddings"], EMBEDDING_ENCODER)
+similarity_index = EmbeddingIndex(
+    SIMILARITY_INDEX_DIR, EMBEDDING_ENCODER, EMOTION_LABELS
+)
+# The default model's probes, loaded on the first fast request
+early_exit = EarlyExit(FAST_PROBES_PATH, MODEL_VERSION, FAST_THRESHOLD)
+# Hourly emotion counts the web app's analytics read
+emotion_rollups = db["emotion_rollups"]
+result_files = db.fs.files.with_options(
+    write_concern=write_concern(RESULT_WRITE_W, RESULT_WRITE_JOURNAL)
+)
 
 
 # Emotion classification function
 def classify_emotion_from_audio(filename):
     """
-    Classify the emotion from an audio file stored in MongoDB.
+    Classify the emotion from an audio file or in-memory audio.
     Args:
-        file_id (str): The ObjectId of the audio file in MongoDB.
+        filename: A file path, raw audio bytes, or a readable binary stream
+            such as a GridFS GridOut.
     Returns:
         str: The predicted emotion label.
+    Raises:
+        NoSpeechError: If the recording has no speech in it.
     """
+    return classify_speech(trim_speech(load_speech(filename)))
 
-    # Process the audio file using librosa
-    speech, _ = librosa.load(filename, sr=SAMPLE_RATE)
 
-    # Convert speech to tensor (matching the model input type)
-    input_values = torch.tensor(speech).unsqueeze(0)
+def load_speech(source):
+    """
+    Decode audio into a mono float32 waveform sampled at SAMPLE_RATE.
+    Args:
+        source: A file path, raw audio bytes, or a readable binary stream.
+    Returns:
+        np.ndarray: The decoded waveform.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        # Process the audio file using librosa
+        with stage("decode"):
+            speech, _ = librosa.load(source, sr=SAMPLE_RATE)
+        return speech
+    with stage("decode"):
+        return decode_audio(source, SAMPLE_RATE)
+
+
+def trim_speech(speech):
+    """
+    Drop the silence around and long pauses within a decoded waveform, so
+    the model only runs over speech.
+    Args:
+        speech (np.ndarray): 1-D float32 waveform sampled at SAMPLE_RATE.
+    Returns:
+        np.ndarray: The waveform to classify.
+    Raises:
+        NoSpeechError: If the recording has no speech in it.
+    """
+    if not VAD_ENABLED:
+        return speech
+    try:
+        with stage("vad"):
+            return trim_silence(speech, VAD_OPTIONS)
+    except NoSpeechError:
+        NO_SPEECH.inc()
+        raise
+
+
+def audio_report(decoded, inferred):
+    """
+    Count how much of a recording the model ran over.
+    Args:
+        decoded (np.ndarray): The waveform as decoded.
+        inferred (np.ndarray): The waveform the model was given.
+    Returns:
+        dict: The recording's length and the seconds classified.
+    """
+    seconds = len(decoded) / SAMPLE_RATE
+    inferred_seconds = len(inferred) / SAMPLE_RATE
+    AUDIO_SECONDS.labels("decoded").inc(seconds)
+    AUDIO_SECONDS.labels("inferred").inc(inferred_seconds)
+    return {"seconds": round(seconds, 3), "inferredSeconds": round(inferred_seconds, 3)}
+
+
+def classify_speech(speech):
+    """
+    Classify the emotion of a single decoded waveform.
+    Args:
+        speech (np.ndarray): 1-D float32 waveform sampled at SAMPLE_RATE.
+    Returns:
+        str: The predicted emotion label.
+    """
+    # Wrap the decoded buffer as a tensor without copying it
+    input_values = torch.from_numpy(speech).unsqueeze(0)
 
     # Pass the audio input to the model
-    with torch.no_grad():
-        logits = model(input_values).logits
+    logits = predict_logits(input_values)
 
     # Get the predicted emotion (highest logit score)
     predicted_class = torch.argmax(logits, dim=-1).item()
 
-    # Emotion labels based on the model's fine-tuning
-    emotion_labels = ["angry", "disgust", "fear", "happy", "neutral", "sad", "surprise"]
-    predicted_emotion = emotion_labels[predicted_class]
+    predicted_emotion = EMOTION_LABELS[predicted_class]
 
     return predicted_emotion
 
 
-def create_flask_app():
+def classify_emotions_batch(speeches):
+    """
+    Classify several decoded waveforms with a single forward pass.
+    Shorter clips are zero-padded and masked out, so each result matches
+    what classify_speech would return for that clip alone.
+    Args:
+        speeches (list): 1-D float32 waveforms sampled at SAMPLE_RATE.
+    Returns:
+        list: The predicted emotion label for each waveform, in order.
+    """
+    input_values, attention_mask = pad_batch(speeches)
+    logits = predict_logits(input_values, attention_mask=attention_mask)
+    return [EMOTION_LABELS[i] for i in torch.argmax(logits, dim=-1).tolist()]
+
+
+def embed_emotions_batch(speeches, model_id=None):
+    """
+    Like classify_emotions_batch, but also keep each clip's pooled encoder
+    embedding so it can be classified again later with only the head.
+    Args:
+        speeches (list): 1-D float32 waveforms sampled at SAMPLE_RATE.
+        model_id (str): The model to run, MODEL_ID if None.
+    Returns:
+        list: (emotion, embedding) for each waveform, in order.
+    """
+    input_values, attention_mask = pad_batch(speeches)
+    backend = models.get(model_id or MODEL_ID)
+    started = time.perf_counter()
+    with stage("inference"):
+        logits, embeddings = backend.embed(input_values, attention_mask=attention_mask)
+    observe_cost(input_values, attention_mask, time.perf_counter() - started)
+    labels = [EMOTION_LABELS[i] for i in torch.argmax(logits, dim=-1).tolist()]
+    return list(zip(labels, embeddings.numpy()))
+
+
+def classify_embeddings(embeddings):
+    """
+    Classify stored embeddings by running only the classifier head.
+    Args:
+        embeddings (np.ndarray): Pooled encoder embeddings, one per row.
+    Returns:
+        list: The predicted emotion label for each row.
+    """
+    logits = models.get(MODEL_ID).head(torch.from_numpy(np.asarray(embeddings)))
+    return [EMOTION_LABELS[i] for i in torch.argmax(logits, dim=-1).tolist()]
+
+
+def classify_speech_windowed(speech, aggregate="mean", model_id=None):
+    """
+    Classify a long waveform in overlapping fixed-length windows.
+    Args:
+        speech (np.ndarray): 1-D float32 waveform sampled at SAMPLE_RATE.
+        aggregate (str): "mean" averages window logits, "confidence" weights
+            each window by its top softmax probability.
+        model_id (str): The model to run, MODEL_ID if None.
+    Returns:
+        tuple: (emotion, timeline) with one timeline entry per window.
+    """
+    return classify_windowed(
+        speech,
+        functools.partial(predict_logits, model_id=model_id),
+        EMOTION_LABELS,
+        {
+            "sample_rate": SAMPLE_RATE,
+            "window_seconds": WINDOW_SECONDS,
+            "hop_seconds": WINDOW_HOP_SECONDS,
+            "batch_size": WINDOW_BATCH_SIZE,
+            "aggregate": aggregate,
+        },
+    )
+
+
+def predict_logits(input_values, attention_mask=None, model_id=None):
+    """
+    Run the configured inference backend.
+    Args:
+        input_values (torch.Tensor): Waveforms of shape (batch, samples).
+        attention_mask (torch.Tensor): Marks real samples when padded.
+        model_id (str): The model to run, MODEL_ID if None.
+    Returns:
+        torch.Tensor: Logits of shape (batch, len(EMOTION_LABELS)).
+    """
+    backend = models.get(model_id or MODEL_ID)
+    started = time.perf_counter()
+    with stage("inference"):
+        logits = backend(input_values, attention_mask=attention_mask)
+    observe_cost(input_values, attention_mask, time.perf_counter() - started)
+    return logits
+
+
+def observe_cost(input_values, attention_mask, seconds):
+    """
+    Teach the admission controller how long a forward pass took.
+    Args:
+        input_values (torch.Tensor): The waveforms that were classified.
+        attention_mask (torch.Tensor): Marks real samples when padded.
+        seconds (float): How long the pass took.
+    """
+    samples = (
+        input_values.numel() if attention_mask is None else int(attention_mask.sum())
+    )
+    admission.observe(samples / SAMPLE_RATE, seconds)
+
+
+def load_weights(_previous, source=None):
+    """
+    Load the model weights, preferring the copy baked into the image.
+    Safetensors files are memory-mapped, so the weights are paged in from
+    the page cache instead of being read and copied up front.
+    Args:
+        source (str): A local directory or Hugging Face name; None loads
+            MODEL_PATH, or MODEL_NAME if it is missing.
+    Returns:
+        Wav2Vec2ForSequenceClassification: The model in eval mode.
+    """
+    if source is None:
+        source = MODEL_PATH if os.path.isdir(MODEL_PATH) else MODEL_NAME
+    if os.path.isdir(source):
+        return Wav2Vec2ForSequenceClassification.from_pretrained(
+            source, use_safetensors=True
+        )
+    return Wav2Vec2ForSequenceClassification.from_pretrained(source)
+
+
+def build_backend(loaded_model, onnx_path=ONNX_MODEL_PATH):
+    """Wrap the loaded model in the configured inference backend."""
+    return load_backend(INFERENCE_BACKEND, loaded_model, onnx_path=onnx_path)
+
+
+def warm_up(loaded_backend):
+    """
+    Run one forward pass on a second of quiet noise, so the first real
+    request does not pay for kernel selection or graph compilation.
+    """
+    noise = np.random.default_rng(0).standard_normal(SAMPLE_RATE) * 0.01
+    loaded_backend(torch.from_numpy(noise.astype(np.float32)).unsqueeze(0))
+    return loaded_backend
+
+
+def extra_model_loader(model_id):
+    """
+    Make the loader of one of EXTRA_MODELS, which exports its own ONNX
+    graph next to ONNX_MODEL_PATH.
+    """
+    root, extension = os.path.splitext(ONNX_MODEL_PATH)
+    return ModelLoader(
+        [
+            ("weights", functools.partial(load_weights, source=EXTRA_MODELS[model_id])),
+            (
+                "backend",
+                functools.partial(
+                    build_backend, onnx_path=f"{root}-{model_id}{extension}"
+                ),
+            ),
+            ("warmup", warm_up),
+        ]
+    )
+
+
+model_loader = ModelLoader(
+    [("weights", load_weights), ("backend", build_backend), ("warmup", warm_up)]
+)
+
+models = ModelRegistry(
+    extra_model_loader,
+    [MODEL_ID, *EXTRA_MODELS],
+    budget_bytes=int(MODEL_MEMORY_BUDGET_MB * 1024 * 1024),
+    pinned=(MODEL_ID,),
+    measure=backend_bytes,
+    loaders={MODEL_ID: model_loader},
+)
+
+
+admission = AdmissionController(
+    max_pending=ADMISSION_MAX_PENDING,
+    max_wait=ADMISSION_MAX_WAIT_SECONDS,
+    cost=ADMISSION_INITIAL_COST,
+)
+
+scheduler = MicroBatchScheduler(
+    embed_emotions_batch,
+    max_batch_size=BATCH_MAX_SIZE,
+    max_wait_ms=BATCH_MAX_WAIT_MS,
+    observe_wait=lambda seconds: observe("queue_wait", seconds),
+)
+
+# The result cache, embedding store and scheduler of each of EXTRA_MODELS,
+# made on first use; see served_model
+extra_served = {}
+extra_served_lock = threading.Lock()
+
+
+def served_model(model_id=None):
+    """
+    The pieces that serve one model's requests. Each model has its own
+    micro-batches, and its results and embeddings are kept apart.
+    Args:
+        model_id (str): MODEL_ID, one of EXTRA_MODELS, or None for MODEL_ID.
+    Returns:
+        dict: The model's id and version, and its result_cache,
+            embedding_store and scheduler. MODEL_ID uses the module's own.
+    Raises:
+        UnknownModel: If no such model is served.
+    """
+    if model_id is None or model_id == MODEL_ID:
+        return {
+            "id": MODEL_ID,
+            "version": MODEL_VERSION,
+            "result_cache": result_cache,
+            "embedding_store": embedding_store,
+            "scheduler": scheduler,
+        }
+    if model_id not in EXTRA_MODELS:
+        raise UnknownModel(f"Unknown model {model_id!r}")
+    with extra_served_lock:
+        if model_id not in extra_served:
+            source = EXTRA_MODELS[model_id]
+            version = model_version(source)
+            extra_served[model_id] = {
+                "id": model_id,
+                "version": version,
+                "result_cache": ResultCache(
+                    db["inference_cache"], version, max_entries=RESULT_CACHE_SIZE
+                ),
+                "embedding_store": EmbeddingStore(db["embeddings"], source),
+                "scheduler": MicroBatchScheduler(
+                    functools.partial(embed_emotions_batch, model_id=model_id),
+                    max_batch_size=BATCH_MAX_SIZE,
+                    max_wait_ms=BATCH_MAX_WAIT_MS,
+                    observe_wait=lambda seconds: observe("queue_wait", seconds),
+                ),
+            }
+        return extra_served[model_id]
+
+
+def stream_window_logits(speeches):
+    """
+    Classify windows of streamed recordings in one forward pass.
+    Args:
+        speeches (list): 1-D float32 waveforms sampled at SAMPLE_RATE.
+    Returns:
+        list: The logits of each waveform, in order.
+    """
+    input_values, attention_mask = pad_batch(speeches)
+    return list(predict_logits(input_values, attention_mask=attention_mask))
+
+
+# Windows of streamed recordings are batched apart from whole recordings,
+# as they are classified without keeping an embedding
+stream_scheduler = MicroBatchScheduler(
+    stream_window_logits,
+    max_batch_size=BATCH_MAX_SIZE,
+    max_wait_ms=BATCH_MAX_WAIT_MS,
+    observe_wait=lambda seconds: observe("queue_wait", seconds),
+)
+
+
+def classify_stream_windows(windows, deadline=None):
+    """
+    Classify the windows a stream session has completed, through admission
+    control and the micro-batcher like any other recording.
+    Args:
+        windows (list): 1-D float32 waveforms sampled at SAMPLE_RATE.
+        deadline (float): A time.monotonic() deadline, see request_deadline.
+    Returns:
+        torch.Tensor: Logits of shape (len(windows), len(EMOTION_LABELS)).
+    Raises:
+        Overloaded: If admission control sheds the windows.
+        DeadlineExceeded: If the deadline passed before their batch ran.
+    """
+    seconds = sum(len(window) for window in windows) / SAMPLE_RATE
+    with admission.admit(seconds, deadline), QUEUE_DEPTH.track_inprogress():
+        futures = [
+            stream_scheduler.submit(window, deadline=deadline) for window in windows
+        ]
+        return torch.stack([future.result() for future in futures])
+
+
+stream_sessions = StreamRegistry(
+    {
+        "decoder": functools.partial(StreamDecoder, SAMPLE_RATE),
+        "classify_windows": classify_stream_windows,
+        "labels": EMOTION_LABELS,
+        "sample_rate": SAMPLE_RATE,
+        "window_seconds": STREAM_WINDOW_SECONDS,
+        "min_tail_seconds": STREAM_MIN_TAIL_SECONDS,
+    },
+    idle_seconds=STREAM_IDLE_SECONDS,
+)
+
+
+def classify_stored_file(  # pylint: disable=too-many-arguments
+    file_id, mode=None, aggregate="mean", deadline=None, *, model_id=None
+):
+    """
+    Classify a recording stored in GridFS and save the emotion on it,
+    stamped with the model that produced it. With RESULT_WRITE_BEHIND the
+    emotion is queued on result_writes and saved after this returns.
+    Args:
+        file_id (ObjectId): The fs.files id of the recording.
+        mode (str): "windowed" forces sliding-window inference; otherwise it
+            is only used for recordings longer than WINDOWED_MIN_SECONDS.
+        aggregate (str): How window logits are combined, see AGGREGATIONS.
+        deadline (float): See classify_recording.
+        model_id (str): See classify_recording.
+    Returns:
+        dict: The emotion, whether it came from the cache, the model id
+            and, for windowed inference, the per-window timeline.
+    Raises:
+        UnknownModel: If no such model is served.
+        NoFile: If no recording has that id, or its audio was deleted.
+        NoSpeechError: If the recording has no speech in it.
+        Overloaded: If the recording could not be classified in time.
+        DeadlineExceeded: If the deadline passed while it was queued.
+    """
+    served = served_model(model_id)
+    with stage("gridfs_get"):
+        file = fs.get(file_id)
+    if isinstance(getattr(file, "audioDeletedAt", None), datetime.datetime):
+        # storage.py prune keeps the result but not the audio
+        raise NoFile(f"The audio of {file_id} was deleted")
+    # The web app stores a digest of the upload; decode straight from the
+    # GridFS stream
+    response = classify_recording(
+        file,
+        getattr(file, "sha256", None),
+        mode,
+        aggregate,
+        deadline,
+        model_id=model_id,
+        file_id=file_id,
+    )
+    result = {
+        "_id": file_id,
+        "emotion": response["emotion"],
+        "modelId": served["id"],
+        "modelVersion": served["version"],
+    }
+    with stage("result_store"):
+        if RESULT_WRITE_BEHIND:
+            result_writes.put(result)
+        else:
+            write_results([result])
+    return response
+
+
+def write_results(results):
+    """
+    Stamp a batch of emotions on fs.files with one bulk_write, and move the
+    recordings between emotions in the hourly rollups.
+    Args:
+        results (list): Dicts of an fs.files _id and the emotion, modelId
+            and modelVersion to set on it, oldest first.
+    """
+    # A recording classified twice in one batch keeps its last result
+    latest = {result["_id"]: result for result in results}
+    if not latest:
+        return
+    # The documents as they were, so a reclassified recording moves between
+    # counts instead of being counted twice. Unlike find_one_and_update this
+    # is two round trips, so two processes writing the same recording at
+    # the same moment can both move it out of its old count.
+    before = {
+        document["_id"]: document
+        for document in db.fs.files.find(
+            {"_id": {"$in": list(latest)}}, {"emotion": 1, "uploadDate": 1}
+        )
+    }
+    result_files.bulk_write(
+        [
+            UpdateOne(
+                {"_id": file_id},
+                {"$set": {k: v for k, v in result.items() if k != "_id"}},
+            )
+            for file_id, result in latest.items()
+        ],
+        ordered=False,
+    )
+    with stage("rollups"):
+        record_emotions(
+            emotion_rollups,
+            [
+                (
+                    before[file_id]["uploadDate"],
+                    before[file_id].get("emotion"),
+                    result["emotion"],
+                )
+                for file_id, result in latest.items()
+                if file_id in before
+            ],
+        )
+
+
+result_writes = WriteBuffer(
+    write_results,
+    max_batch_size=RESULT_WRITE_BATCH_SIZE,
+    max_wait_ms=RESULT_WRITE_MAX_WAIT_MS,
+    max_pending=RESULT_WRITE_MAX_PENDING,
+)
+# Under gunicorn, each worker exits through sys.exit and so writes its own
+atexit.register(result_writes.close)
+
+
+def classify_recording(  # pylint: disable=too-many-arguments
+    source,
+    digest,
+    mode=None,
+    aggregate="mean",
+    deadline=None,
+    *,
+    model_id=None,
+    file_id=None,
+):
+    """
+    Classify a recording, reusing the cached result for identical audio.
+    Args:
+        source: Raw audio bytes or a readable binary stream.
+        digest (str): The SHA-256 of the audio, or None to skip the cache.
+        mode (str): "windowed" forces sliding-window inference; otherwise it
+            is only used for recordings longer than WINDOWED_MIN_SECONDS.
+            "fast" lets MODEL_ID answer from an early layer, see early_exit;
+            without probes for it, or for other models, the model runs whole.
+        aggregate (str): How window logits are combined, see AGGREGATIONS.
+        deadline (float): time.monotonic() by which the caller needs the
+            result, or None to wait as long as it takes.
+        model_id (str): MODEL_ID or one of EXTRA_MODELS, None for MODEL_ID.
+        file_id (ObjectId): The fs.files id of the recording, if it is
+            stored; MODEL_ID's embedding of it is then added to
+            similarity_index.
+    Returns:
+        dict: The emotion, whether it came from the cache, the id of the
+            model, how many seconds were classified and, for windowed
+            inference, the per-window timeline, or in fast mode the
+            exitLayer that answered.
+    Raises:
+        UnknownModel: If no such model is served.
+        NoSpeechError: If the recording has no speech in it.
+        Overloaded: If the recording could not be classified in time.
+        DeadlineExceeded: If the deadline passed while it was queued.
+    """
+    served = served_model(model_id)
+    # Repeated recordings skip both decoding and the model. Only single-pass
+    # results are cached: a windowed answer also has a timeline, and depends
+    # on the aggregate asked for
+    if digest and mode != "windowed":
+        with stage("cache_lookup"):
+            emotion = served["result_cache"].get(digest)
+    else:
+        emotion = None
+    response = {"cached": emotion is not None, "modelId": served["id"]}
+    if not response["cached"]:
+        speech = load_speech(source)
+        trimmed = trim_speech(speech)
+        windowed = (
+            mode == "windowed" or len(trimmed) > WINDOWED_MIN_SECONDS * SAMPLE_RATE
+        )
+        # Window times are given in the recording as it was made
+        inferred = speech if windowed else trimmed
+        embedding = None
+        with admission.admit(len(inferred) / SAMPLE_RATE, deadline):
+            if windowed:
+                emotion, response["timeline"] = classify_speech_windowed(
+                    speech, aggregate, served["id"]
+                )
+            elif (
+                mode == "fast"
+                and served["id"] == MODEL_ID
+                and early_exit.usable(models.get(MODEL_ID))
+            ):
+                emotion, response["exitLayer"] = early_exit.classify(
+                    models.get(MODEL_ID), trimmed, EMOTION_LABELS
+                )
+            elif request_profiler.active():
+                # In this thread, which the profilers are watching, rather
+                # than the scheduler's
+                emotion, embedding = embed_emotions_batch([trimmed], served["id"])[0]
+            else:
+                with QUEUE_DEPTH.track_inprogress():
+                    emotion, embedding = served["scheduler"].classify(
+                        trimmed, deadline=deadline
+                    )
+        response["audio"] = audio_report(speech, inferred)
+        if digest and embedding is not None:
+            with stage("embedding_store"):
+                served["embedding_store"].put(digest, embedding)
+        if file_id is not None and embedding is not None and served["id"] == MODEL_ID:
+            with stage("similarity_index"):
+                similarity_index.add(file_id, embedding, emotion)
+        # A fast answer may differ from the model's, so it is not cached
+        if digest and not windowed and "exitLayer" not in response:
+            with stage("cache_store"):
+                served["result_cache"].put(digest, emotion)
+    response["emotion"] = emotion
+    return response
+
+
+def stored_embedding(file_id):
+    """
+    MODEL_ID's embedding of a stored recording from similarity_index or,
+    failing that, embedding_store, or None if neither has it.
+    Args:
+        file_id (ObjectId): The fs.files id of the recording.
+    Raises:
+        NoFile: If no recording has that id.
+    """
+    embedding = similarity_index.get(file_id)
+    if embedding is not None:
+        return embedding
+    document = db.fs.files.find_one({"_id": file_id}, {"sha256": 1})
+    if document is None:
+        raise NoFile(f"No recording has id {file_id}")
+    if not document.get("sha256"):
+        return None
+    return embedding_store.get_many([document["sha256"]]).get(document["sha256"])
+
+
+def knn_emotion(file_id):
+    """
+    Classify a stored recording by the vote of its KNN_NEIGHBOURS nearest
+    indexed recordings, without its audio, the encoder or the head.
+    Returns:
+        dict: The emotion, with source "knn", its share of the vote and the
+            neighbours' count; None if the recording has no stored
+            embedding or no neighbour has an emotion.
+    Raises:
+        NoFile: If no recording has that id.
+    """
+    embedding = stored_embedding(file_id)
+    if embedding is None:
+        return None
+    similar = similarity_index.similar(embedding, KNN_NEIGHBOURS, exclude=[file_id])
+    result = {**similar["vote"], "source": "knn", "modelId": MODEL_ID}
+    result["neighbours"] = len(similar["neighbours"])
+    return result if result["emotion"] else None
+
+
+def classify_or_vote(  # pylint: disable=too-many-arguments
+    file_id, mode=None, aggregate="mean", deadline=None, *, model_id=None
+):
+    """
+    classify_stored_file, or knn_emotion instead when mode is "knn", or
+    when the recording is shed and KNN_FALLBACK is on. Only MODEL_ID's
+    embeddings are indexed, so other models always run. A vote is not
+    saved on the recording, since no model produced it.
+    Args:
+        mode (str): "knn", or a mode for classify_stored_file.
+        See classify_stored_file for the rest, and what is raised.
+    """
+    knn = model_id in (None, MODEL_ID)
+    if knn and mode == "knn":
+        result = knn_emotion(file_id)
+        if result is not None:
+            return result
+    try:
+        return classify_stored_file(
+            file_id,
+            None if mode == "knn" else mode,
+            aggregate,
+            deadline,
+            model_id=model_id,
+        )
+    except Overloaded:
+        result = knn_emotion(file_id) if knn and KNN_FALLBACK else None
+        if result is None:
+            raise
+        print(f"Answered shed recording {file_id} by kNN vote")
+        return result
+
+
+def request_deadline(headers):
+    """
+    The deadline for a request, from the seconds its client will wait.
+    Args:
+        headers: The request headers, where DEADLINE_HEADER is optional.
+    Returns:
+        float: A time.monotonic() deadline, ADMISSION_MAX_WAIT_SECONDS
+            away without the header.
+    Raises:
+        ValueError: If the header is not a positive number of seconds.
+    """
+    value = headers.get(DEADLINE_HEADER)
+    if value is None:
+        return admission.deadline()
+    timeout = float(value)
+    if math.isnan(timeout) or timeout <= 0:
+        raise ValueError(f"{DEADLINE_HEADER} must be positive")
+    return admission.deadline(timeout)
+
+
+def request_model(headers):
+    """
+    The model a request asked for.
+    Args:
+        headers: The request headers, where MODEL_HEADER is optional.
+    Returns:
+        str: The model id in MODEL_HEADER, or MODEL_ID.
+    Raises:
+        UnknownModel: If no such model is served.
+    """
+    model_id = headers.get(MODEL_HEADER, MODEL_ID)
+    if model_id not in models.model_ids:
+        raise UnknownModel(f"Unknown model {model_id!r}")
+    return model_id
+
+
+def create_flask_app():  # pylint: disable=too-many-statements
     """
     Create and configure the Flask application.
     This function sets up the Flask app and defines the routes for the web application.
@@ -70,14 +909,61 @@ def create_flask_app():
     Routes:
         /detect-emotion, received an ObjectId from webapp and adds the emotion to the
         corresponding document, then sends the emotion back to webapp
+        /classify, classifies audio posted in the request body, so the webapp
+        can store the recording after answering instead of before
+        /similar, finds the stored recordings whose embeddings are closest
+        to a stored recording's, with their emotions and the emotion they
+        vote for
+        /cache-stats, reports hit and miss counts for the result cache
+        /metrics, per-stage latency histograms, request counts and gauges in
+        the Prometheus text format
+        /healthz, reports that the process is up
+        /readyz, reports whether the model is loaded and warmed up, and the
+        memory, loads and evictions of every served model
+        /stream/<id>/chunk, classifies a recording slice by slice as it arrives
+        /stream/<id>/finish, classifies the rest, stores the recording and
+        returns the final emotion
+    /classify and /detect-emotion honour the seconds the client will wait,
+    sent in DEADLINE_HEADER. A recording that could not be classified in
+    time gets a 429, a full admission queue a 503, both with Retry-After,
+    and one whose deadline passes in the queue a 503 before reaching the
+    model.
+    Both pick the model by id in MODEL_HEADER, MODEL_ID when it is absent,
+    and an unknown id gets a 400. Responses carry the id as modelId.
+    Silence and long pauses are trimmed before inference, and a recording
+    with no speech gets a 422 without reaching the model.
+    Recordings longer than WINDOWED_MIN_SECONDS, or requests sent with
+    "mode": "windowed", are classified window by window and the response
+    also carries the per-window timeline.
+    /detect-emotion with "mode": "knn", or shed while KNN_FALLBACK is on,
+    answers with the vote of the recording's nearest neighbours when its
+    embedding is stored.
+    Requests sending PROFILE_TOKEN in request_profiler.PROFILE_HEADER, and a
+    PROFILE_SAMPLE_RATE share of the rest, are profiled into PROFILE_DIR and
+    answered with the profile's name in request_profiler.PROFILE_ID_HEADER.
     """
     flask_app = Flask(__name__)
     flask_app.secret_key = "KEY"
+    instrument(flask_app)
+    request_profiler.install(
+        flask_app,
+        {
+            "directory": PROFILE_DIR,
+            "token": PROFILE_TOKEN,
+            "sample_rate": PROFILE_SAMPLE_RATE,
+            "keep": PROFILE_KEEP,
+        },
+    )
 
     try:
         client.admin.command("ping")
         client.admin.command("ping")
         print("Pinged your deployment. You successfully connected to MongoDB!")
+        result_cache.ensure_indexes()
+        removed = result_cache.invalidate_stale(
+            keep=[model_version(source) for source in EXTRA_MODELS.values()]
+        )
+        print(f"Removed {removed} cached results from other models")
     except ConnectionFailure:
         print("Failed to connect to MongoDB. Please check your connection.")
     except OperationFailure:
@@ -100,26 +986,196 @@ def create_flask_app():
         except errors.InvalidId:
             return jsonify({"error": "Invalid fileId"}), 400
 
+        aggregate = web_request.get("aggregate", "mean")
+        if aggregate not in AGGREGATIONS:
+            return jsonify({"error": "Invalid aggregate"}), 400
+
+        try:
+            deadline = request_deadline(request.headers)
+        except ValueError:
+            return jsonify({"error": f"Invalid {DEADLINE_HEADER}"}), 400
+
+        model_id = request_model(request.headers)
+        try:
+            response = classify_or_vote(
+                file_id_obj,
+                web_request.get("mode"),
+                aggregate,
+                deadline,
+                model_id=model_id,
+            )
+        except NoFile:
+            return jsonify({"error": "Invalid fileId"}), 400
+        print("Sending the emotion:", response["emotion"])
+        return jsonify(response), 200
+
+    @flask_app.route("/similar", methods=["POST"])
+    def similar():
+        web_request = request.get_json()
         try:
-            file = fs.get(file_id_obj)
+            file_id_obj = ObjectId(web_request.get("fileId"))
+        except (errors.InvalidId, TypeError):
+            return jsonify({"error": "Invalid fileId"}), 400
+        k = web_request.get("k", KNN_NEIGHBOURS)
+        # bool is an int subclass, but true is not a number of neighbours
+        if isinstance(k, bool) or not isinstance(k, int) or not 1 <= k <= SIMILAR_MAX_K:
+            return jsonify({"error": f"k must be from 1 to {SIMILAR_MAX_K}"}), 400
+        try:
+            embedding = stored_embedding(file_id_obj)
         except NoFile:
             return jsonify({"error": "Invalid fileId"}), 400
-        # Create a temporary file to save the audio
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as temp_file:
-            temp_file.write(file.read())
-            temp_file_path = temp_file.name
-        emotion = classify_emotion_from_audio(temp_file_path)
-        os.remove(temp_file_path)
-        db.fs.files.update_one(
-            {"_id": ObjectId(file_id)}, {"$set": {"emotion": emotion}}
+        if embedding is None:
+            return jsonify({"error": "No embedding is stored for fileId"}), 404
+        response = similarity_index.similar(embedding, k, exclude=[file_id_obj])
+        return jsonify({"fileId": str(file_id_obj), **response}), 200
+
+    @flask_app.route("/classify", methods=["POST"])
+    def classify_upload():
+        data = request.get_data()
+        if not data:
+            return jsonify({"error": "Audio is required"}), 400
+
+        aggregate = request.args.get("aggregate", "mean")
+        if aggregate not in AGGREGATIONS:
+            return jsonify({"error": "Invalid aggregate"}), 400
+
+        try:
+            deadline = request_deadline(request.headers)
+        except ValueError:
+            return jsonify({"error": f"Invalid {DEADLINE_HEADER}"}), 400
+
+        model_id = request_model(request.headers)
+        response = classify_recording(
+            data,
+            hashlib.sha256(data).hexdigest(),
+            request.args.get("mode"),
+            aggregate,
+            deadline,
+            model_id=model_id,
+        )
+        response["modelVersion"] = served_model(model_id)["version"]
+        print("Sending the emotion:", response["emotion"])
+        return jsonify(response), 200
+
+    @flask_app.errorhandler(NoSpeechError)
+    def no_speech(exc):
+        return jsonify({"error": str(exc)}), 422
+
+    @flask_app.errorhandler(UnknownModel)
+    def unknown_model(exc):
+        return jsonify({"error": str(exc)}), 400
+
+    @flask_app.errorhandler(Overloaded)
+    def overloaded(exc):
+        SHED.labels("queue_full" if exc.status == 503 else "deadline").inc()
+        response = jsonify({"error": str(exc)})
+        response.headers["Retry-After"] = str(exc.retry_after)
+        return response, exc.status
+
+    @flask_app.errorhandler(DeadlineExceeded)
+    def deadline_exceeded(exc):
+        SHED.labels("expired").inc()
+        return jsonify({"error": str(exc)}), 503
+
+    @flask_app.route("/stream/<session_id>/chunk", methods=["POST"])
+    def stream_chunk(session_id):
+        if not SESSION_ID_PATTERN.fullmatch(session_id):
+            return jsonify({"error": "Invalid stream id"}), 400
+        try:
+            deadline = request_deadline(request.headers)
+        except ValueError:
+            return jsonify({"error": f"Invalid {DEADLINE_HEADER}"}), 400
+        chunk = request.get_data()
+        session = stream_sessions.get(session_id)
+        with session.lock:
+            if len(session.data) + len(chunk) > STREAM_MAX_BYTES:
+                return jsonify({"error": "Recording too large"}), 413
+            partial = session.append(chunk, deadline)
+        return jsonify(partial), 200
+
+    @flask_app.route("/stream/<session_id>/finish", methods=["POST"])
+    def stream_finish(session_id):
+        try:
+            deadline = request_deadline(request.headers)
+        except ValueError:
+            return jsonify({"error": f"Invalid {DEADLINE_HEADER}"}), 400
+        session = stream_sessions.get(session_id, create=False)
+        if session is None or not session.data:
+            return jsonify({"error": "Unknown stream"}), 404
+        # A finish that is shed keeps the session, so it can be retried
+        with session.lock:
+            try:
+                emotion = session.finish(deadline)
+            except StreamDecodeError as exc:
+                stream_sessions.pop(session_id)
+                return jsonify({"error": str(exc)}), 422
+            finished = stream_sessions.pop(session_id) is session
+        if not finished:
+            # Another request finished it first
+            return jsonify({"error": "Unknown stream"}), 404
+        if emotion is None:
+            return jsonify({"error": "The recording has no audio"}), 422
+        data = bytes(session.data)
+        digest = hashlib.sha256(data).hexdigest()
+        file_id = fs.put(
+            data,
+            filename=f"recordings/{digest}.webm",
+            sha256=digest,
+            emotion=emotion,
+            modelId=MODEL_ID,
+            modelVersion=MODEL_VERSION,
         )
-        print("Sending the emotion:", emotion)
-        return jsonify({"emotion": emotion}), 200
+        record_emotions(
+            emotion_rollups,
+            [(datetime.datetime.now(datetime.timezone.utc), None, emotion)],
+        )
+        # Not cached: the windows were classified without trimming silence,
+        # so the result is not what /classify would give for these bytes
+        print("Sending the streamed emotion:", emotion)
+        return (
+            jsonify(
+                {
+                    "emotion": emotion,
+                    "fileId": str(file_id),
+                    "timeline": session.timeline,
+                }
+            ),
+            200,
+        )
+
+    @flask_app.route("/healthz", methods=["GET"])
+    def healthz():
+        return jsonify({"status": "ok"}), 200
+
+    @flask_app.route("/readyz", methods=["GET"])
+    def readyz():
+        body = {
+            "status": model_loader.status,
+            "timings": model_loader.timings,
+            "admission": admission.stats(),
+            "models": models.stats(),
+        }
+        if model_loader.error:
+            body["error"] = model_loader.error
+        return jsonify(body), 200 if model_loader.ready() else 503
+
+    @flask_app.route("/cache-stats", methods=["GET"])
+    def cache_stats():
+        return jsonify(result_cache.stats()), 200
+
+    @flask_app.route("/metrics", methods=["GET"])
+    def metrics():
+        return metrics_response()
 
     return flask_app
 
 
 if __name__ == "__main__":
+    # Exit through atexit on docker stop, so waiting results are written
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
     app = create_flask_app()
+    # Bind the port right away and report readiness through /readyz
+    model_loader.start_background()
     FLASK_PORT = 4000
-    app.run(host="0.0.0.0", port=FLASK_PORT, debug=True)
+    # The reloader would import this module, and load the model, twice
+    app.run(host="0.0.0.0", port=FLASK_PORT, debug=True, use_reloader=False)
@@ -0,0 +1,95 @@
+"""
+Gunicorn settings for serving the ML client from several processes.
+
+The master process loads the model once, before any worker exists, and the
+workers are forked from it. The weights are never written after loading, so
+every worker reads the same physical pages instead of holding its own copy.
+Each worker then gets its own share of the cores for PyTorch's intra-op
+threads, so the processes do not fight over them.
+
+With PROMETHEUS_MULTIPROC_DIR set, every worker writes its metrics to
+that directory and /metrics merges them, whichever worker answers.
+
+Usage:
+    gunicorn -c gunicorn.conf.py
+"""
+
+# Gunicorn only reads its settings under these lowercase names
+# pylint: disable=invalid-name
+
+import gc
+import glob
+import os
+
+import torch
+from prometheus_client import multiprocess
+
+# Forking after these backends have started their own threads or compiler
+# processes is unsafe, so they only share the weights and each worker
+# builds its own backend
+FORK_SAFE_BACKENDS = ("eager", "int8")
+
+CPU_COUNT = os.cpu_count() or 1
+SERVE_WORKERS = int(os.getenv("SERVE_WORKERS", str(CPU_COUNT)))
+TORCH_THREADS_PER_WORKER = int(
+    os.getenv("TORCH_THREADS_PER_WORKER", str(max(1, CPU_COUNT // SERVE_WORKERS)))
+)
+
+bind = os.getenv("SERVE_BIND", "0.0.0.0:4000")
+wsgi_app = "emotion_detector:create_flask_app()"
+workers = SERVE_WORKERS
+# Request threads let the micro-batcher group concurrent requests per worker
+worker_class = "gthread"
+threads = int(os.getenv("SERVE_THREADS", "4"))
+timeout = 120
+
+
+def on_starting(_server):
+    """Stop the collector leaving holes in pages the workers will share."""
+    gc.disable()
+    # Metrics left by an earlier run would be merged into this one's
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        for path in glob.glob(
+            os.path.join(os.environ["PROMETHEUS_MULTIPROC_DIR"], "*.db")
+        ):
+            os.remove(path)
+
+
+def when_ready(_server):
+    """Load the model in the master, just before the workers are forked."""
+    # A single thread keeps OpenMP from starting a pool the children
+    # would inherit in a broken state
+    torch.set_num_threads(1)
+    # pylint: disable=import-outside-toplevel
+    from backends import export_onnx
+    from emotion_detector import INFERENCE_BACKEND, ONNX_MODEL_PATH, model_loader
+
+    if INFERENCE_BACKEND in FORK_SAFE_BACKENDS:
+        model_loader.get()
+    else:
+        model = model_loader.preload("weights")
+        # Export once here rather than in every worker at the same time
+        if INFERENCE_BACKEND == "onnx" and not os.path.exists(ONNX_MODEL_PATH):
+            export_onnx(model, ONNX_MODEL_PATH)
+    # Keep the collector from touching the parent's objects in the workers
+    gc.freeze()
+    print(
+        f"Serving with {SERVE_WORKERS} workers, "
+        f"{TORCH_THREADS_PER_WORKER} torch threads each"
+    )
+
+
+def post_fork(_server, _worker):
+    """Give this worker its share of the cores and finish loading the model."""
+    gc.enable()
+    torch.set_num_threads(TORCH_THREADS_PER_WORKER)
+    # pylint: disable-next=import-outside-toplevel
+    from emotion_detector import model_loader
+
+    model_loader.get()
+
+
+def child_exit(_server, worker):
+    """Drop a dead worker's live gauges, such as its in-flight requests."""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,126 @@
+"""Module for the Mongo-backed queue of emotion detection jobs"""
+
+import datetime
+
+from pymongo import ReturnDocument
+
+
+def utcnow():
+    """The current time as a timezone-aware UTC datetime."""
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def ensure_indexes(jobs):
+    """Create the indexes that claim_job and expire_jobs filter and sort on."""
+    jobs.create_index([("status", 1), ("createdAt", 1)])
+    jobs.create_index([("status", 1), ("leaseUntil", 1)])
+
+
+def claim_job(jobs, worker_id, lease_seconds, max_attempts):
+    """
+    Atomically take the oldest job that is queued, or whose previous worker
+    let its lease run out, and lease it to this worker.
+    Args:
+        jobs: The jobs collection.
+        worker_id (str): Identifies the worker holding the lease.
+        lease_seconds (float): How long the job is reserved for this worker.
+        max_attempts (int): Jobs already tried this many times are skipped.
+    Returns:
+        dict: The claimed job document, or None if there is nothing to do.
+    """
+    now = utcnow()
+    return jobs.find_one_and_update(
+        {
+            "$or": [
+                {"status": "queued"},
+                {"status": "running", "leaseUntil": {"$lt": now}},
+            ],
+            "attempts": {"$lt": max_attempts},
+        },
+        {
+            "$set": {
+                "status": "running",
+                "worker": worker_id,
+                "leaseUntil": now + datetime.timedelta(seconds=lease_seconds),
+                "updatedAt": now,
+            },
+            "$inc": {"attempts": 1},
+        },
+        sort=[("createdAt", 1)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+def renew_lease(jobs, job, lease_seconds):
+    """
+    Extend the lease of a job that is still being worked on.
+    Args:
+        jobs: The jobs collection.
+        job (dict): The document returned by claim_job.
+        lease_seconds (float): How long from now the job stays reserved.
+    Returns:
+        bool: Whether this worker still held the lease.
+    """
+    now = utcnow()
+    update = jobs.update_one(
+        {"_id": job["_id"], "worker": job["worker"], "status": "running"},
+        {
+            "$set": {
+                "leaseUntil": now + datetime.timedelta(seconds=lease_seconds),
+                "updatedAt": now,
+            }
+        },
+    )
+    return update.modified_count == 1
+
+
+def complete_job(jobs, job, result):
+    """
+    Record a job's result, unless another worker has since taken it over.
+    Args:
+        jobs: The jobs collection.
+        job (dict): The document returned by claim_job.
+        result (dict): Fields to store on the job, including the emotion.
+    Returns:
+        bool: Whether this worker still held the lease.
+    """
+    update = jobs.update_one(
+        {"_id": job["_id"], "worker": job["worker"], "status": "running"},
+        {"$set": dict(result, status="done", updatedAt=utcnow())},
+    )
+    return update.modified_count == 1
+
+
+def fail_job(jobs, job, error, max_attempts):
+    """
+    Put a failed job back in the queue, or mark it failed once it has used
+    up its attempts.
+    Args:
+        jobs: The jobs collection.
+        job (dict): The document returned by claim_job.
+        error (str): What went wrong, kept on the job for the web app.
+        max_attempts (int): Attempts allowed before giving up.
+    """
+    status = "failed" if job["attempts"] >= max_attempts else "queued"
+    jobs.update_one(
+        {"_id": job["_id"], "worker": job["worker"]},
+        {"$set": {"status": status, "error": error, "updatedAt": utcnow()}},
+    )
+
+
+def expire_jobs(jobs, max_attempts):
+    """
+    Fail running jobs whose lease ran out on their last allowed attempt,
+    since claim_job will never pick them up again.
+    Returns:
+        int: The number of jobs marked failed.
+    """
+    result = jobs.update_many(
+        {
+            "status": "running",
+            "leaseUntil": {"$lt": utcnow()},
+            "attempts": {"$gte": max_attempts},
+        },
+        {"$set": {"status": "failed", "error": "Lease expired"}},
+    )
+    return result.modified_count
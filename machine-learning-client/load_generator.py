@@ -0,0 +1,42 @@
+"""Module for sending a workload from concurrent callers and timing it"""
+
+import threading
+import time
+
+import numpy as np
+
+
+def percentile(latencies, pct):
+    """Return the given percentile of a list of latencies, in milliseconds."""
+    return float(np.percentile(np.asarray(latencies) * 1000.0, pct))
+
+
+def run_load(classify, clips, concurrency):
+    """
+    Send every clip through classify from a pool of concurrent callers.
+    Returns:
+        tuple: (wall-clock seconds, list of per-request latencies in seconds).
+    """
+    latencies = []
+    lock = threading.Lock()
+    cursor = iter(range(len(clips)))
+
+    def caller():
+        while True:
+            with lock:
+                index = next(cursor, None)
+            if index is None:
+                return
+            started = time.perf_counter()
+            classify(clips[index])
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+
+    threads = [threading.Thread(target=caller) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - started, latencies
@@ -0,0 +1,202 @@
+"""Module for the Prometheus metrics the ML client serves at /metrics"""
+
+import os
+import time
+
+from flask import Response, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+# From 1 ms, a cache hit, to 60 s, a long recording classified in windows
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+# gridfs_get only fetches the fs.files document; the chunks are read while
+# decoding. temp_file is part of decode, for formats libsndfile cannot read.
+# vad trims silence before the waveform is queued for inference.
+# similarity_index appends a stored recording's embedding; similarity_search
+# scores the whole index for /similar and kNN votes.
+STAGES = (
+    "gridfs_get",
+    "cache_lookup",
+    "decode",
+    "temp_file",
+    "vad",
+    "queue_wait",
+    "inference",
+    "embedding_store",
+    "similarity_index",
+    "similarity_search",
+    "cache_store",
+    "result_store",
+    "rollups",
+)
+
+STAGE_SECONDS = Histogram(
+    "ml_stage_seconds",
+    "Time spent in each stage of classifying a recording",
+    ["stage"],
+    buckets=LATENCY_BUCKETS,
+)
+REQUEST_SECONDS = Histogram(
+    "ml_request_seconds",
+    "Time to answer a request, by route",
+    ["route"],
+    buckets=LATENCY_BUCKETS,
+)
+REQUESTS = Counter(
+    "ml_requests_total", "Requests answered, by route and outcome", ["route", "outcome"]
+)
+IN_FLIGHT = Gauge(
+    "ml_requests_in_flight", "Requests being handled", multiprocess_mode="livesum"
+)
+QUEUE_DEPTH = Gauge(
+    "ml_inference_queue_depth",
+    "Recordings waiting for or in a micro-batch",
+    multiprocess_mode="livesum",
+)
+# 1 - inferred / decoded is the share of audio the model was spared
+AUDIO_SECONDS = Counter(
+    "ml_audio_seconds_total",
+    "Seconds of audio decoded, and of those sent to the model",
+    ["part"],
+)
+NO_SPEECH = Counter(
+    "ml_no_speech_recordings_total", "Recordings rejected with no speech in them"
+)
+SHED = Counter(
+    "ml_shed_requests_total",
+    "Requests turned away before inference: queue_full, deadline (it would "
+    "not finish in time) or expired (its deadline passed in the queue)",
+    ["reason"],
+)
+MODEL_MEMORY = Gauge(
+    "ml_model_memory_bytes",
+    "Bytes held by the weights of the resident models",
+    multiprocess_mode="max",
+)
+# Loading takes seconds to minutes, evicting well under a second
+MODEL_LOAD_SECONDS = Histogram(
+    "ml_model_load_seconds",
+    "Time to load a model and warm it up, by model id",
+    ["model"],
+    buckets=(0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0),
+)
+MODEL_EVICT_SECONDS = Histogram(
+    "ml_model_evict_seconds",
+    "Time to unload a model evicted to stay within the memory budget",
+    ["model"],
+    buckets=LATENCY_BUCKETS,
+)
+# Emotions waiting in emotion_detector.result_writes for their bulk_write
+RESULT_WRITES_PENDING = Gauge(
+    "ml_result_writes_pending",
+    "Emotions answered but not yet written to fs.files",
+    multiprocess_mode="livesum",
+)
+RESULT_FLUSH_SECONDS = Histogram(
+    "ml_result_flush_seconds",
+    "Time to write one batch of emotions to fs.files and the rollups",
+    buckets=LATENCY_BUCKETS,
+)
+# The last encoder layer means no probe was sure and the whole model ran
+EARLY_EXITS = Counter(
+    "ml_early_exits_total",
+    "Recordings classified in fast mode, by the encoder layer that answered",
+    ["layer"],
+)
+
+# Bound once, so timing a stage costs two clock reads and one observe()
+_STAGE_TIMERS = {name: STAGE_SECONDS.labels(name) for name in STAGES}
+
+
+def stage(name):
+    """
+    Time a block as one of STAGES.
+    Usage:
+        with stage("decode"):
+            speech = decode_audio(data, SAMPLE_RATE)
+    """
+    return _STAGE_TIMERS[name].time()
+
+
+def observe(name, seconds):
+    """Record a duration measured elsewhere as one of STAGES."""
+    _STAGE_TIMERS[name].observe(seconds)
+
+
+def outcome(status_code):
+    """Group a status code into success, client_error or server_error."""
+    if status_code < 400:
+        return "success"
+    return "client_error" if status_code < 500 else "server_error"
+
+
+def instrument(flask_app):
+    """
+    Count every request of a Flask app by route and outcome, time it, and
+    track how many are in flight. Flask runs after_request for the 500
+    response of a view that raised, so errors are counted too.
+    """
+
+    @flask_app.before_request
+    def start_request():
+        IN_FLIGHT.inc()
+        request.environ["metrics.in_flight"] = True
+        request.environ["metrics.started"] = time.perf_counter()
+
+    @flask_app.after_request
+    def count_response(response):
+        record_request(response.status_code)
+        return response
+
+    @flask_app.teardown_request
+    def finish_request(_exc):
+        # Only requests counted on the way in; a context can be torn down
+        # without before_request having run
+        if request.environ.pop("metrics.in_flight", False):
+            IN_FLIGHT.dec()
+
+
+def record_request(status_code):
+    """Count and time the current request."""
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    REQUESTS.labels(route, outcome(status_code)).inc()
+    started = request.environ.get("metrics.started")
+    if started is not None:
+        REQUEST_SECONDS.labels(route).observe(time.perf_counter() - started)
+
+
+def metrics_response():
+    """
+    Render every metric in the Prometheus text format. Under gunicorn with
+    PROMETHEUS_MULTIPROC_DIR set, the workers' metrics are merged.
+    """
+    registry = REGISTRY
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,112 @@
+"""Module for loading the emotion model off the request path"""
+
+import threading
+import time
+
+
+class ModelLoader:
+    """
+    Loads the inference backend once, either in the background at startup
+    or on first use, and reports how long each stage took.
+
+    Loading runs a list of named stages, each taking the previous stage's
+    result (the first one gets None). The last stage's result is what get()
+    returns.
+    """
+
+    def __init__(self, stages):
+        """
+        Args:
+            stages (list): (name, callable) pairs run in order.
+        """
+        self.stages = stages
+        self.status = "not_loaded"
+        self.timings = {}
+        self.error = None
+        self._lock = threading.Lock()
+        self._completed = 0
+        self._value = None
+
+    def get(self):
+        """
+        Returns:
+            The loaded backend, loading it first if nobody has yet.
+        Raises:
+            RuntimeError: If loading failed.
+        """
+        if not self._loaded():
+            with self._lock:
+                if not self._loaded():
+                    self._load()
+        return self._value
+
+    def start_background(self):
+        """Begin loading on a daemon thread so the server can bind right away."""
+
+        def load():
+            try:
+                self.get()
+            except RuntimeError as exc:
+                print(exc)
+
+        threading.Thread(target=load, name="model-loader", daemon=True).start()
+
+    def preload(self, until):
+        """
+        Run the stages up to and including the named one now, so that a
+        later get() only runs the rest. Serve mode uses this to load the
+        weights once before forking and build the backend in each worker.
+        Args:
+            until (str): Name of the last stage to run.
+        Returns:
+            That stage's result.
+        """
+        count = [name for name, _ in self.stages].index(until) + 1
+        with self._lock:
+            self._run(count)
+            if not self._loaded():
+                self.status = "preloaded"
+        return self._value
+
+    def unload(self):
+        """
+        Drop the loaded backend so its memory can be freed. The next get()
+        runs every stage again.
+        """
+        with self._lock:
+            self._value = None
+            self._completed = 0
+            self.status = "not_loaded"
+
+    def ready(self):
+        """Whether the backend is loaded and warmed up."""
+        return self.status == "ready"
+
+    def _loaded(self):
+        return self._completed == len(self.stages)
+
+    def _run(self, count):
+        # Caller holds the lock; resumes after any stages already run
+        pending = self.stages[self._completed : count]
+        if not pending:
+            return
+        self.status = "loading"
+        try:
+            for name, stage in pending:
+                started = time.perf_counter()
+                self._value = stage(self._value)
+                self._completed += 1
+                self.timings[name] = round(time.perf_counter() - started, 3)
+        except Exception as exc:
+            self.status = "failed"
+            self.error = f"{type(exc).__name__}: {exc}"
+            raise RuntimeError(f"Model failed to load: {self.error}") from exc
+
+    def _load(self):
+        # Caller holds the lock
+        self._run(len(self.stages))
+        self.status = "ready"
+        breakdown = ", ".join(
+            f"{name} {secs:.2f}s" for name, secs in self.timings.items()
+        )
+        print(f"Model ready in {sum(self.timings.values()):.2f}s ({breakdown})")
@@ -0,0 +1,168 @@
+"""Module for serving several emotion models from one process"""
+
+import gc
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import MODEL_EVICT_SECONDS, MODEL_LOAD_SECONDS, MODEL_MEMORY
+
+
+class UnknownModel(ValueError):
+    """Raised when a request asks for a model the registry does not serve."""
+
+
+class ModelRegistry:
+    """
+    Loads emotion models on first use and keeps them resident under a
+    memory budget, evicting the least recently used one when a new load
+    would go over it.
+
+    Each model has its own ModelLoader, made by a factory the first time
+    the model is asked for. Evicting a model unloads its loader, so the
+    next request for it loads it again. Requests that already hold the
+    evicted backend finish with it; its memory is freed when they are done.
+    Two models loading at the same time can briefly go over the budget.
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        factory,
+        model_ids,
+        *,
+        budget_bytes=0,
+        pinned=(),
+        measure=None,
+        loaders=None,
+    ):
+        """
+        Args:
+            factory (callable): Takes a model id and returns its ModelLoader.
+            model_ids (list): The ids of the models that may be served.
+            budget_bytes (int): Most bytes of weights to keep resident, 0 for
+                no limit. The model just used is kept even if it alone is
+                over the budget.
+            pinned (tuple): Ids that are never evicted, such as the default
+                model the worker and /readyz rely on.
+            measure (callable): Takes a loaded backend and returns the bytes
+                it holds; without one every model counts as 0 bytes.
+            loaders (dict): Loaders already made, by model id, which the
+                factory is not asked for.
+        """
+        self.factory = factory
+        self.budget_bytes = budget_bytes
+        self.pinned = set(pinned)
+        self.measure = measure or (lambda _backend: 0)
+        self._lock = threading.Lock()
+        # Each model's loader, once made, and its load and eviction counts
+        self._models = {
+            model_id: {
+                "loader": (loaders or {}).get(model_id),
+                "loads": 0,
+                "evictions": 0,
+            }
+            for model_id in model_ids
+        }
+        # Resident model ids and their bytes, least recently used first
+        self._resident = OrderedDict()
+
+    @property
+    def model_ids(self):
+        """The ids of the models that may be served."""
+        return list(self._models)
+
+    def loader(self, model_id):
+        """
+        Returns:
+            ModelLoader: The loader of a served model, made on first use.
+        Raises:
+            UnknownModel: If the registry does not serve that model.
+        """
+        if model_id not in self._models:
+            raise UnknownModel(f"Unknown model {model_id!r}")
+        with self._lock:
+            entry = self._models[model_id]
+            if entry["loader"] is None:
+                entry["loader"] = self.factory(model_id)
+            return entry["loader"]
+
+    def get(self, model_id):
+        """
+        Return a model's backend, loading it first if it is not resident
+        and evicting others if that puts the registry over its budget.
+        Args:
+            model_id (str): One of model_ids.
+        Returns:
+            The loaded backend.
+        Raises:
+            UnknownModel: If the registry does not serve that model.
+            RuntimeError: If loading failed.
+        """
+        loader = self.loader(model_id)
+        # Loading holds the loader's own lock, so requests for other
+        # models are not held up behind it
+        backend = loader.get()
+        with self._lock:
+            if model_id in self._resident:
+                self._resident.move_to_end(model_id)
+                return backend
+            # Loaded by this call, or by a caller that used the loader
+            # directly, such as gunicorn.conf.py before forking
+            self._resident[model_id] = self.measure(backend)
+            entry = self._models[model_id]
+            entry["loads"] += 1
+            load_seconds = sum(loader.timings.values())
+            entry["loadSeconds"] = round(load_seconds, 3)
+            MODEL_LOAD_SECONDS.labels(model_id).observe(load_seconds)
+            self._evict()
+            MODEL_MEMORY.set(sum(self._resident.values()))
+        return backend
+
+    def stats(self):
+        """
+        Returns:
+            dict: The budget, the bytes resident and, for each model, its
+                status, bytes, load and eviction counts, and how long its
+                last load and eviction took.
+        """
+        with self._lock:
+            return {
+                "budgetBytes": self.budget_bytes,
+                "residentBytes": sum(self._resident.values()),
+                "models": {
+                    model_id: {
+                        **{k: v for k, v in entry.items() if k != "loader"},
+                        "status": (
+                            entry["loader"].status if entry["loader"] else "not_loaded"
+                        ),
+                        "bytes": self._resident.get(model_id, 0),
+                    }
+                    for model_id, entry in self._models.items()
+                },
+            }
+
+    def _evict(self):
+        # Caller holds the lock; the model just used is last in _resident
+        candidates = [
+            model_id
+            for model_id in list(self._resident)[:-1]
+            if model_id not in self.pinned
+        ]
+        while (
+            self.budget_bytes
+            and candidates
+            and sum(self._resident.values()) > self.budget_bytes
+        ):
+            model_id = candidates.pop(0)
+            entry = self._models[model_id]
+            started = time.perf_counter()
+            entry["loader"].unload()
+            del self._resident[model_id]
+            # Free anything only reference cycles keep alive now, not at the
+            # next collection
+            gc.collect()
+            evict_seconds = time.perf_counter() - started
+            entry["evictions"] += 1
+            entry["evictSeconds"] = round(evict_seconds, 3)
+            MODEL_EVICT_SECONDS.labels(model_id).observe(evict_seconds)
+            print(f"Evicted model {model_id} in {evict_seconds:.2f}s")
@@ -0,0 +1,209 @@
+"""
+Module for profiling single requests on demand.
+
+A request is profiled when it sends PROFILE_HEADER with the configured
+token, or at random at the configured sample rate. cProfile and
+torch.profiler run for the whole request in the thread that handles it;
+emotion_detector runs a profiled request's inference in that thread too,
+instead of in the micro-batcher's. Each profile is written as:
+    <name>.pstats: cProfile's statistics, for pstats or snakeviz.
+    <name>.collapsed: Collapsed stacks, for flamegraph.pl or speedscope.
+    <name>.trace.json: torch.profiler's Chrome trace, with every Python
+        call and PyTorch op on a timeline, for Perfetto or chrome://tracing.
+Only the newest profiles are kept. With no token and a zero sample rate
+install adds nothing to the app, so requests cost nothing extra.
+"""
+
+import cProfile
+import hmac
+import os
+import pstats
+import random
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+import torch
+from flask import request
+
+PROFILE_HEADER = "X-Profile"
+PROFILE_ID_HEADER = "X-Profile-Id"
+SUFFIXES = (".pstats", ".collapsed", ".trace.json")
+# Paths through the call graph shorter than this are left out of the
+# collapsed stacks, which keeps them small
+MIN_FOLDED_SECONDS = 1e-6
+
+# The profile of the request the current thread is handling, if any
+_current = threading.local()
+
+
+def active():
+    """Whether the current thread is handling a profiled request."""
+    return getattr(_current, "profile", None) is not None
+
+
+def frame_label(function):
+    """A cProfile function key as one frame of a collapsed stack."""
+    filename, line, name = function
+    if filename == "~":
+        # Built-ins have no file
+        return name.replace(";", ",")
+    return f"{os.path.basename(filename)}:{name}:{line}".replace(";", ",")
+
+
+def collapsed_stacks(stats):
+    """
+    Fold cProfile's call graph into collapsed stacks.
+    cProfile keeps the time of each caller and callee pair, not whole
+    stacks, so a function's time is split between the paths that reach
+    it in proportion to the time it spent under each caller.
+    Args:
+        stats (pstats.Stats): The profile.
+    Returns:
+        list: "frame;frame;frame microseconds" lines, outermost frame first.
+    """
+    entries = stats.stats
+    callees = defaultdict(list)
+    for function, (_, _, _, _, callers) in entries.items():
+        for caller, caller_stats in callers.items():
+            callees[caller].append((function, caller_stats[3]))
+    folded = defaultdict(float)
+    # Functions with no recorded caller were on the stack when it started
+    pending = [
+        ((function,), 1.0) for function, entry in entries.items() if not entry[4]
+    ]
+    while pending:
+        path, share = pending.pop()
+        folded[path] += entries[path[-1]][2] * share
+        for callee, under_caller in callees[path[-1]]:
+            total = entries[callee][3]
+            if callee in path or total <= 0:
+                continue
+            callee_share = share * under_caller / total
+            if callee_share * total >= MIN_FOLDED_SECONDS:
+                pending.append((path + (callee,), callee_share))
+    return [
+        f"{';'.join(frame_label(function) for function in path)} {round(seconds * 1e6)}"
+        for path, seconds in sorted(folded.items())
+        if round(seconds * 1e6) > 0
+    ]
+
+
+def prune(directory, keep):
+    """
+    Delete all but the newest keep profiles in directory.
+    Profile names start with the time they were taken, so they sort oldest
+    first.
+    """
+    names = sorted(
+        {
+            name.split(".", 1)[0]
+            for name in os.listdir(directory)
+            if name.endswith(SUFFIXES)
+        }
+    )
+    for name in names[: max(0, len(names) - keep)]:
+        for suffix in SUFFIXES:
+            try:
+                os.remove(os.path.join(directory, name + suffix))
+            except FileNotFoundError:
+                # Pruned by another worker
+                pass
+
+
+class RequestProfile:
+    """cProfile and torch.profiler over one request."""
+
+    def __init__(self, name):
+        """
+        Args:
+            name (str): Names the profile's files.
+        """
+        self.name = name
+        self.python = cProfile.Profile()
+        self.torch = torch.profiler.profile(
+            activities=[torch.profiler.ProfilerActivity.CPU], with_stack=True
+        )
+
+    def start(self):
+        """Start both profilers."""
+        self.torch.start()
+        self.python.enable()
+
+    def stop(self):
+        """Stop both profilers."""
+        self.python.disable()
+        self.torch.stop()
+
+    def write(self, directory):
+        """
+        Write the profile's files to directory.
+        Returns:
+            list: The paths written.
+        """
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, self.name)
+        self.python.dump_stats(path + ".pstats")
+        with open(path + ".collapsed", "w", encoding="utf-8") as file:
+            lines = collapsed_stacks(pstats.Stats(self.python))
+            file.write("\n".join(lines) + "\n")
+        self.torch.export_chrome_trace(path + ".trace.json")
+        return [path + suffix for suffix in SUFFIXES]
+
+
+def wanted(token, sample_rate):
+    """
+    Whether to profile the current request.
+    Args:
+        token (str): The value PROFILE_HEADER must have, or "" to ignore it.
+        sample_rate (float): The share of other requests to profile.
+    """
+    sent = request.headers.get(PROFILE_HEADER)
+    if token and sent is not None and hmac.compare_digest(sent, token):
+        return True
+    return sample_rate > 0 and random.random() < sample_rate
+
+
+def install(flask_app, options):
+    """
+    Profile the requests of a Flask app that ask for it or are sampled.
+    Args:
+        flask_app (Flask): The app.
+        options (dict): "directory" to write the profiles to, "token" and
+            "sample_rate" as for wanted, and "keep", the number of newest
+            profiles to keep.
+    """
+    if not options["token"] and options["sample_rate"] <= 0:
+        return
+
+    @flask_app.before_request
+    def start_profile():
+        if not wanted(options["token"], options["sample_rate"]):
+            return
+        stamp = time.strftime("%Y%m%dT%H%M%S", time.gmtime())
+        endpoint = (request.endpoint or "unmatched").replace(".", "-")
+        profile = RequestProfile(f"{stamp}-{endpoint}-{uuid.uuid4().hex[:8]}")
+        _current.profile = profile
+        profile.start()
+
+    @flask_app.after_request
+    def finish_profile(response):
+        profile = getattr(_current, "profile", None)
+        if profile is None:
+            return response
+        _current.profile = None
+        profile.stop()
+        profile.write(options["directory"])
+        prune(options["directory"], options["keep"])
+        response.headers[PROFILE_ID_HEADER] = profile.name
+        print(f"Profiled {request.path} as {profile.name}")
+        return response
+
+    @flask_app.teardown_request
+    def drop_profile(_exc):
+        # A request that failed before after_request leaves its profilers on
+        profile = getattr(_current, "profile", None)
+        if profile is not None:
+            _current.profile = None
+            profile.stop()
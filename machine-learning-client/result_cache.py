@@ -0,0 +1,119 @@
+"""Module for caching emotion results by audio content hash"""
+
+import datetime
+import threading
+from collections import OrderedDict
+
+from pymongo.errors import PyMongoError
+
+
+class ResultCache:
+    """
+    Two-level cache of emotion results keyed on the SHA-256 of the uploaded
+    audio and the model that produced them.
+
+    Lookups go to a bounded in-process LRU first and then to a Mongo
+    collection shared by every ML client instance. Entries written by a
+    different model are never returned, and invalidate_stale removes them.
+    """
+
+    def __init__(self, collection, model_name, max_entries=1024):
+        """
+        Args:
+            collection: The Mongo collection backing the cache.
+            model_name (str): Results are only shared between requests
+                classified by the same model.
+            max_entries (int): Capacity of the in-process LRU.
+        """
+        self.collection = collection
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._counts = {"memory_hits": 0, "mongo_hits": 0, "misses": 0, "evictions": 0}
+
+    def ensure_indexes(self):
+        """Create the unique (sha256, model) index the lookups rely on."""
+        self.collection.create_index([("sha256", 1), ("model", 1)], unique=True)
+
+    def invalidate_stale(self, keep=()):
+        """
+        Delete cached results produced by any other model.
+        Args:
+            keep (list): Other models whose results stay, because the same
+                process serves them too.
+        Returns:
+            int: The number of entries removed.
+        """
+        model = {"$nin": [self.model_name, *keep]} if keep else {"$ne": self.model_name}
+        result = self.collection.delete_many({"model": model})
+        return result.deleted_count
+
+    def get(self, digest):
+        """
+        Look up the emotion cached for an audio digest.
+        Args:
+            digest (str): Hex SHA-256 of the audio bytes.
+        Returns:
+            str: The cached emotion, or None on a miss.
+        """
+        with self._lock:
+            if digest in self._entries:
+                self._entries.move_to_end(digest)
+                self._counts["memory_hits"] += 1
+                return self._entries[digest]
+
+        try:
+            document = self.collection.find_one(
+                {"sha256": digest, "model": self.model_name}, {"emotion": 1}
+            )
+        except PyMongoError as exc:
+            print("Result cache lookup failed:", exc)
+            document = None
+
+        with self._lock:
+            if document is None:
+                self._counts["misses"] += 1
+                return None
+            self._counts["mongo_hits"] += 1
+            self._remember(digest, document["emotion"])
+        return document["emotion"]
+
+    def put(self, digest, emotion):
+        """
+        Store the emotion classified for an audio digest in both levels.
+        Args:
+            digest (str): Hex SHA-256 of the audio bytes.
+            emotion (str): The predicted emotion label.
+        """
+        with self._lock:
+            self._remember(digest, emotion)
+        try:
+            self.collection.update_one(
+                {"sha256": digest, "model": self.model_name},
+                {
+                    "$set": {
+                        "emotion": emotion,
+                        "createdAt": datetime.datetime.now(datetime.timezone.utc),
+                    }
+                },
+                upsert=True,
+            )
+        except PyMongoError as exc:
+            print("Result cache write failed:", exc)
+
+    def stats(self):
+        """
+        Returns:
+            dict: Hit/miss/eviction counters and the current LRU size.
+        """
+        with self._lock:
+            return dict(self._counts, size=len(self._entries), model=self.model_name)
+
+    def _remember(self, digest, emotion):
+        # Caller holds the lock
+        self._entries[digest] = emotion
+        self._entries.move_to_end(digest)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._counts["evictions"] += 1
@@ -0,0 +1,63 @@
+"""Module for keeping hourly emotion counts up to date as emotions are written"""
+
+import datetime
+from collections import defaultdict
+
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+
+
+def bucket_start(when):
+    """
+    The start of the UTC hour a recording falls in.
+    Args:
+        when (datetime.datetime): The recording's uploadDate. Naive values,
+            as pymongo returns them, are taken to be UTC.
+    """
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=datetime.timezone.utc)
+    return when.astimezone(datetime.timezone.utc).replace(
+        minute=0, second=0, microsecond=0
+    )
+
+
+def rollup_updates(changes):
+    """
+    Turn emotion writes into $inc updates, one per hour bucket touched.
+    Args:
+        changes: (uploadDate, previous emotion or None, new emotion) triples.
+    Returns:
+        list: UpdateOne operations for the rollup collection.
+    """
+    increments = defaultdict(lambda: defaultdict(int))
+    for when, previous, emotion in changes:
+        if previous == emotion:
+            continue
+        counts = increments[bucket_start(when)]
+        if previous is None:
+            counts["total"] += 1
+        else:
+            counts[f"counts.{previous}"] -= 1
+        counts[f"counts.{emotion}"] += 1
+    return [
+        UpdateOne({"_id": bucket}, {"$inc": dict(counts)}, upsert=True)
+        for bucket, counts in increments.items()
+    ]
+
+
+def record_emotions(collection, changes):
+    """
+    Apply emotion writes to the rollup collection with one bulk_write.
+    A failure is logged rather than raised, so it never fails the
+    classification that caused it.
+    Args:
+        collection: The emotion_rollups collection.
+        changes: See rollup_updates.
+    """
+    updates = rollup_updates(changes)
+    if not updates:
+        return
+    try:
+        collection.bulk_write(updates, ordered=False)
+    except PyMongoError as exc:
+        print(f"Failed to update emotion rollups: {exc}")
@@ -0,0 +1,230 @@
+"""
+Compaction and retention for the recordings stored in GridFS.
+
+The web app stores uploads as the browser sent them: WebM/Opus at 48 kHz,
+or uncompressed WAV. The model only ever sees 16 kHz mono, so compact
+re-encodes each recording to 16 kHz mono FLAC, which loses nothing the
+model would see, or to Opus at --bit-rate for a fraction of the size. Each
+recording keeps its _id, emotion and sha256, which stays the digest of the
+upload as received because the result cache and the stored embeddings are
+keyed by it. Its duration, sample rate, codec and original size are
+recorded next to them.
+
+prune deletes the audio of classified recordings older than the retention
+period. Their fs.files documents stay, with audioDeletedAt set and length
+0, so emotions, analytics and embeddings outlive the audio.
+
+Every step of a compaction can be interrupted. The new audio is first
+stored as a separate file carrying the original document; the next run
+finishes or undoes any swap it finds half done.
+
+Usage:
+    python storage.py compact --codec flac --limit 1000
+    python storage.py prune --retention-days 90
+"""
+
+import argparse
+import datetime
+import io
+import time
+
+from audio_decode import decode_audio, encode_audio, sniff_format
+from emotion_detector import SAMPLE_RATE, db, fs
+
+CODECS = {"flac": ("flac", ".flac"), "opus": ("webm", ".webm")}
+# Fields GridFS manages itself, which a re-stored recording must not copy
+GRIDFS_FIELDS = ("_id", "length", "chunkSize", "uploadDate", "md5")
+
+
+def transcode(data, codec, bit_rate=None):
+    """
+    Re-encode a recording as 16 kHz mono.
+    Args:
+        data (bytes): The recording as stored.
+        codec (str): "flac" or "opus".
+        bit_rate (int): Opus bits per second, or None for libopus's default.
+    Returns:
+        tuple: The encoded bytes and the fields to record about them.
+    """
+    speech = decode_audio(data, SAMPLE_RATE)
+    audio_format, _ = CODECS[codec]
+    encoded = encode_audio(speech, audio_format, SAMPLE_RATE, bit_rate)
+    return encoded, {
+        "codec": codec,
+        "sampleRate": SAMPLE_RATE,
+        "channels": 1,
+        "durationSeconds": round(len(speech) / SAMPLE_RATE, 3),
+        "originalLength": len(data),
+        "originalFormat": sniff_format(io.BytesIO(data)),
+        "compactedAt": datetime.datetime.now(datetime.timezone.utc),
+    }
+
+
+def replace_audio(document, encoded, fields):
+    """
+    Swap a recording's audio for encoded, keeping its _id and fields.
+    GridFS cannot rewrite a file in place, so the new audio is stored first
+    as a separate file holding the original document, the recording is
+    deleted and stored again under its _id, and the copy is removed.
+    Args:
+        document (dict): The recording's fs.files document.
+        encoded (bytes): The new audio.
+        fields (dict): Fields to add to the document.
+    """
+    kept = {k: v for k, v in document.items() if k not in GRIDFS_FIELDS}
+    filename = (kept.pop("filename", None) or "recording").rsplit(".", 1)[0]
+    kept.update(fields, filename=filename + CODECS[fields["codec"]][1])
+    copy_id = fs.put(
+        encoded,
+        compactedFrom=document["_id"],
+        original=kept,
+        originalUploadDate=document["uploadDate"],
+    )
+    restore(document["_id"], encoded, kept, document["uploadDate"])
+    fs.delete(copy_id)
+
+
+def restore(file_id, encoded, fields, upload_date):
+    """Store encoded under file_id with fields, replacing what is there."""
+    fs.delete(file_id)
+    fs.put(encoded, _id=file_id, **fields)
+    db.fs.files.update_one({"_id": file_id}, {"$set": {"uploadDate": upload_date}})
+
+
+def recover():
+    """
+    Finish the swaps an interrupted compaction left behind.
+    Returns:
+        int: How many recordings were restored from their copies.
+    """
+    restored = 0
+    for copy in db.fs.files.find({"compactedFrom": {"$exists": True}}):
+        # Copies made before originalUploadDate was kept only have their own
+        upload_date = copy.get("originalUploadDate", copy["uploadDate"])
+        current = db.fs.files.find_one({"_id": copy["compactedFrom"]}, {"codec": 1})
+        if current is None or "codec" not in current:
+            # The swap stopped before the recording was stored again
+            restore(
+                copy["compactedFrom"],
+                fs.get(copy["_id"]).read(),
+                copy["original"],
+                upload_date,
+            )
+            restored += 1
+        else:
+            # It may have stopped before the upload date was put back
+            db.fs.files.update_one(
+                {"_id": copy["compactedFrom"]}, {"$set": {"uploadDate": upload_date}}
+            )
+        fs.delete(copy["_id"])
+    return restored
+
+
+def compact(codec, limit=0, bit_rate=None):
+    """
+    Re-encode every recording that has not been compacted yet.
+    Recordings that fail to decode, or would not get smaller, are marked
+    with codec "original" and left as they are.
+    Args:
+        codec (str): "flac" or "opus".
+        limit (int): The most recordings to look at, 0 for all.
+        bit_rate (int): Opus bits per second, or None for libopus's default.
+    Returns:
+        dict: Recordings compacted and skipped, and bytes before and after.
+    """
+    totals = {"compacted": 0, "skipped": 0, "bytes_before": 0, "bytes_after": 0}
+    cursor = db.fs.files.find(
+        {
+            "codec": {"$exists": False},
+            "compactedFrom": {"$exists": False},
+            "audioDeletedAt": {"$exists": False},
+        },
+        limit=limit,
+    ).sort("_id", 1)
+    for document in cursor:
+        data = fs.get(document["_id"]).read()
+        try:
+            encoded, fields = transcode(data, codec, bit_rate)
+        except Exception as exc:  # pylint: disable=broad-exception-caught
+            print(f"Could not transcode {document['_id']}: {exc}")
+            encoded = None
+        if encoded is None or len(encoded) >= len(data):
+            db.fs.files.update_one(
+                {"_id": document["_id"]}, {"$set": {"codec": "original"}}
+            )
+            totals["skipped"] += 1
+            continue
+        replace_audio(document, encoded, fields)
+        totals["compacted"] += 1
+        totals["bytes_before"] += len(data)
+        totals["bytes_after"] += len(encoded)
+    return totals
+
+
+def prune(retention_days, now=None):
+    """
+    Delete the audio of classified recordings older than retention_days,
+    keeping their fs.files documents and emotions.
+    Args:
+        retention_days (float): How long audio is kept after upload.
+        now (datetime.datetime): The current time, for tests.
+    Returns:
+        dict: Recordings pruned and bytes freed.
+    """
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    documents = list(
+        db.fs.files.find(
+            {
+                "uploadDate": {"$lt": now - datetime.timedelta(days=retention_days)},
+                "emotion": {"$exists": True},
+                "audioDeletedAt": {"$exists": False},
+                "compactedFrom": {"$exists": False},
+            },
+            {"length": 1},
+        )
+    )
+    ids = [document["_id"] for document in documents]
+    if ids:
+        # Chunks go first: if this stops halfway, the next run finds the
+        # same documents and finishes the job
+        db.fs.chunks.delete_many({"files_id": {"$in": ids}})
+        db.fs.files.update_many(
+            {"_id": {"$in": ids}}, {"$set": {"audioDeletedAt": now, "length": 0}}
+        )
+    return {
+        "pruned": len(ids),
+        "bytes_freed": sum(document["length"] for document in documents),
+    }
+
+
+def main():
+    """Parse arguments and compact or prune."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", maxsplit=1)[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    compact_parser = commands.add_parser("compact")
+    compact_parser.add_argument("--codec", choices=sorted(CODECS), default="flac")
+    compact_parser.add_argument("--bit-rate", type=int, default=24000)
+    compact_parser.add_argument("--limit", type=int, default=0)
+    prune_parser = commands.add_parser("prune")
+    prune_parser.add_argument("--retention-days", type=float, required=True)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    if args.command == "prune":
+        print(f"Pruned audio: {prune(args.retention_days)}")
+        return
+    restored = recover()
+    if restored:
+        print(f"Restored {restored} recordings from an interrupted compaction")
+    totals = compact(args.codec, args.limit, args.bit_rate)
+    saved = totals["bytes_before"] - totals["bytes_after"]
+    print(
+        f"Compacted {totals['compacted']} recordings to {args.codec} "
+        f"({totals['skipped']} left as they were) in "
+        f"{time.perf_counter() - started:.1f}s, saving {saved} bytes "
+        f"({saved / max(1, totals['bytes_before']):.0%})"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+"""Module for classifying recordings while they are still being uploaded"""
+
+import threading
+import time
+
+import numpy as np
+import torch
+
+
+class StreamDecodeError(Exception):
+    """Raised when a finished recording cannot be decoded."""
+
+
+class StreamSession:  # pylint: disable=too-many-instance-attributes
+    """
+    Audio received so far for one in-progress recording.
+
+    The browser sends its MediaRecorder output in slices. Each slice is
+    handed to the session's decoder, which returns only the samples it adds,
+    and every complete window not classified yet is sent to the model, its
+    logits added to a running total. When the recording finishes only the
+    remaining tail still needs the model. Samples are dropped once their
+    window has been classified.
+    """
+
+    def __init__(self, config):
+        """
+        Args:
+            config (dict): decoder (makes an object whose decode(data,
+                final) returns the samples added since its last call),
+                classify_windows ((list of waveforms, deadline) -> logits,
+                one row per waveform), labels, sample_rate, window_seconds
+                and min_tail_seconds.
+        """
+        self.config = config
+        self.data = bytearray()
+        self.lock = threading.Lock()
+        self.last_seen = time.monotonic()
+        self.timeline = []
+        self._decoder = config["decoder"]()
+        # Samples from _next_start on, which no window has classified yet
+        self._pending = np.zeros(0, dtype=np.float32)
+        self._next_start = 0
+        self._total = None
+
+    def append(self, chunk, deadline=None):
+        """
+        Add a slice of the recording and classify any newly completed windows.
+        If classifying them fails, the slice is still kept and its windows
+        are classified on the next call.
+        Args:
+            chunk (bytes): The next slice of the encoded recording.
+            deadline (float): Passed on to classify_windows.
+        Returns:
+            dict: The running emotion (None until a window completes), the
+                seconds classified so far and the timeline entries just added.
+        """
+        self.data.extend(chunk)
+        self.last_seen = time.monotonic()
+        try:
+            self._receive(self._decoder.decode(bytes(self.data)))
+        except Exception:  # pylint: disable=broad-exception-caught
+            # A truncated container often fails to decode until more arrives
+            pass
+        added = self._classify(final=False, deadline=deadline)
+        return {
+            "emotion": self.emotion(),
+            "seconds": self._next_start / self.config["sample_rate"],
+            "timeline": added,
+        }
+
+    def finish(self, deadline=None):
+        """
+        Classify whatever is left after the last full window.
+        Args:
+            deadline (float): Passed on to classify_windows.
+        Returns:
+            str: The emotion for the whole recording, or None if it decoded
+                to no audio at all.
+        Raises:
+            StreamDecodeError: If the recording cannot be decoded.
+        """
+        try:
+            self._receive(self._decoder.decode(bytes(self.data), final=True))
+        except Exception as exc:  # pylint: disable=broad-exception-caught
+            # libav, libsndfile and librosa each raise their own errors
+            raise StreamDecodeError("The recording could not be decoded") from exc
+        self._classify(final=True, deadline=deadline)
+        return self.emotion()
+
+    def emotion(self):
+        """The label with the highest mean logit over all windows so far."""
+        if self._total is None:
+            return None
+        return self.config["labels"][int(torch.argmax(self._total).item())]
+
+    def _receive(self, samples):
+        if len(samples):
+            self._pending = np.concatenate([self._pending, samples])
+
+    def _classify(self, final, deadline):
+        sample_rate = self.config["sample_rate"]
+        window = int(self.config["window_seconds"] * sample_rate)
+        lengths = [window] * (len(self._pending) // window)
+        tail = len(self._pending) - window * len(lengths)
+        min_tail = int(self.config["min_tail_seconds"] * sample_rate)
+        if final and tail > 0 and (tail >= min_tail or self._total is None):
+            lengths.append(tail)
+        if not lengths:
+            return []
+
+        offsets = [window * index for index in range(len(lengths))]
+        logits = self.config["classify_windows"](
+            [
+                self._pending[offset : offset + length]
+                for offset, length in zip(offsets, lengths)
+            ],
+            deadline,
+        )
+        # Only now that the windows are classified are they dropped
+        summed = logits.sum(dim=0)
+        self._total = summed if self._total is None else self._total + summed
+        confidence, predicted = torch.softmax(logits, dim=-1).max(dim=-1)
+        added = [
+            {
+                "start": (self._next_start + offset) / sample_rate,
+                "end": (self._next_start + offset + length) / sample_rate,
+                "emotion": self.config["labels"][index],
+                "confidence": round(score, 4),
+            }
+            for offset, length, index, score in zip(
+                offsets, lengths, predicted.tolist(), confidence.tolist()
+            )
+        ]
+        consumed = sum(lengths)
+        self._pending = self._pending[consumed:].copy()
+        self._next_start += consumed
+        self.timeline += added
+        return added
+
+
+class StreamRegistry:
+    """Open stream sessions by id, dropping ones that have gone quiet."""
+
+    def __init__(self, config, idle_seconds=120.0):
+        """
+        Args:
+            config (dict): Passed to every StreamSession that is created.
+            idle_seconds (float): Sessions with no chunk for this long are
+                discarded.
+        """
+        self.config = config
+        self.idle_seconds = idle_seconds
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def get(self, session_id, create=True):
+        """
+        Args:
+            session_id (str): The id chosen by the browser for the recording.
+            create (bool): Open a new session if none exists.
+        Returns:
+            StreamSession: The session, or None if it does not exist and
+                create is False.
+        """
+        with self._lock:
+            self._expire()
+            session = self._sessions.get(session_id)
+            if session is None and create:
+                session = self._sessions[session_id] = StreamSession(self.config)
+            return session
+
+    def pop(self, session_id):
+        """Remove and return a session, or None if it does not exist."""
+        with self._lock:
+            return self._sessions.pop(session_id, None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
+
+    def _expire(self):
+        # Caller holds the lock
+        cutoff = time.monotonic() - self.idle_seconds
+        for session_id in [
+            key for key, session in self._sessions.items() if session.last_seen < cutoff
+        ]:
+            del self._sessions[session_id]
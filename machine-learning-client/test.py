@@ -1,15 +1,81 @@
 """Modules for tests"""
 
+# pylint: disable=too-many-lines
+
+import cProfile
+import datetime
+import hashlib
+import os
+import pstats
+import runpy
+import time
+from io import BytesIO
 from unittest import mock
 import numpy as np
 import pytest
 import torch
 from bson import ObjectId
 import pymongo
+import gridfs
+import mongomock
+import mongomock.gridfs
+from pymongo import UpdateOne
 from pymongo.errors import ConnectionFailure, OperationFailure
 import librosa
-from transformers import Wav2Vec2ForSequenceClassification
-from emotion_detector import classify_emotion_from_audio, create_flask_app
+import soundfile
+from transformers import Wav2Vec2Config, Wav2Vec2ForSequenceClassification
+from prometheus_client import REGISTRY
+from admission import AdmissionController, Overloaded
+from backends import load_backend, model_bytes
+from audio_decode import StreamDecoder, decode_audio, encode_audio, sniff_format
+from benchmark_e2e import (
+    encode_recording,
+    find_regressions,
+    make_fixtures,
+    make_recording,
+    mongomock_bulk_write,
+)
+from early_exit import ExitProbes, fit_probes
+from embedding_index import EmbeddingIndex, vote
+from embedding_store import EmbeddingStore, decode_embedding, encode_embedding
+from job_queue import claim_job, complete_job, fail_job, renew_lease
+from model_loader import ModelLoader
+from model_registry import ModelRegistry, UnknownModel
+import request_profiler
+from batching import DeadlineExceeded, MicroBatchScheduler, pad_batch
+from emotion_detector import (
+    classify_emotion_from_audio,
+    classify_emotions_batch,
+    classify_speech,
+    classify_stored_file,
+    classify_stream_windows,
+    create_flask_app,
+    write_results,
+    load_speech,
+    model_loader,
+    trim_speech,
+    DEADLINE_HEADER,
+    EMOTION_LABELS,
+    MODEL_ID,
+    MODEL_VERSION,
+    SAMPLE_RATE,
+)
+from result_cache import ResultCache
+from rollups import rollup_updates
+from streaming import StreamRegistry, StreamSession
+from vad import NoSpeechError, trim_silence
+from windowing import classify_windowed, window_starts
+from write_buffer import WriteBuffer
+import worker
+import backfill
+import storage
+
+
+@pytest.fixture(autouse=True, scope="module")
+def fixture_loaded_model():
+    """Load the real model up front, as the service does at startup, so tests
+    that mock from_pretrained do not end up replacing it"""
+    model_loader.get()
 
 
 @mock.patch("librosa.load")
@@ -168,3 +234,1585 @@ def test_model_loading_error(mock_model):
     # Ensure that the exception is raised when attempting to load the model
     with pytest.raises(Exception):
         Wav2Vec2ForSequenceClassification.from_pretrained("model-name")
+
+
+def test_pad_batch_masks_padding():
+    """Test that pad_batch zero-pads shorter clips and masks the padding"""
+    speeches = [np.ones(3, dtype=np.float32), np.ones(5, dtype=np.float32)]
+
+    input_values, attention_mask = pad_batch(speeches)
+
+    assert input_values.shape == (2, 5)
+    assert attention_mask.tolist() == [[1, 1, 1, 0, 0], [1, 1, 1, 1, 1]]
+    assert input_values[0, 3:].abs().sum().item() == 0
+
+
+def test_scheduler_groups_concurrent_requests():
+    """Test that requests queued together are classified in one batch"""
+    batch_sizes = []
+
+    def classify_batch(speeches):
+        batch_sizes.append(len(speeches))
+        return [f"label-{int(speech[0])}" for speech in speeches]
+
+    scheduler = MicroBatchScheduler(classify_batch, max_batch_size=4, max_wait_ms=200)
+    futures = [scheduler.submit(np.full(10, i, dtype=np.float32)) for i in range(4)]
+
+    assert [future.result(timeout=5) for future in futures] == [
+        "label-0",
+        "label-1",
+        "label-2",
+        "label-3",
+    ]
+    assert batch_sizes == [4]
+
+
+def test_scheduler_propagates_errors():
+    """Test that a failed batch raises in every waiting caller"""
+
+    def classify_batch(_speeches):
+        raise RuntimeError("forward pass failed")
+
+    scheduler = MicroBatchScheduler(classify_batch, max_batch_size=2, max_wait_ms=0)
+
+    with pytest.raises(RuntimeError):
+        scheduler.classify(np.zeros(10, dtype=np.float32), timeout=5)
+
+
+def test_classify_emotions_batch_matches_single():
+    """Test that padded batch inference agrees with per-clip inference"""
+    rng = np.random.default_rng(0)
+    speeches = [
+        rng.standard_normal(16000).astype(np.float32),
+        rng.standard_normal(8000).astype(np.float32),
+    ]
+
+    assert classify_emotions_batch(speeches) == [classify_speech(s) for s in speeches]
+
+
+def _wav_bytes(speech, sample_rate, channels=1):
+    """Encode a waveform as in-memory 16-bit WAV bytes"""
+    buffer = BytesIO()
+    data = np.stack([speech] * channels, axis=1) if channels > 1 else speech
+    soundfile.write(buffer, data, sample_rate, format="WAV", subtype="PCM_16")
+    return buffer.getvalue()
+
+
+@mock.patch("librosa.load")
+def test_load_speech_decodes_bytes_in_memory(mock_load):
+    """Test that WAV bytes are decoded without going through librosa.load"""
+    speech = np.linspace(-0.5, 0.5, 16000, dtype=np.float32)
+
+    decoded = load_speech(_wav_bytes(speech, 16000))
+
+    mock_load.assert_not_called()
+    assert decoded.dtype == np.float32
+    assert decoded.flags["C_CONTIGUOUS"]
+    np.testing.assert_allclose(decoded, speech, atol=1e-4)
+
+
+def test_load_speech_downmixes_and_resamples_stream():
+    """Test that a stereo 8 kHz stream comes back as mono 16 kHz"""
+    speech = np.zeros(8000, dtype=np.float32)
+
+    decoded = load_speech(BytesIO(_wav_bytes(speech, 8000, channels=2)))
+
+    assert decoded.ndim == 1
+    assert len(decoded) == 16000
+
+
+@mock.patch("librosa.load")
+@mock.patch("soundfile.read")
+def test_load_speech_fallback_removes_temp_file(mock_read, mock_load):
+    """Test that undecodable containers fall back to librosa and clean up"""
+    mock_read.side_effect = soundfile.LibsndfileError(1, "unknown format")
+    mock_load.side_effect = librosa.util.exceptions.ParameterError("bad audio")
+
+    with pytest.raises(librosa.util.exceptions.ParameterError):
+        load_speech(b"\x1aE\xdf\xa3webm")
+
+    temp_file_path = mock_load.call_args[0][0]
+    assert not os.path.exists(temp_file_path)
+
+
+@pytest.mark.parametrize(
+    "header, container",
+    [
+        (b"RIFF\x00\x00\x00\x00WAVE", "wav"),
+        (b"fLaC\x00\x00\x00\x22", "flac"),
+        (b"OggS\x00\x02", "ogg"),
+        (b"\x1aE\xdf\xa3\x9fB\x86\x81", "webm"),
+        (b"\x00\x00\x00\x18ftypM4A ", "mp4"),
+        (b"ID3\x04\x00", None),
+    ],
+)
+def test_sniff_format_reads_magic_bytes(header, container):
+    """Test that the container comes from the data, not the upload's label"""
+    stream = BytesIO(header + b"\x00" * 16)
+
+    assert sniff_format(stream) == container
+    assert stream.tell() == 0
+
+
+@mock.patch("audio_decode._decode_with_librosa")
+def test_decode_audio_reads_webm_opus_in_process(mock_librosa):
+    """Test that browser WebM/Opus is decoded without the librosa fallback"""
+    times = np.arange(16000) / 16000
+    speech = (0.3 * np.sin(2 * np.pi * 220 * times)).astype(np.float32)
+
+    decoded = decode_audio(encode_recording(speech, "webm"), 16000)
+
+    mock_librosa.assert_not_called()
+    assert decoded.dtype == np.float32
+    assert abs(len(decoded) - 16000) < 960
+    assert 0.2 < np.abs(decoded).max() < 0.4
+
+
+@mock.patch("librosa.resample")
+def test_decode_audio_skips_resampling_native_rate(mock_resample):
+    """Test that 16 kHz PCM uploads are used as they are"""
+    speech = np.linspace(-0.5, 0.5, 16000, dtype=np.float32)
+
+    decoded = decode_audio(encode_recording(speech, "flac"), 16000)
+
+    mock_resample.assert_not_called()
+    np.testing.assert_allclose(decoded, speech, atol=1e-4)
+
+
+def test_result_cache_lru_eviction():
+    """Test that the in-process cache evicts the least recently used entry"""
+    collection = mock.MagicMock()
+    collection.find_one.return_value = None
+    cache = ResultCache(collection, "model-a", max_entries=2)
+
+    cache.put("a", "happy")
+    cache.put("b", "sad")
+    assert cache.get("a") == "happy"
+    cache.put("c", "angry")
+
+    assert cache.get("b") is None
+    assert cache.get("a") == "happy"
+    assert cache.get("c") == "angry"
+    stats = cache.stats()
+    assert stats["memory_hits"] == 3
+    assert stats["misses"] == 1
+    assert stats["evictions"] == 1
+    assert stats["size"] == 2
+
+
+def test_result_cache_falls_back_to_mongo():
+    """Test that a Mongo hit is scoped to the model and promoted into memory"""
+    collection = mock.MagicMock()
+    collection.find_one.return_value = {"emotion": "fear"}
+    cache = ResultCache(collection, "model-a")
+
+    assert cache.get("digest") == "fear"
+    assert cache.get("digest") == "fear"
+
+    collection.find_one.assert_called_once_with(
+        {"sha256": "digest", "model": "model-a"}, {"emotion": 1}
+    )
+    assert cache.stats()["mongo_hits"] == 1
+    assert cache.stats()["memory_hits"] == 1
+
+
+def test_result_cache_invalidates_other_models():
+    """Test that results from a different MODEL_NAME are removed"""
+    collection = mock.MagicMock()
+    collection.delete_many.return_value.deleted_count = 3
+    cache = ResultCache(collection, "model-b")
+
+    assert cache.invalidate_stale() == 3
+    collection.delete_many.assert_called_once_with({"model": {"$ne": "model-b"}})
+
+
+def test_result_cache_treats_mongo_errors_as_miss():
+    """Test that a failing cache collection does not fail the request"""
+    collection = mock.MagicMock()
+    collection.find_one.side_effect = OperationFailure("unavailable")
+    cache = ResultCache(collection, "model-a")
+
+    assert cache.get("digest") is None
+    assert cache.stats()["misses"] == 1
+
+
+@mock.patch("emotion_detector.result_writes")
+@mock.patch("emotion_detector.load_speech")
+@mock.patch("emotion_detector.result_cache")
+@mock.patch("emotion_detector.fs")
+def test_emotion_route_cache_hit_skips_inference(
+    mock_fs, mock_cache, mock_load_speech, mock_writes
+):
+    """Test that a cached digest answers without decoding the audio"""
+    mock_fs.get.return_value.sha256 = "digest"
+    mock_cache.get.return_value = "happy"
+
+    app = create_flask_app()
+
+    with app.test_client() as client:
+        response = client.post("/detect-emotion", json={"fileId": str(ObjectId())})
+
+    assert response.status_code == 200
+    assert response.json == {"emotion": "happy", "cached": True, "modelId": "default"}
+    mock_cache.get.assert_called_once_with("digest")
+    mock_load_speech.assert_not_called()
+    assert mock_writes.put.call_args[0][0]["emotion"] == "happy"
+
+
+@mock.patch("emotion_detector.embedding_store")
+@mock.patch("emotion_detector.scheduler")
+@mock.patch("emotion_detector.result_cache")
+def test_classify_route_caches_posted_audio(mock_cache, mock_scheduler, mock_store):
+    """Test that /classify decodes the request body and caches by its digest"""
+    buffer = BytesIO()
+    tone = 0.3 * np.sin(np.arange(8000, dtype=np.float32) * 0.2)
+    soundfile.write(buffer, tone, 16000, format="WAV")
+    data = buffer.getvalue()
+    mock_cache.get.return_value = None
+    mock_scheduler.classify.return_value = ("sad", np.ones(4, dtype=np.float32))
+
+    app = create_flask_app()
+
+    with app.test_client() as client:
+        response = client.post("/classify", data=data)
+        empty = client.post("/classify", data=b"")
+
+    assert response.status_code == 200
+    assert response.json == {
+        "emotion": "sad",
+        "cached": False,
+        "modelId": "default",
+        "audio": {"seconds": 0.5, "inferredSeconds": 0.5},
+        "modelVersion": MODEL_VERSION,
+    }
+    assert len(mock_scheduler.classify.call_args[0][0]) == 8000
+    mock_cache.put.assert_called_once_with(hashlib.sha256(data).hexdigest(), "sad")
+    assert mock_store.put.call_args[0][0] == hashlib.sha256(data).hexdigest()
+    assert empty.status_code == 400
+
+
+def test_window_starts_cover_whole_clip():
+    """Test that windows overlap and the last one ends at the clip end"""
+    assert window_starts(100, 40, 20) == [0, 20, 40, 60]
+    assert window_starts(105, 40, 20) == [0, 20, 40, 60, 65]
+    assert window_starts(30, 40, 20) == [0]
+
+
+def test_classify_windowed_batches_and_aggregates():
+    """Test bounded batches, the timeline and both aggregation modes"""
+    labels = ["calm", "loud"]
+    batch_sizes = []
+
+    def predict_logits(batch):
+        batch_sizes.append(batch.shape[0])
+        loud = batch.abs().mean(dim=-1) > 0.5
+        # Quiet windows are confidently "calm", loud ones weakly "loud"
+        return torch.where(
+            loud.unsqueeze(-1), torch.tensor([0.0, 1.0]), torch.tensor([4.0, 0.0])
+        )
+
+    speech = np.zeros(16 * 5, dtype=np.float32)
+    speech[16 * 3 :] = 1.0
+    options = {
+        "sample_rate": 16,
+        "window_seconds": 1,
+        "hop_seconds": 1,
+        "batch_size": 2,
+        "aggregate": "mean",
+    }
+
+    emotion, timeline = classify_windowed(speech, predict_logits, labels, options)
+
+    assert batch_sizes == [2, 2, 1]
+    assert emotion == "calm"
+    assert [entry["emotion"] for entry in timeline] == [
+        "calm",
+        "calm",
+        "calm",
+        "loud",
+        "loud",
+    ]
+    assert timeline[-1]["start"] == 4.0 and timeline[-1]["end"] == 5.0
+
+    # One confident calm window against five unsure loud ones
+    speech = np.ones(16 * 6, dtype=np.float32)
+    speech[:16] = 0.0
+    assert classify_windowed(speech, predict_logits, labels, options)[0] == "loud"
+    options["aggregate"] = "confidence"
+    assert classify_windowed(speech, predict_logits, labels, options)[0] == "calm"
+
+
+class _ByteDecoder:  # pylint: disable=too-few-public-methods
+    """Stream decoder whose samples are the bytes themselves"""
+
+    def __init__(self):
+        self.seen = 0
+
+    def decode(self, data, final=False):  # pylint: disable=unused-argument
+        """The bytes not returned before, as float32 samples"""
+        new = np.frombuffer(data[self.seen :], dtype=np.uint8).astype(np.float32)
+        self.seen = len(data)
+        return new
+
+
+def _window_logits(batch):
+    """Logits that say "loud" for windows averaging above 0.5"""
+    loud = torch.stack([torch.as_tensor(window).mean() > 0.5 for window in batch])
+    return torch.stack([(~loud).float(), loud.float()], dim=-1)
+
+
+def _stream_config():
+    """Stream config whose model says "loud" for windows averaging above 0.5"""
+    return {
+        "decoder": _ByteDecoder,
+        "classify_windows": lambda windows, deadline: _window_logits(windows),
+        "labels": ["calm", "loud"],
+        "sample_rate": 4,
+        "window_seconds": 1,
+        "min_tail_seconds": 0.5,
+    }
+
+
+def test_stream_session_classifies_windows_as_they_complete():
+    """Test partial results per complete window and the final tail"""
+    session = StreamSession(_stream_config())
+
+    first = session.append(bytes([0, 0, 0]))
+    assert first == {"emotion": None, "seconds": 0.0, "timeline": []}
+
+    second = session.append(bytes([0, 1, 1, 1, 1, 1]))
+    assert second["emotion"] == "calm"
+    assert second["seconds"] == 2.0
+    assert [entry["emotion"] for entry in second["timeline"]] == ["calm", "loud"]
+
+    session.append(bytes([1, 1]))
+    assert session.finish() in ("calm", "loud")
+    assert [entry["end"] for entry in session.timeline] == [1.0, 2.0, 2.75]
+
+
+def test_stream_session_short_recording_still_classified():
+    """Test that a recording shorter than one window gets a result on finish"""
+    session = StreamSession(_stream_config())
+    session.append(bytes([1]))
+
+    assert session.finish() == "loud"
+
+
+def test_stream_registry_expires_idle_sessions():
+    """Test that sessions without recent chunks are discarded"""
+    registry = StreamRegistry(_stream_config(), idle_seconds=60)
+    session = registry.get("abc")
+    session.last_seen -= 120
+
+    assert registry.get("other") is not None
+    assert registry.get("abc", create=False) is None
+    assert len(registry) == 1
+
+
+def test_stream_chunk_rejects_bad_session_id():
+    """Test that stream ids outside the allowed alphabet are rejected"""
+    app = create_flask_app()
+
+    with app.test_client() as client:
+        response = client.post("/stream/bad.id/chunk", data=b"abc")
+
+    assert response.status_code == 400
+
+
+def test_stream_finish_unknown_session():
+    """Test finishing a stream that never received audio"""
+    app = create_flask_app()
+
+    with app.test_client() as client:
+        response = client.post("/stream/missing/finish")
+
+    assert response.status_code == 404
+
+
+@mock.patch("emotion_detector.emotion_rollups")
+@mock.patch("emotion_detector.result_cache")
+@mock.patch("emotion_detector.fs")
+def test_stream_finish_rejects_undecodable_or_empty_audio(
+    mock_fs, mock_cache, mock_rollups
+):
+    """Test that a failed stream is a 422 that stores and counts nothing"""
+
+    class Decoder:  # pylint: disable=too-few-public-methods
+        """Fails on "bad", finds no audio in "nil" and silence in the rest"""
+
+        def decode(self, data, final=False):  # pylint: disable=unused-argument
+            """All of the recording at once"""
+            if data == b"bad":
+                raise ValueError("not audio")
+            return np.zeros(0 if data == b"nil" else 8, dtype=np.float32)
+
+    registry = StreamRegistry({**_stream_config(), "decoder": Decoder})
+    mock_fs.put.return_value = ObjectId()
+
+    with mock.patch("emotion_detector.stream_sessions", registry):
+        with create_flask_app().test_client() as client:
+            responses = {}
+            for data in (b"bad", b"nil", b"good"):
+                client.post(f"/stream/{data.decode()}/chunk", data=data)
+                responses[data] = client.post(f"/stream/{data.decode()}/finish")
+
+    assert responses[b"bad"].status_code == 422
+    assert responses[b"nil"].status_code == 422
+    assert responses[b"good"].json["emotion"] == "calm"
+    mock_fs.put.assert_called_once()
+    mock_rollups.bulk_write.assert_called_once()
+    mock_cache.put.assert_not_called()
+
+
+def test_stream_decoder_decodes_each_slice_once():
+    """Test that slices decode to the same audio as the whole recording"""
+    rng = np.random.default_rng(0)
+    speech = (rng.standard_normal(SAMPLE_RATE * 3) * 0.1).astype(np.float32)
+    data = encode_audio(speech, "webm", SAMPLE_RATE)
+    decoder = StreamDecoder(SAMPLE_RATE)
+
+    pieces = [
+        decoder.decode(data[:end])
+        for end in range(len(data) // 8, len(data), len(data) // 8)
+    ]
+    pieces.append(decoder.decode(data, final=True))
+
+    assert any(len(piece) for piece in pieces[:-1])
+    np.testing.assert_allclose(
+        np.concatenate(pieces), decode_audio(data, SAMPLE_RATE), atol=1e-6
+    )
+    assert len(decoder.decode(data, final=True)) == 0
+
+
+@mock.patch("emotion_detector.emotion_rollups")
+@mock.patch("emotion_detector.fs")
+def test_stream_windows_go_through_admission_and_batcher(mock_fs, _mock_rollups):
+    """Test that shed slices keep their audio and a shed finish can be retried"""
+    batches = []
+
+    def classify_batch(speeches):
+        batches.append(len(speeches))
+        return list(_window_logits(speeches))
+
+    registry = StreamRegistry(
+        {**_stream_config(), "classify_windows": classify_stream_windows}
+    )
+    mock_fs.put.return_value = ObjectId()
+    shed = {DEADLINE_HEADER: "0.01"}
+
+    with mock.patch("emotion_detector.stream_sessions", registry), mock.patch(
+        "emotion_detector.admission", AdmissionController(cost=1000.0)
+    ), mock.patch(
+        "emotion_detector.stream_scheduler", MicroBatchScheduler(classify_batch)
+    ):
+        with create_flask_app().test_client() as client:
+            first = client.post("/stream/s/chunk", data=bytes(4), headers=shed)
+            second = client.post("/stream/s/chunk", data=bytes([1] * 4))
+            client.post("/stream/s/chunk", data=bytes([1] * 2))
+            shed_finish = client.post("/stream/s/finish", headers=shed)
+            finish = client.post("/stream/s/finish")
+
+    assert first.status_code == 429 and "Retry-After" in first.headers
+    assert [entry["emotion"] for entry in second.json["timeline"]] == ["calm", "loud"]
+    assert shed_finish.status_code == 429
+    assert finish.status_code == 200
+    assert [entry["end"] for entry in finish.json["timeline"]] == [1.0, 2.0, 2.5]
+    assert sum(batches) == 3
+    assert len(registry) == 0
+
+
+TINY_MODEL_CONFIG = {
+    "hidden_size": 32,
+    "num_hidden_layers": 2,
+    "num_attention_heads": 2,
+    "intermediate_size": 64,
+    "conv_dim": (16,) * 7,
+    "num_conv_pos_embeddings": 16,
+    "num_conv_pos_embedding_groups": 2,
+    "classifier_proj_size": 16,
+    "num_labels": 7,
+    "feat_extract_norm": "layer",
+    "do_stable_layer_norm": True,
+}
+
+
+def _tiny_model():
+    """A small randomly initialised wav2vec2 classifier with seven labels"""
+    torch.manual_seed(0)
+    return Wav2Vec2ForSequenceClassification(Wav2Vec2Config(**TINY_MODEL_CONFIG)).eval()
+
+
+@pytest.mark.parametrize(
+    "backend_name, tolerance",
+    [("int8", 1e-2), ("compile", 1e-4), ("onnx", 1e-4)],
+)
+def test_backend_parity_with_fp32(backend_name, tolerance, tmp_path):
+    """Test that each optimized backend agrees with the fp32 eager model"""
+    if backend_name == "onnx":
+        pytest.importorskip("onnxruntime")
+    model = _tiny_model()
+    input_values = torch.randn(2, 16000)
+    attention_mask = torch.ones(2, 16000, dtype=torch.long)
+    attention_mask[1, 8000:] = 0
+    reference = load_backend("eager", model)(input_values, attention_mask)
+
+    backend = load_backend(
+        backend_name, model, onnx_path=str(tmp_path / "emotion.onnx")
+    )
+    logits = backend(input_values, attention_mask)
+
+    assert torch.equal(logits.argmax(dim=-1), reference.argmax(dim=-1))
+    assert torch.allclose(logits, reference, atol=tolerance)
+    assert torch.allclose(backend(input_values[:1]), reference[:1], atol=tolerance)
+
+
+def test_unknown_backend_rejected():
+    """Test that a misspelled INFERENCE_BACKEND fails loudly"""
+    with pytest.raises(ValueError):
+        load_backend("tensorrt", mock.MagicMock())
+
+
+def test_model_loader_runs_stages_once():
+    """Test that stages run in order, once, and are timed"""
+    calls = []
+
+    def load(_previous):
+        calls.append("load")
+        return "model"
+
+    def warm(value):
+        calls.append("warm")
+        return value + "-warm"
+
+    loader = ModelLoader([("weights", load), ("warmup", warm)])
+    assert not loader.ready()
+
+    assert loader.get() == "model-warm"
+    assert loader.get() == "model-warm"
+    assert calls == ["load", "warm"]
+    assert loader.ready()
+    assert set(loader.timings) == {"weights", "warmup"}
+
+
+def test_model_loader_reports_failure():
+    """Test that a failing stage leaves the loader in the failed state"""
+
+    def load(_previous):
+        raise OSError("no weights")
+
+    loader = ModelLoader([("weights", load)])
+
+    with pytest.raises(RuntimeError):
+        loader.get()
+    assert loader.status == "failed"
+    assert "no weights" in loader.error
+
+
+def test_model_loader_preload_resumes_after_stage():
+    """Test that get() only runs the stages preload left over"""
+    calls = []
+
+    def stage(name):
+        def run(previous):
+            calls.append(name)
+            return f"{previous}-{name}"
+
+        return run
+
+    loader = ModelLoader([(name, stage(name)) for name in ("weights", "backend")])
+
+    assert loader.preload("weights") == "None-weights"
+    assert loader.status == "preloaded"
+    assert loader.get() == "None-weights-backend"
+    assert calls == ["weights", "backend"]
+    assert loader.ready()
+
+
+@pytest.mark.parametrize(
+    "backend_name, preloaded", [("eager", False), ("compile", True)]
+)
+@mock.patch("gc.freeze")
+@mock.patch("torch.set_num_threads")
+@mock.patch("emotion_detector.model_loader")
+def test_serve_config_loads_model_before_fork(
+    mock_loader, mock_threads, _mock_freeze, backend_name, preloaded
+):
+    """Test that serve mode only shares fork-safe backends with its workers"""
+    config = runpy.run_path("gunicorn.conf.py")
+
+    with mock.patch("emotion_detector.INFERENCE_BACKEND", backend_name):
+        config["when_ready"](None)
+
+    assert mock_loader.preload.called == preloaded
+    assert mock_loader.get.called != preloaded
+    mock_threads.assert_called_once_with(1)
+
+
+def test_health_and_readiness_routes():
+    """Test /healthz and /readyz once the model is loaded"""
+    app = create_flask_app()
+
+    with app.test_client() as client:
+        assert client.get("/healthz").status_code == 200
+        response = client.get("/readyz")
+
+    assert response.status_code == 200
+    assert response.json["status"] == "ready"
+    assert "warmup" in response.json["timings"]
+
+
+@mock.patch("emotion_detector.model_loader")
+def test_readiness_route_while_loading(mock_loader):
+    """Test that /readyz refuses traffic until the model is warm"""
+    mock_loader.ready.return_value = False
+    mock_loader.status = "loading"
+    mock_loader.timings = {}
+    mock_loader.error = None
+    app = create_flask_app()
+
+    with app.test_client() as client:
+        response = client.get("/readyz")
+
+    assert response.status_code == 503
+    assert response.json["status"] == "loading"
+
+
+def test_claim_job_leases_oldest_available_job():
+    """Test that claiming is one atomic find_one_and_update with a lease"""
+    jobs = mock.MagicMock()
+
+    claim_job(jobs, "worker-1", lease_seconds=30, max_attempts=3)
+
+    query, update = jobs.find_one_and_update.call_args[0]
+    kwargs = jobs.find_one_and_update.call_args[1]
+    assert {"status": "queued"} in query["$or"]
+    assert query["attempts"] == {"$lt": 3}
+    assert update["$set"]["status"] == "running"
+    assert update["$set"]["worker"] == "worker-1"
+    assert update["$inc"] == {"attempts": 1}
+    assert kwargs["sort"] == [("createdAt", 1)]
+
+
+@pytest.mark.parametrize("attempts, status", [(1, "queued"), (3, "failed")])
+def test_fail_job_retries_until_attempts_used(attempts, status):
+    """Test that failed jobs are requeued until they run out of attempts"""
+    jobs = mock.MagicMock()
+    job = {"_id": ObjectId(), "worker": "worker-1", "attempts": attempts}
+
+    fail_job(jobs, job, "boom", max_attempts=3)
+
+    assert jobs.update_one.call_args[0][1]["$set"]["status"] == status
+
+
+def test_complete_job_requires_lease():
+    """Test that a worker that lost its lease does not overwrite the result"""
+    jobs = mock.MagicMock()
+    jobs.update_one.return_value.modified_count = 0
+    job = {"_id": ObjectId(), "worker": "worker-1", "attempts": 1}
+
+    assert not complete_job(jobs, job, {"emotion": "sad"})
+    query = jobs.update_one.call_args[0][0]
+    assert query["worker"] == "worker-1" and query["status"] == "running"
+
+
+@mock.patch("worker.complete_job")
+@mock.patch("worker.classify_stored_file")
+@mock.patch("worker.claim_job")
+def test_worker_processes_claimed_job(mock_claim, mock_classify, mock_complete):
+    """Test that a worker classifies the claimed recording and stores the result"""
+    file_id = ObjectId()
+    job = {"_id": ObjectId(), "fileId": file_id, "worker": "w", "attempts": 1}
+    mock_claim.return_value = job
+    mock_classify.return_value = {"emotion": "happy", "cached": False}
+
+    assert worker.process_one("w")
+
+    mock_classify.assert_called_once_with(file_id, None)
+    mock_complete.assert_called_once_with(
+        worker.jobs, job, {"emotion": "happy", "cached": False}
+    )
+
+
+@mock.patch("worker.fail_job")
+@mock.patch("worker.classify_stored_file")
+@mock.patch("worker.claim_job")
+def test_worker_requeues_failed_job(mock_claim, mock_classify, mock_fail):
+    """Test that an inference error is recorded for a retry"""
+    job = {"_id": ObjectId(), "fileId": ObjectId(), "worker": "w", "attempts": 1}
+    mock_claim.return_value = job
+    mock_classify.side_effect = RuntimeError("decode failed")
+
+    assert worker.process_one("w")
+
+    mock_fail.assert_called_once_with(worker.jobs, job, "decode failed", 3)
+
+
+@mock.patch("worker.renew_lease")
+@mock.patch("worker.complete_job")
+@mock.patch("worker.classify_stored_file")
+@mock.patch("worker.claim_job")
+def test_worker_renews_lease_while_classifying(
+    mock_claim, mock_classify, _mock_complete, mock_renew
+):
+    """Test that a job slower than its lease keeps it until it is done"""
+    job = {"_id": ObjectId(), "fileId": ObjectId(), "worker": "w", "attempts": 1}
+    mock_claim.return_value = job
+    mock_classify.side_effect = lambda *_: time.sleep(0.2) or {"emotion": "sad"}
+    mock_renew.return_value = True
+
+    with mock.patch("worker.JOB_LEASE_SECONDS", 0.06):
+        assert worker.process_one("w")
+        renewals = mock_renew.call_count
+        time.sleep(0.1)
+
+    assert renewals >= 2
+    assert mock_renew.call_count == renewals
+    mock_renew.assert_called_with(worker.jobs, job, 0.06)
+
+
+def test_renew_lease_requires_lease():
+    """Test that a worker that lost its lease cannot extend it"""
+    jobs = mock.MagicMock()
+    jobs.update_one.return_value.modified_count = 0
+    job = {"_id": ObjectId(), "worker": "worker-1", "attempts": 1}
+
+    assert not renew_lease(jobs, job, 30)
+    query, update = jobs.update_one.call_args[0]
+    assert query["worker"] == "worker-1" and query["status"] == "running"
+    assert "leaseUntil" in update["$set"]
+
+
+@mock.patch("worker.claim_job")
+def test_worker_idle_when_queue_empty(mock_claim):
+    """Test that an empty queue is reported so the worker can sleep"""
+    mock_claim.return_value = None
+
+    assert not worker.process_one("w")
+
+
+def test_length_buckets_group_similar_lengths():
+    """Test that backfill batches clips in order of length"""
+    speeches = [np.zeros(n) for n in (50, 10, 40, 20, 30)]
+
+    assert backfill.length_buckets(speeches, 2) == [[1, 3], [4, 2], [0]]
+
+
+@mock.patch("backfill.trim_speech", side_effect=lambda speech: speech)
+@mock.patch("backfill.classify_speech_windowed")
+@mock.patch("backfill.embed_emotions_batch")
+def test_backfill_classify_page(mock_batch, mock_windowed, _mock_trim):
+    """Test that long clips are windowed and undecodable ones are skipped"""
+    mock_batch.side_effect = lambda batch: [
+        (f"len{len(clip)}", len(clip)) for clip in batch
+    ]
+    mock_windowed.return_value = ("sad", [])
+    long_clip = np.zeros(int(backfill.WINDOWED_MIN_SECONDS * 16000) + 1)
+    speeches = [np.zeros(300), None, long_clip, np.zeros(100), np.zeros(200)]
+
+    emotions, embeddings, no_speech = backfill.classify_page(speeches, batch_size=2)
+
+    assert emotions == ["len300", None, "sad", "len100", "len200"]
+    assert embeddings == [300, None, None, 100, 200]
+    assert no_speech == 0
+    assert [len(call.args[0]) for call in mock_batch.call_args_list] == [2, 1]
+
+
+@mock.patch("backfill.embed_emotions_batch")
+def test_backfill_classify_page_trims_silence_like_live_path(mock_batch):
+    """Test that backfill classifies the speech the live service would"""
+    mock_batch.side_effect = lambda batch: [("sad", len(clip)) for clip in batch]
+    speech = make_recording(1, 0)
+    padded = np.concatenate([np.zeros(2 * 16000, dtype=np.float32), speech])
+    silent = np.zeros(16000, dtype=np.float32)
+
+    emotions, embeddings, no_speech = backfill.classify_page(
+        [padded, silent], batch_size=2
+    )
+
+    assert emotions == ["sad", None]
+    assert no_speech == 1
+    assert embeddings[0] == len(trim_speech(padded)) < len(padded)
+    assert [len(clip) for clip in mock_batch.call_args[0][0]] == [embeddings[0]]
+
+
+@mock.patch("backfill.index_stored", return_value=0)
+@mock.patch("backfill.reclassify_from_embeddings", return_value=0)
+@mock.patch("backfill.model_loader")
+@mock.patch("backfill.read_pages")
+@mock.patch("backfill.checkpoints")
+def test_backfill_resumes_after_checkpoint(
+    mock_checkpoints, mock_pages, mock_loader, _mock_embeddings, _mock_index
+):
+    """Test that a rerun only scans past the last checkpointed file"""
+    last_id = ObjectId()
+    mock_checkpoints.find_one.return_value = {"lastId": last_id}
+    mock_pages.return_value = iter([])
+    options = {
+        "page_size": 10,
+        "batch_size": 4,
+        "decoders": 1,
+        "limit": 0,
+        "restart": False,
+    }
+
+    assert backfill.run(options) == {
+        "from_embeddings": 0,
+        "classified": 0,
+        "no_speech": 0,
+        "failed": 0,
+        "indexed": 0,
+    }
+    mock_pages.assert_called_once_with(last_id, 10, 0)
+    mock_loader.get.assert_not_called()
+    assert backfill.stale_query("v2", last_id) == {
+        "modelVersion": {"$ne": "v2"},
+        "compactedFrom": {"$exists": False},
+        "audioDeletedAt": {"$exists": False},
+        "_id": {"$gt": last_id},
+    }
+
+
+def test_stale_query_skips_compaction_copies_and_pruned_audio():
+    """Test that backfill leaves compaction leftovers and pruned audio alone"""
+    files = mongomock.MongoClient().db.fs.files
+    stale, copy, pruned = ObjectId(), ObjectId(), ObjectId()
+    files.insert_many(
+        [
+            {"_id": stale, "modelVersion": "v1"},
+            {"_id": copy, "compactedFrom": stale},
+            {"_id": pruned, "audioDeletedAt": datetime.datetime(2024, 1, 1)},
+            {"_id": ObjectId(), "modelVersion": "v2"},
+        ]
+    )
+
+    def matched(**kwargs):
+        return [doc["_id"] for doc in files.find(backfill.stale_query("v2", **kwargs))]
+
+    assert matched() == [stale]
+    assert matched(need_audio=False) == [stale, pruned]
+
+
+@pytest.mark.parametrize(
+    "backend_name, tolerance", [("eager", 1e-4), ("int8", 1e-2), ("onnx", 1e-4)]
+)
+def test_head_on_embeddings_matches_full_model(backend_name, tolerance, tmp_path):
+    """Test that the stored embedding reproduces the logits through the head"""
+    if backend_name == "onnx":
+        pytest.importorskip("onnxruntime")
+    model = _tiny_model()
+    backend = load_backend(backend_name, model, str(tmp_path / "model.onnx"))
+    input_values, attention_mask = pad_batch(
+        [
+            np.random.default_rng(0).standard_normal(n).astype(np.float32)
+            for n in (16000, 9000)
+        ]
+    )
+
+    logits, embeddings = backend.embed(input_values, attention_mask=attention_mask)
+    stored = decode_embedding(encode_embedding(embeddings[1].numpy()))
+
+    expected = backend(input_values, attention_mask=attention_mask)
+    torch.testing.assert_close(logits, expected, atol=tolerance, rtol=tolerance)
+    assert embeddings.shape == (2, TINY_MODEL_CONFIG["hidden_size"])
+    assert len(encode_embedding(embeddings[1].numpy())) == 2 * embeddings.shape[1]
+    head_logits = backend.head(torch.from_numpy(stored).unsqueeze(0))
+    torch.testing.assert_close(head_logits[0], expected[1], atol=1e-2, rtol=1e-2)
+
+
+@mock.patch("backfill.write_results")
+@mock.patch("backfill.classify_embeddings")
+@mock.patch("backfill.embedding_store")
+@mock.patch("backfill.stale_pages")
+def test_backfill_reclassifies_from_stored_embeddings(
+    mock_pages, mock_store, mock_classify, mock_write
+):
+    """Test that recordings with an embedding skip decoding entirely"""
+    with_embedding, without, no_digest = ObjectId(), ObjectId(), ObjectId()
+    mock_pages.return_value = iter(
+        [
+            [
+                {"_id": with_embedding, "sha256": "a"},
+                {"_id": without, "sha256": "b"},
+                {"_id": no_digest},
+            ]
+        ]
+    )
+    mock_store.get_many.return_value = {"a": np.ones(4, dtype=np.float32)}
+    mock_classify.return_value = ["happy"]
+
+    assert backfill.reclassify_from_embeddings(page_size=10) == 1
+    mock_pages.assert_called_once_with(None, 10, need_audio=False)
+    mock_store.get_many.assert_called_once_with(["a", "b"])
+    assert mock_classify.call_args[0][0].shape == (1, 4)
+    mock_write.assert_called_once_with(
+        [
+            {
+                "_id": with_embedding,
+                "emotion": "happy",
+                "modelId": MODEL_ID,
+                "modelVersion": MODEL_VERSION,
+            }
+        ]
+    )
+
+
+def test_rollup_updates_move_reclassified_recordings():
+    """Test that rollups count new recordings once and move reclassified ones"""
+    hour = datetime.datetime(2024, 5, 1, 9, 0)
+    changes = [
+        (hour.replace(minute=5), None, "sad"),
+        (hour.replace(minute=50), None, "sad"),
+        (hour.replace(minute=30), "sad", "happy"),
+        (hour.replace(hour=10), "angry", "angry"),
+    ]
+
+    assert rollup_updates(changes) == [
+        UpdateOne(
+            {"_id": hour.replace(tzinfo=datetime.timezone.utc)},
+            {"$inc": {"total": 2, "counts.sad": 1, "counts.happy": 1}},
+            upsert=True,
+        )
+    ]
+
+
+@mock.patch("emotion_detector.result_writes")
+@mock.patch("emotion_detector.classify_recording")
+@mock.patch("emotion_detector.fs")
+def test_classify_stored_file_queues_result(_mock_fs, mock_classify, mock_writes):
+    """Test that the emotion is queued to be saved, not written in the request"""
+    file_id = ObjectId()
+    mock_classify.return_value = {"emotion": "happy", "cached": False}
+
+    classify_stored_file(file_id)
+
+    mock_writes.put.assert_called_once_with(
+        {
+            "_id": file_id,
+            "emotion": "happy",
+            "modelId": "default",
+            "modelVersion": MODEL_VERSION,
+        }
+    )
+
+
+@mock.patch("emotion_detector.record_emotions")
+@mock.patch("emotion_detector.result_files")
+@mock.patch("emotion_detector.db")
+def test_write_results_bulk_writes_and_updates_rollups(
+    mock_db, mock_files, mock_record
+):
+    """Test that a batch is one bulk_write that also moves the rollup counts"""
+    uploaded = datetime.datetime(2024, 5, 1, 9, 30)
+    file_id = ObjectId()
+    mock_db.fs.files.find.return_value = [
+        {"_id": file_id, "emotion": "sad", "uploadDate": uploaded}
+    ]
+    results = [
+        {"_id": file_id, "emotion": emotion, "modelId": "default"}
+        for emotion in ("angry", "happy")
+    ]
+
+    write_results(results + [{"_id": ObjectId(), "emotion": "sad"}])
+
+    operations = mock_files.bulk_write.call_args[0][0]
+    assert len(operations) == 2
+    assert operations[0]._doc == {  # pylint: disable=protected-access
+        "$set": {"emotion": "happy", "modelId": "default"}
+    }
+    assert mock_record.call_args[0][1] == [(uploaded, "sad", "happy")]
+
+
+def test_write_buffer_batches_retries_and_drains_on_close():
+    """Test that writes are flushed in batches, retried and drained on close"""
+    batches = []
+    failures = [OperationFailure("not primary")]
+
+    def flush_batch(writes):
+        if failures:
+            raise failures.pop()
+        batches.append(writes)
+
+    buffer = WriteBuffer(flush_batch, max_batch_size=3, max_wait_ms=20)
+    with mock.patch("write_buffer.RETRY_SECONDS", 0.01):
+        for write in range(5):
+            buffer.put(write)
+        assert buffer.flush(timeout=5)
+        buffer.put(5)
+        assert buffer.close()
+
+    assert [write for batch in batches for write in batch] == list(range(6))
+    assert max(len(batch) for batch in batches) == 3
+    assert len(buffer) == 0
+    with pytest.raises(RuntimeError):
+        buffer.put(6)
+
+
+def test_benchmark_fixtures_are_distinct_and_reproducible():
+    """Test that each run gets new audio and a rerun gets the same audio"""
+    first = make_fixtures(("wav", 1.0), 2, 0)
+    shifted = make_fixtures(("wav", 1.0), 2, 1)
+
+    assert first == make_fixtures(("wav", 1.0), 2, 0)
+    assert first[1] == shifted[0]
+    assert first[0] not in shifted
+    assert len(decode_audio(first[0], 16000)) == 16000
+
+
+def test_benchmark_flags_regressions():
+    """Test that only metrics worse than the tolerance are reported"""
+    baseline = [
+        {
+            "stage": "ml.classify",
+            "format": "wav",
+            "seconds": 2.0,
+            "concurrency": 8,
+            "throughput": 100.0,
+            "p95_ms": 50.0,
+        }
+    ]
+    slower = dict(baseline[0], throughput=70.0, p95_ms=55.0)
+    unmatched = dict(baseline[0], concurrency=1, throughput=1.0)
+
+    regressions = find_regressions([slower, unmatched], baseline, 0.2)
+
+    assert regressions == ["ml.classify wav/2.0s x8: throughput 100.0 -> 70.0 req/s"]
+
+
+def test_metrics_route_counts_requests_by_outcome():
+    """Test that /metrics reports request outcomes and stage histograms"""
+    labels = {"route": "/detect-emotion", "outcome": "client_error"}
+    before = REGISTRY.get_sample_value("ml_requests_total", labels) or 0
+    in_flight = REGISTRY.get_sample_value("ml_requests_in_flight")
+    app = create_flask_app()
+
+    with app.test_client() as client:
+        client.post("/detect-emotion", json={})
+        response = client.get("/metrics")
+
+    assert response.status_code == 200
+    assert response.content_type.startswith("text/plain")
+    assert REGISTRY.get_sample_value("ml_requests_total", labels) == before + 1
+    body = response.get_data(as_text=True)
+    assert 'ml_stage_seconds_bucket{le="0.001",stage="decode"}' in body
+    assert "ml_model_memory_bytes" in body
+    assert REGISTRY.get_sample_value("ml_requests_in_flight") == in_flight
+
+
+def test_scheduler_reports_queue_wait():
+    """Test that the scheduler reports how long each request was queued"""
+    waits = []
+    scheduler = MicroBatchScheduler(
+        lambda speeches: ["label"] * len(speeches),
+        max_batch_size=3,
+        max_wait_ms=200,
+        observe_wait=waits.append,
+    )
+    futures = [scheduler.submit(np.zeros(10, dtype=np.float32)) for _ in range(3)]
+
+    assert [future.result(timeout=5) for future in futures] == ["label"] * 3
+    assert len(waits) == 3
+    assert all(0 <= wait < 5 for wait in waits)
+
+
+def test_model_bytes_counts_quantized_weights():
+    """Test that model memory counts int8 packed weights at one byte each"""
+    model = torch.nn.Sequential(torch.nn.Linear(64, 64))
+    quantized = torch.ao.quantization.quantize_dynamic(
+        model, {torch.nn.Linear}, dtype=torch.qint8
+    )
+
+    assert model_bytes(model) == (64 * 64 + 64) * 4
+    assert 64 * 64 < model_bytes(quantized) < model_bytes(model)
+
+
+def test_trim_silence_drops_silence_and_long_pauses():
+    """Test that VAD keeps speech and short pauses but drops long silences"""
+    rng = np.random.default_rng(0)
+
+    def silence(seconds):
+        return (rng.standard_normal(int(seconds * 16000)) * 0.001).astype(np.float32)
+
+    speech = make_recording(2, 1)
+    recording = np.concatenate(
+        (silence(3), speech, silence(0.3), speech, silence(4), speech, silence(3))
+    )
+
+    trimmed = trim_silence(recording, {"pad_ms": 100, "max_pause_ms": 500})
+
+    # 4.3 s of speech with its short pause, then 2 s, each padded by 0.1 s
+    assert 6.6 < len(trimmed) / 16000 < 6.8
+    assert trim_silence(speech) is speech
+    with pytest.raises(NoSpeechError):
+        trim_silence(silence(5))
+    with pytest.raises(NoSpeechError):
+        trim_silence(np.zeros(100, dtype=np.float32))
+
+
+@mock.patch("emotion_detector.scheduler")
+@mock.patch("emotion_detector.result_cache")
+def test_classify_route_rejects_silence_without_model(mock_cache, mock_scheduler):
+    """Test that /classify answers 422 for a silent recording, skipping the model"""
+    buffer = BytesIO()
+    soundfile.write(buffer, np.zeros(16000, dtype=np.float32), 16000, format="WAV")
+    mock_cache.get.return_value = None
+
+    with create_flask_app().test_client() as client:
+        response = client.post("/classify", data=buffer.getvalue())
+
+    assert response.status_code == 422
+    mock_scheduler.classify.assert_not_called()
+    mock_cache.put.assert_not_called()
+
+
+def test_admission_sheds_when_full_or_past_deadline():
+    """Test that admission bounds the queue and predicts wait from audio length"""
+    admission = AdmissionController(max_pending=1, max_wait=30, cost=1.0)
+
+    with admission.admit(2.0, time.monotonic() + 10):
+        assert admission.estimate(1.0) == 3.0
+        with pytest.raises(Overloaded) as full:
+            with admission.admit(1.0):
+                pass
+    with pytest.raises(Overloaded) as late:
+        with admission.admit(5.0, time.monotonic() + 2):
+            pass
+
+    assert (full.value.status, full.value.retry_after) == (503, 2)
+    assert late.value.status == 429 and late.value.retry_after >= 3
+    assert admission.stats()["pending"] == 0
+    admission.observe(4.0, 2.0)
+    assert admission.cost == pytest.approx(0.9)
+    assert admission.deadline(120) > time.monotonic() + 110
+    assert admission.deadline() <= time.monotonic() + 30
+
+
+def test_scheduler_drops_requests_past_deadline():
+    """Test that queued requests whose deadline passed never reach the model"""
+    batches = []
+    scheduler = MicroBatchScheduler(
+        lambda speeches: batches.append(len(speeches)) or ["label"] * len(speeches),
+        max_batch_size=2,
+        max_wait_ms=200,
+    )
+    expired = scheduler.submit(np.zeros(10, dtype=np.float32), time.monotonic() - 1)
+    live = scheduler.submit(np.zeros(10, dtype=np.float32), time.monotonic() + 60)
+
+    assert live.result(timeout=5) == "label"
+    with pytest.raises(DeadlineExceeded):
+        expired.result(timeout=5)
+    assert batches == [1]
+
+
+@mock.patch("emotion_detector.scheduler")
+@mock.patch("emotion_detector.result_cache")
+@mock.patch("emotion_detector.admission")
+def test_classify_route_sheds_load_with_retry_after(
+    mock_admission, mock_cache, mock_scheduler
+):
+    """Test that /classify fails fast with Retry-After when it cannot keep up"""
+    buffer = BytesIO()
+    soundfile.write(buffer, make_recording(1, 0), 16000, format="WAV")
+    mock_cache.get.return_value = None
+    mock_admission.admit.side_effect = Overloaded("busy", 429, 3)
+
+    with create_flask_app().test_client() as client:
+        shed = client.post(
+            "/classify", data=buffer.getvalue(), headers={"X-Request-Timeout": "5"}
+        )
+        invalid = client.post(
+            "/classify", data=buffer.getvalue(), headers={"X-Request-Timeout": "-1"}
+        )
+
+    assert shed.status_code == 429
+    assert shed.headers["Retry-After"] == "3"
+    mock_admission.deadline.assert_called_once_with(5.0)
+    mock_scheduler.classify.assert_not_called()
+    assert invalid.status_code == 400
+
+
+@mock.patch("emotion_detector.classify_speech_windowed")
+@mock.patch("emotion_detector.result_cache")
+@mock.patch("emotion_detector.admission", AdmissionController(max_wait=30, cost=0.25))
+def test_classify_route_admits_long_recording_within_client_timeout(
+    mock_cache, mock_windowed
+):
+    """Test that a client's timeout longer than the default is honoured"""
+    data = encode_recording(make_recording(150, 0), "wav")
+    mock_cache.get.return_value = None
+    mock_windowed.return_value = ("sad", [])
+
+    with create_flask_app().test_client() as client:
+        response = client.post(
+            "/classify", data=data, headers={"X-Request-Timeout": "100"}
+        )
+
+    assert response.status_code == 200
+    assert response.json["emotion"] == "sad"
+
+
+@pytest.fixture(name="mock_gridfs")
+def fixture_mock_gridfs():
+    """An in-memory GridFS standing in for storage.py's database"""
+    mongomock.gridfs.enable_gridfs_integration()
+    database = mongomock.MongoClient()["audio-analysis"]
+    grid = gridfs.GridFS(database)
+    with mock.patch("storage.db", database), mock.patch("storage.fs", grid):
+        yield database, grid
+
+
+def test_compact_reencodes_and_prune_keeps_results(mock_gridfs):
+    """Test that compaction shrinks audio in place and pruning keeps emotions"""
+    database, grid = mock_gridfs
+    speech = make_recording(2, 0)
+    upload = encode_recording(speech, "wav")
+    file_id = grid.put(upload, filename="recordings/abc", sha256="abc", emotion="sad")
+    uploaded = database.fs.files.find_one({"_id": file_id})["uploadDate"]
+
+    totals = storage.compact("flac")
+    document = database.fs.files.find_one({"_id": file_id})
+
+    assert totals["compacted"] == 1
+    assert totals["bytes_after"] < totals["bytes_before"] == len(upload)
+    assert document["emotion"] == "sad" and document["sha256"] == "abc"
+    assert document["filename"] == "recordings/abc.flac"
+    assert (document["codec"], document["durationSeconds"]) == ("flac", 2.0)
+    assert document["uploadDate"] == uploaded
+    stored = decode_audio(grid.get(file_id).read(), 16000)
+    assert np.allclose(stored, speech, atol=1e-4)
+    assert storage.compact("flac")["compacted"] == 0
+
+    later = uploaded.replace(tzinfo=None) + datetime.timedelta(days=31)
+    assert storage.prune(30, now=later)["pruned"] == 1
+    assert grid.get(file_id).read() == b""
+    assert database.fs.files.find_one({"_id": file_id})["emotion"] == "sad"
+    assert database.fs.chunks.count_documents({"files_id": file_id}) == 0
+
+
+def test_compact_recovers_interrupted_swap(mock_gridfs):
+    """Test that a compaction stopped mid-swap is finished by the next run"""
+    database, grid = mock_gridfs
+    file_id, stored_id = ObjectId(), ObjectId()
+    uploaded = datetime.datetime(2024, 5, 1, 12, 30)
+    original = {"emotion": "happy", "sha256": "abc", "codec": "flac"}
+    grid.put(
+        b"flac", compactedFrom=file_id, original=original, originalUploadDate=uploaded
+    )
+    # Stopped after the recording was stored again, before its date was set
+    grid.put(b"flac", _id=stored_id, **original)
+    grid.put(
+        b"flac", compactedFrom=stored_id, original=original, originalUploadDate=uploaded
+    )
+
+    assert storage.recover() == 1
+    assert grid.get(file_id).read() == b"flac"
+    assert grid.get(file_id).emotion == "happy"
+    assert database.fs.files.count_documents({"compactedFrom": {"$exists": True}}) == 0
+    for recording_id in (file_id, stored_id):
+        assert grid.get(recording_id).upload_date.replace(tzinfo=None) == uploaded
+
+
+def test_model_registry_evicts_least_recently_used():
+    """Test that loading past the budget unloads the oldest unpinned model"""
+    calls = []
+
+    def factory(model_id):
+        def load(_previous):
+            calls.append(model_id)
+            return {"id": model_id, "bytes": 100}
+
+        return ModelLoader([("weights", load)])
+
+    registry = ModelRegistry(
+        factory,
+        ["default", "fr", "de"],
+        budget_bytes=250,
+        pinned=("default",),
+        measure=lambda backend: backend["bytes"],
+    )
+
+    for model_id in ("default", "fr", "de", "fr", "default"):
+        assert registry.get(model_id)["id"] == model_id
+    stats = registry.stats()
+
+    assert calls == ["default", "fr", "de", "fr"]
+    assert stats["residentBytes"] == 200
+    assert stats["models"]["de"]["status"] == "not_loaded"
+    assert stats["models"]["de"]["evictions"] == 1
+    assert stats["models"]["fr"]["loads"] == 2
+    assert stats["models"]["default"]["evictions"] == 0
+    with pytest.raises(UnknownModel):
+        registry.get("es")
+
+
+@mock.patch.dict("emotion_detector.EXTRA_MODELS", {"fr": "org/emotion-fr"})
+@mock.patch("emotion_detector.result_cache")
+def test_classify_route_picks_model_by_header(mock_cache):
+    """Test that X-Model routes a recording to that model and stamps its id"""
+    served = {
+        "id": "fr",
+        "version": "org/emotion-fr:v1",
+        "result_cache": mock.MagicMock(),
+        "embedding_store": mock.MagicMock(),
+        "scheduler": mock.MagicMock(),
+    }
+    served["result_cache"].get.return_value = None
+    served["scheduler"].classify.return_value = ("happy", None)
+    buffer = BytesIO()
+    soundfile.write(buffer, make_recording(1, 0), 16000, format="WAV")
+    app = create_flask_app()
+
+    with mock.patch.dict("emotion_detector.extra_served", {"fr": served}), mock.patch(
+        "emotion_detector.models", ModelRegistry(None, ["default", "fr"])
+    ), app.test_client() as client:
+        response = client.post(
+            "/classify", data=buffer.getvalue(), headers={"X-Model": "fr"}
+        )
+        unknown = client.post(
+            "/classify", data=buffer.getvalue(), headers={"X-Model": "es"}
+        )
+
+    assert response.status_code == 200
+    assert response.json["modelId"] == "fr"
+    assert response.json["modelVersion"] == "org/emotion-fr:v1"
+    served["result_cache"].put.assert_called_once()
+    mock_cache.get.assert_not_called()
+    assert unknown.status_code == 400
+
+
+def test_embedding_index_shares_appends_between_processes(tmp_path):
+    """Test that rows appended by one index are searched by another"""
+    writer = EmbeddingIndex(str(tmp_path), "encoder", EMOTION_LABELS, block_rows=3)
+    reader = EmbeddingIndex(str(tmp_path), "encoder", EMOTION_LABELS, block_rows=3)
+    ids = [ObjectId() for _ in range(5)]
+    vectors = np.eye(5, 8)
+    vectors[1, 0] = 0.5
+    writer.add_many(zip(ids, vectors, ["happy", "happy", "sad", "sad", None]))
+    writer.add(ids[4], vectors[0], "happy")
+
+    nearest = reader.search([vectors[0], vectors[2]], k=2, exclude=[ids[0]])
+
+    assert len(reader) == 5
+    assert [n["fileId"] for n in nearest[0]] == [str(ids[4]), str(ids[1])]
+    assert nearest[1][0] == {
+        "fileId": str(ids[2]),
+        "emotion": "sad",
+        "score": pytest.approx(1.0, abs=1e-3),
+    }
+    assert vote(nearest[0]) == ("happy", 1.0)
+    unknown = ObjectId()
+    assert reader.relabel_many([(ids[2], "angry"), (unknown, "sad")]) == [unknown]
+    assert writer.search(vectors[2], k=1)[0][0]["emotion"] == "angry"
+    assert EmbeddingIndex(str(tmp_path), "encoder", []).search(vectors, k=0)[0] == []
+
+
+@mock.patch("emotion_detector.classify_stored_file")
+def test_similar_route_and_knn_fallback(mock_classify, tmp_path):
+    """Test /similar, and that a shed recording is answered by its neighbours"""
+    index = EmbeddingIndex(str(tmp_path), "encoder", EMOTION_LABELS)
+    ids = [ObjectId() for _ in range(4)]
+    index.add_many(
+        zip(ids, np.eye(4) + 0.5, ["happy", "sad", "sad", "sad"]),
+    )
+    mock_classify.side_effect = Overloaded("Too busy", 503, 2)
+    app = create_flask_app()
+
+    with mock.patch(
+        "emotion_detector.similarity_index", index
+    ), app.test_client() as client:
+        similar = client.post("/similar", json={"fileId": str(ids[0]), "k": 2})
+        too_many = client.post("/similar", json={"fileId": str(ids[0]), "k": 500})
+        boolean = client.post("/similar", json={"fileId": str(ids[0]), "k": True})
+        shed = client.post("/detect-emotion", json={"fileId": str(ids[0])})
+        voted = client.post(
+            "/detect-emotion", json={"fileId": str(ids[1]), "mode": "knn"}
+        )
+
+    assert similar.status_code == 200
+    assert similar.json["indexed"] == 4
+    assert [n["emotion"] for n in similar.json["neighbours"]] == ["sad", "sad"]
+    assert similar.json["vote"] == {"emotion": "sad", "share": 1.0}
+    assert too_many.status_code == 400
+    assert boolean.status_code == 400
+    assert shed.status_code == 200
+    assert shed.json["emotion"] == "sad"
+    assert shed.json["source"] == "knn"
+    assert voted.json["emotion"] == "sad"
+    assert mock_classify.call_count == 1
+
+
+@pytest.mark.parametrize("stable", [True, False])
+def test_early_exit_matches_full_model_and_exits_when_sure(stable, tmp_path):
+    """Test that fast mode runs the model's layers and stops at a sure probe"""
+    torch.manual_seed(0)
+    config = Wav2Vec2Config(**{**TINY_MODEL_CONFIG, "do_stable_layer_norm": stable})
+    model = Wav2Vec2ForSequenceClassification(config).eval()
+    speeches = [make_recording(1 + seed % 3, seed) for seed in range(12)]
+    probes, agreement = fit_probes(model, speeches, "tiny")
+    input_values = torch.from_numpy(speeches[0]).unsqueeze(0)
+    expected = torch.softmax(load_backend("eager", model)(input_values)[0], -1)
+
+    label, confidence, layer = probes.classify(model, input_values, 1.01)
+
+    assert probes.layers == [1]
+    assert 0 <= agreement[1] <= 1
+    assert (label, layer) == (expected.argmax().item(), 2)
+    assert confidence == pytest.approx(expected.max().item(), abs=1e-5)
+    assert probes.classify(model, input_values, 0.0)[2] == 1
+    probes.save(str(tmp_path / "probes.pt"))
+    assert ExitProbes.load(str(tmp_path / "probes.pt"), "tiny").layers == [1]
+    assert ExitProbes.load(str(tmp_path / "probes.pt"), "other") is None
+
+
+@mock.patch("emotion_detector.models")
+@mock.patch("emotion_detector.early_exit")
+@mock.patch("emotion_detector.scheduler")
+@mock.patch("emotion_detector.result_cache")
+def test_classify_route_fast_mode_reports_exit_layer(
+    mock_cache, mock_scheduler, mock_early_exit, mock_models
+):
+    """Test that mode "fast" answers from a probe and is not cached"""
+    data = encode_recording(make_recording(1, 0), "wav")
+    mock_cache.get.return_value = None
+    mock_early_exit.classify.return_value = ("sad", 6)
+    mock_models.model_ids = ["default"]
+    app = create_flask_app()
+
+    with app.test_client() as client:
+        response = client.post("/classify?mode=fast", data=data)
+
+    assert response.status_code == 200
+    assert response.json["emotion"] == "sad"
+    assert response.json["exitLayer"] == 6
+    mock_scheduler.classify.assert_not_called()
+    mock_cache.put.assert_not_called()
+
+
+def test_collapsed_stacks_fold_call_graph_and_prune_keeps_newest(tmp_path):
+    """Test that profiles fold into caller-first stacks and old ones go"""
+
+    def inner():
+        return sum(range(200000))
+
+    def outer():
+        return inner() + inner()
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    outer()
+    profiler.disable()
+    for name in ("20260101T000000-a", "20260102T000000-b", "20260103T000000-c"):
+        for suffix in request_profiler.SUFFIXES:
+            (tmp_path / (name + suffix)).write_text("")
+
+    lines = request_profiler.collapsed_stacks(pstats.Stats(profiler))
+    request_profiler.prune(str(tmp_path), 2)
+
+    inner_lines = [line for line in lines if ":outer:" in line and ":inner:" in line]
+    assert inner_lines
+    stack, microseconds = inner_lines[0].rsplit(" ", 1)
+    assert stack.index(":outer:") < stack.index(":inner:")
+    assert int(microseconds) > 0
+    assert sorted(os.listdir(tmp_path)) == sorted(
+        name + suffix
+        for name in ("20260102T000000-b", "20260103T000000-c")
+        for suffix in request_profiler.SUFFIXES
+    )
+
+
+def test_profiling_is_not_installed_when_disabled():
+    """Test that with no token and no sampling requests are left alone"""
+    app = create_flask_app()
+
+    request_profiler.install(
+        app, {"directory": "unused", "token": "", "sample_rate": 0, "keep": 1}
+    )
+
+    assert all(
+        function.__module__ != "request_profiler"
+        for functions in app.before_request_funcs.values()
+        for function in functions
+    )
+
+
+@mock.patch("emotion_detector.embed_emotions_batch")
+@mock.patch("emotion_detector.embedding_store")
+@mock.patch("emotion_detector.scheduler")
+@mock.patch("emotion_detector.result_cache")
+def test_classify_route_profiles_requests_sending_the_token(
+    mock_cache, mock_scheduler, _mock_store, mock_embed, tmp_path
+):
+    """Test that a request with the profile token is profiled inline"""
+    data = encode_recording(make_recording(1, 0), "wav")
+    mock_cache.get.return_value = None
+    mock_scheduler.classify.return_value = ("sad", np.ones(4, dtype=np.float32))
+    mock_embed.return_value = [("happy", np.ones(4, dtype=np.float32))]
+    with mock.patch.multiple(
+        "emotion_detector", PROFILE_TOKEN="secret", PROFILE_DIR=str(tmp_path)
+    ):
+        app = create_flask_app()
+
+    with app.test_client() as client:
+        profiled = client.post(
+            "/classify", data=data, headers={request_profiler.PROFILE_HEADER: "secret"}
+        )
+        wrong = client.post(
+            "/classify", data=data, headers={request_profiler.PROFILE_HEADER: "guess"}
+        )
+        plain = client.post("/classify", data=data)
+
+    name = profiled.headers[request_profiler.PROFILE_ID_HEADER]
+    assert profiled.json["emotion"] == "happy"
+    assert sorted(os.listdir(tmp_path)) == sorted(
+        name + suffix for suffix in request_profiler.SUFFIXES
+    )
+    assert (
+        "emotion_detector.py:classify_recording:"
+        in (tmp_path / (name + ".collapsed")).read_text()
+    )
+    assert pstats.Stats(str(tmp_path / (name + ".pstats"))).total_tt > 0
+    assert request_profiler.PROFILE_ID_HEADER not in wrong.headers
+    assert request_profiler.PROFILE_ID_HEADER not in plain.headers
+    assert plain.json["emotion"] == "sad"
+    assert mock_scheduler.classify.call_count == 2
+    assert not request_profiler.active()
+
+
+@mock.patch.object(mongomock.Collection, "bulk_write", mongomock_bulk_write)
+def test_embedding_store_keeps_each_encoders_embedding_of_the_same_audio():
+    """Test that two encoders writing one digest do not replace each other"""
+    collection = mongomock.MongoClient().db.embeddings
+    default = EmbeddingStore(collection, "default")
+    french = EmbeddingStore(collection, "fr")
+    collection.insert_one(
+        {"_id": "old", "encoder": "default", "embedding": encode_embedding([3, 3])}
+    )
+
+    default.put("abc", np.array([1, 2], dtype=np.float32))
+    french.put("abc", np.array([4, 5], dtype=np.float32))
+
+    assert collection.count_documents({}) == 3
+    assert default.get_many(["abc", "old"])["abc"].tolist() == [1, 2]
+    assert default.get_many(["abc", "old"])["old"].tolist() == [3, 3]
+    assert list(french.get_many(["abc", "old"])) == ["abc"]
+    assert french.get_many(["abc"])["abc"].tolist() == [4, 5]
+
+
+@mock.patch("emotion_detector.classify_speech_windowed")
+def test_classify_route_windowed_repeats_are_not_served_from_cache(mock_windowed):
+    """Test that a repeated windowed request still gets its timeline"""
+    data = encode_recording(make_recording(1, 0), "wav")
+    timeline = [{"start": 0.0, "end": 1.0, "emotion": "sad"}]
+    mock_windowed.return_value = ("sad", timeline)
+    cache = ResultCache(mongomock.MongoClient().db.inference_cache, MODEL_VERSION)
+
+    with mock.patch("emotion_detector.result_cache", cache):
+        with create_flask_app().test_client() as client:
+            first = client.post("/classify?mode=windowed", data=data)
+            second = client.post(
+                "/classify?mode=windowed&aggregate=confidence", data=data
+            )
+
+    assert first.json["timeline"] == second.json["timeline"] == timeline
+    assert not second.json["cached"]
+    assert mock_windowed.call_args_list[1].args[1] == "confidence"
+    assert cache.get(hashlib.sha256(data).hexdigest()) is None
@@ -0,0 +1,132 @@
+"""Module for trimming silence from recordings before inference"""
+
+import numpy as np
+
+DEFAULTS = {
+    "sample_rate": 16000,
+    # Frames are short and do not overlap, so features are a single reshape
+    "frame_ms": 20,
+    # A frame is speech when it is louder than this many dBFS...
+    "threshold_db": -50.0,
+    # ...and within this many dB of the loudest frame in the recording
+    "relative_db": 40.0,
+    # Quieter frames still count when they cross zero this often, as
+    # fricatives like "s" and "f" do, but only if they also stand out from
+    # the background noise, which crosses zero just as often
+    "zcr_threshold": 0.25,
+    "zcr_margin_db": 10.0,
+    "noise_margin_db": 6.0,
+    # Kept around every stretch of speech, so onsets and decays survive
+    "pad_ms": 150,
+    # Pauses up to this long are kept whole; longer ones shrink to the padding
+    "max_pause_ms": 500,
+    # Recordings with less speech than this are rejected
+    "min_speech_ms": 100,
+}
+
+
+class NoSpeechError(ValueError):
+    """Raised for a recording with no speech in it, before any model call."""
+
+
+def frame_features(speech, frame_length):
+    """
+    Energy and zero-crossing rate of every whole frame of a waveform.
+    Args:
+        speech (np.ndarray): 1-D float32 waveform.
+        frame_length (int): Samples per frame.
+    Returns:
+        tuple: (energy_db, zcr), one value per frame. energy_db is the mean
+            power in dB relative to full scale; zcr is the fraction of
+            neighbouring samples that change sign.
+    """
+    count = len(speech) // frame_length
+    frames = speech[: count * frame_length].reshape(count, frame_length)
+    power = np.einsum("ij,ij->i", frames, frames, dtype=np.float64) / frame_length
+    energy_db = 10.0 * np.log10(power + 1e-10)
+    signs = np.signbit(frames)
+    zcr = np.count_nonzero(signs[:, 1:] != signs[:, :-1], axis=1) / frame_length
+    return energy_db, zcr
+
+
+def speech_frames(speech, options=None):
+    """
+    Decide which frames of a waveform to keep.
+    Args:
+        speech (np.ndarray): 1-D float32 waveform.
+        options (dict): Overrides for any of DEFAULTS.
+    Returns:
+        tuple: (keep, voiced), boolean arrays with one value per frame.
+            voiced marks the frames detected as speech; keep adds the
+            padding around them and the short pauses between them.
+    """
+    options = {**DEFAULTS, **(options or {})}
+    frame_ms = options["frame_ms"]
+    energy_db, zcr = frame_features(speech, _frame_length(options))
+    if energy_db.size == 0:
+        return np.zeros(0, dtype=bool), np.zeros(0, dtype=bool)
+    threshold = max(options["threshold_db"], energy_db.max() - options["relative_db"])
+    # The quietest tenth of the frames is taken as the background noise
+    noise_db = np.percentile(energy_db, 10)
+    voiced = (energy_db > threshold) | (
+        (
+            energy_db
+            > max(
+                threshold - options["zcr_margin_db"],
+                noise_db + options["noise_margin_db"],
+            )
+        )
+        & (zcr >= options["zcr_threshold"])
+    )
+
+    starts, ends = _runs(voiced)
+    pad = int(options["pad_ms"] // frame_ms)
+    short = starts[1:] - ends[:-1] <= options["max_pause_ms"] // frame_ms
+    # Every padded stretch of speech, plus the short pauses between them
+    keep = _cover(
+        len(voiced),
+        np.concatenate((starts - pad, ends[:-1][short])),
+        np.concatenate((ends + pad, starts[1:][short])),
+    )
+    return keep, voiced
+
+
+def trim_silence(speech, options=None):
+    """
+    Drop the silence before, after and in long pauses within a recording.
+    Args:
+        speech (np.ndarray): 1-D float32 waveform.
+        options (dict): Overrides for any of DEFAULTS.
+    Returns:
+        np.ndarray: The kept samples, or speech itself if all were kept.
+    Raises:
+        NoSpeechError: If the recording has less than min_speech_ms of speech.
+    """
+    options = {**DEFAULTS, **(options or {})}
+    keep, voiced = speech_frames(speech, options)
+    if np.count_nonzero(voiced) * options["frame_ms"] < options["min_speech_ms"]:
+        raise NoSpeechError("No speech detected in the recording")
+    if keep.all():
+        return speech
+    # The samples after the last whole frame go with that frame
+    mask = np.repeat(keep, _frame_length(options))
+    tail = np.full(len(speech) - len(mask), keep[-1])
+    return speech[np.concatenate((mask, tail))]
+
+
+def _frame_length(options):
+    return max(1, int(options["sample_rate"] * options["frame_ms"] / 1000))
+
+
+def _runs(mask):
+    # Start and end (exclusive) of every run of True
+    edges = np.flatnonzero(np.diff(mask, prepend=False, append=False))
+    return edges[0::2], edges[1::2]
+
+
+def _cover(length, starts, ends):
+    # Mark the union of [start, end) intervals, which may overlap
+    marks = np.zeros(length + 1, dtype=np.int32)
+    np.add.at(marks, np.clip(starts, 0, length), 1)
+    np.add.at(marks, np.clip(ends, 0, length), -1)
+    return np.cumsum(marks[:-1]) > 0
@@ -0,0 +1,92 @@
+"""Module for sliding-window inference over long recordings"""
+
+import numpy as np
+import torch
+
+AGGREGATIONS = ("mean", "confidence")
+
+
+def window_starts(length, window, hop):
+    """
+    Start offsets of overlapping windows covering a waveform.
+    The last window is aligned to the end of the clip so every sample is
+    covered and every window has the same length. Clips shorter than one
+    window get a single window over the whole clip.
+    Args:
+        length (int): Number of samples in the waveform.
+        window (int): Window length in samples.
+        hop (int): Distance between window starts in samples.
+    Returns:
+        list: Sample offsets where each window starts.
+    """
+    if length <= window:
+        return [0]
+    starts = list(range(0, length - window + 1, hop))
+    if starts[-1] + window < length:
+        starts.append(length - window)
+    return starts
+
+
+def classify_windowed(speech, predict_logits, labels, options):
+    """
+    Classify a long waveform window by window and combine the results.
+
+    Windows are run through the model batch_size at a time and their logits
+    are folded into a running sum, so memory used by the model stays bounded
+    by one batch of windows however long the recording is.
+    Args:
+        speech (np.ndarray): 1-D float32 waveform.
+        predict_logits (callable): Maps a (batch, samples) tensor to logits.
+        labels (list): Emotion label for each logit index.
+        options (dict): sample_rate, window_seconds, hop_seconds, batch_size
+            and aggregate ("mean" or "confidence").
+    Returns:
+        tuple: (emotion, timeline) where timeline lists the start and end
+            second, emotion and confidence of every window.
+    """
+    if options["aggregate"] not in AGGREGATIONS:
+        raise ValueError(f"aggregate must be one of {AGGREGATIONS}")
+    window = int(options["window_seconds"] * options["sample_rate"])
+    starts = window_starts(
+        len(speech),
+        window,
+        max(1, int(options["hop_seconds"] * options["sample_rate"])),
+    )
+
+    total = 0.0
+    total_weight = 0.0
+    timeline = []
+    for batch_starts, batch in _batches(speech, starts, window, options["batch_size"]):
+        logits = predict_logits(batch)
+        confidence, predicted = torch.softmax(logits, dim=-1).max(dim=-1)
+
+        weights = (
+            confidence
+            if options["aggregate"] == "confidence"
+            else torch.ones_like(confidence)
+        )
+        total = total + (logits * weights.unsqueeze(-1)).sum(dim=0)
+        total_weight += weights.sum().item()
+
+        timeline.extend(
+            {
+                "start": start / options["sample_rate"],
+                "end": min(start + window, len(speech)) / options["sample_rate"],
+                "emotion": labels[index],
+                "confidence": round(score, 4),
+            }
+            for start, index, score in zip(
+                batch_starts, predicted.tolist(), confidence.tolist()
+            )
+        )
+
+    return labels[int(torch.argmax(total / total_weight).item())], timeline
+
+
+def _batches(speech, starts, window, batch_size):
+    # Only batch_size windows are ever copied out of the waveform at once
+    for offset in range(0, len(starts), batch_size):
+        batch_starts = starts[offset : offset + batch_size]
+        yield batch_starts, torch.from_numpy(
+            np.stack([speech[start : start + window] for start in batch_starts])
+        )
@@ -0,0 +1,117 @@
+"""
+Worker that takes emotion detection jobs from the Mongo queue.
+
+The web app's /stop stores the recording and a job document, then returns
+at once. Any number of these workers, in any number of containers, claim
+jobs with a lease, classify the recording and write the emotion back to
+both the job and the fs.files document. The lease is renewed while the
+recording is classified, so a long one is not claimed twice, and a job
+whose worker dies is picked up again once its lease runs out. On SIGTERM
+each thread finishes its job and the emotions still waiting in
+result_writes are written.
+
+Usage:
+    python worker.py
+"""
+
+import os
+import signal
+import socket
+import threading
+
+from gridfs.errors import NoFile
+
+from emotion_detector import classify_stored_file, db, model_loader
+from job_queue import (
+    claim_job,
+    complete_job,
+    ensure_indexes,
+    expire_jobs,
+    fail_job,
+    renew_lease,
+)
+from vad import NoSpeechError
+
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "120"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "0.5"))
+# Several threads per worker let the micro-batcher group concurrent jobs
+JOB_WORKER_THREADS = int(os.getenv("JOB_WORKER_THREADS", "4"))
+
+jobs = db["jobs"]
+# Set to stop taking jobs
+stopping = threading.Event()
+
+
+def keep_leased(job, done):
+    """
+    Renew a job's lease every third of JOB_LEASE_SECONDS until done is set,
+    or until another worker has taken the job over.
+    """
+    while not done.wait(JOB_LEASE_SECONDS / 3):
+        if not renew_lease(jobs, job, JOB_LEASE_SECONDS):
+            return
+
+
+def process_one(worker_id):
+    """
+    Claim and run a single job.
+    Args:
+        worker_id (str): Identifies this thread as the lease holder.
+    Returns:
+        bool: Whether a job was found.
+    """
+    job = claim_job(jobs, worker_id, JOB_LEASE_SECONDS, JOB_MAX_ATTEMPTS)
+    if job is None:
+        return False
+    done = threading.Event()
+    threading.Thread(target=keep_leased, args=(job, done), daemon=True).start()
+    try:
+        result = classify_stored_file(job["fileId"], job.get("mode"))
+    except NoFile:
+        # Retrying cannot bring the recording back
+        fail_job(jobs, job, "Recording not found", max_attempts=0)
+        return True
+    except NoSpeechError as exc:
+        fail_job(jobs, job, str(exc), max_attempts=0)
+        return True
+    except Exception as exc:  # pylint: disable=broad-exception-caught
+        print(f"Job {job['_id']} failed on attempt {job['attempts']}: {exc}")
+        fail_job(jobs, job, str(exc), JOB_MAX_ATTEMPTS)
+        return True
+    finally:
+        done.set()
+    if complete_job(jobs, job, result):
+        print(f"Job {job['_id']} done:", result["emotion"])
+    return True
+
+
+def run(worker_id):
+    """Claim jobs until stopping, sleeping briefly whenever the queue is empty."""
+    while not stopping.is_set():
+        expire_jobs(jobs, JOB_MAX_ATTEMPTS)
+        if not process_one(worker_id):
+            stopping.wait(JOB_POLL_SECONDS)
+
+
+def main():
+    """Load the model, then run JOB_WORKER_THREADS job loops."""
+    ensure_indexes(jobs)
+    model_loader.get()
+    signal.signal(signal.SIGTERM, lambda *_: stopping.set())
+    prefix = f"{socket.gethostname()}-{os.getpid()}"
+    threads = [
+        threading.Thread(target=run, args=(f"{prefix}-{index}",), daemon=True)
+        for index in range(JOB_WORKER_THREADS)
+    ]
+    for thread in threads:
+        thread.start()
+    print(f"Worker {prefix} running {JOB_WORKER_THREADS} job threads")
+    for thread in threads:
+        thread.join()
+    # emotion_detector writes the emotions still waiting on the way out
+    print(f"Worker {prefix} stopped")
+
+
+if __name__ == "__main__":
+    main()
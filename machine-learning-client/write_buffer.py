@@ -0,0 +1,182 @@
+"""Module for writing classification results behind the requests that made them"""
+
+import threading
+import time
+from collections import deque
+
+from pymongo import WriteConcern
+from pymongo.errors import PyMongoError
+
+from metrics import RESULT_FLUSH_SECONDS, RESULT_WRITES_PENDING
+
+# Least time between attempts at a batch that failed
+RETRY_SECONDS = 0.5
+
+
+def write_concern(w, journal=False):
+    """
+    Args:
+        w (str): A number of nodes, "0" for unacknowledged writes, or a
+            mode such as "majority".
+        journal (bool): Whether writes wait for the journal.
+    Returns:
+        WriteConcern: The write concern for those settings.
+    """
+    return WriteConcern(w=int(w) if w.isdigit() else w, j=journal or None)
+
+
+class WriteBuffer:
+    """
+    Collects writes so a request can answer as soon as its result is known,
+    and applies them in batches.
+
+    A single thread, started on the first put, waits for the first write,
+    then flushes once max_batch_size writes are waiting or max_wait_ms has
+    passed since the first one arrived. A batch that fails with a
+    PyMongoError goes back to the front of the queue and is retried after
+    RETRY_SECONDS or max_wait_ms, whichever is longer, so a Mongo outage
+    delays results instead of losing them. Any other error would fail
+    again, so that batch is logged and dropped.
+    Once max_pending writes are waiting, put blocks until a flush makes
+    room. close writes whatever is left before the process exits.
+    """
+
+    def __init__(
+        self, flush_batch, max_batch_size=64, max_wait_ms=50.0, max_pending=10000
+    ):
+        """
+        Args:
+            flush_batch (callable): Applies a list of writes, in the order
+                they were put.
+            max_batch_size (int): Most writes per flush_batch call.
+            max_wait_ms (float): Longest time to hold a write while waiting
+                for others to join its batch.
+            max_pending (int): Most writes waiting before put blocks.
+        """
+        self.flush_batch = flush_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self.max_pending = max(self.max_batch_size, max_pending)
+        self._pending = deque()
+        self._condition = threading.Condition()
+        # The writes taken off _pending that flush_batch has not finished
+        # yet, whether close was called, and the thread that flushes
+        self._state = {"flushing": 0, "closed": False, "worker": None}
+
+    def __len__(self):
+        """Writes put and not yet applied."""
+        with self._condition:
+            return len(self._pending) + self._state["flushing"]
+
+    def put(self, write):
+        """
+        Queue one write.
+        Args:
+            write: Anything flush_batch accepts a list of.
+        Raises:
+            RuntimeError: If the buffer has been closed.
+        """
+        with self._condition:
+            if self._state["closed"]:
+                raise RuntimeError("The write buffer is closed")
+            self._ensure_worker()
+            while len(self._pending) >= self.max_pending:
+                self._condition.wait()
+            self._pending.append((write, time.monotonic()))
+            RESULT_WRITES_PENDING.inc()
+            self._condition.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        Wait until every write put so far has been applied.
+        Args:
+            timeout (float): Seconds to wait, None for no limit.
+        Returns:
+            bool: Whether nothing is left to write.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            self._condition.notify_all()
+            while self._pending or self._state["flushing"]:
+                if not self._worker_alive():
+                    # Nobody else is writing them, as after a fork
+                    self._ensure_worker()
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            return True
+
+    def close(self, timeout=30.0):
+        """
+        Refuse further writes, apply the ones waiting and stop the thread.
+        Args:
+            timeout (float): Seconds to keep retrying failed writes.
+        Returns:
+            bool: Whether every write was applied.
+        """
+        written = self.flush(timeout)
+        with self._condition:
+            self._state["closed"] = True
+            self._condition.notify_all()
+            left = len(self._pending) + self._state["flushing"]
+        if not written:
+            print(f"Gave up on {left} results that could not be written")
+        return written
+
+    def _worker_alive(self):
+        return self._state["worker"] is not None and self._state["worker"].is_alive()
+
+    def _ensure_worker(self):
+        # Caller holds _condition
+        if not self._worker_alive():
+            worker = threading.Thread(
+                target=self._run, name="write-buffer", daemon=True
+            )
+            worker.start()
+            self._state["worker"] = worker
+
+    def _collect(self):
+        # Waits for the first write, then for a full batch or max_wait
+        with self._condition:
+            while not self._pending:
+                if self._state["closed"]:
+                    return None
+                self._condition.wait()
+            deadline = self._pending[0][1] + self.max_wait
+            while (
+                len(self._pending) < self.max_batch_size and not self._state["closed"]
+            ):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            size = min(self.max_batch_size, len(self._pending))
+            batch = [self._pending.popleft() for _ in range(size)]
+            self._state["flushing"] = len(batch)
+            self._condition.notify_all()
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            started = time.perf_counter()
+            try:
+                self.flush_batch([write for write, _ in batch])
+            except PyMongoError as exc:
+                print(f"Failed to write {len(batch)} results, will retry: {exc}")
+                with self._condition:
+                    self._pending.extendleft(reversed(batch))
+                    self._state["flushing"] = 0
+                    self._condition.notify_all()
+                time.sleep(max(self.max_wait, RETRY_SECONDS))
+                continue
+            except Exception as exc:  # pylint: disable=broad-exception-caught
+                print(f"Dropped {len(batch)} results that cannot be written: {exc}")
+            RESULT_FLUSH_SECONDS.observe(time.perf_counter() - started)
+            with self._condition:
+                self._state["flushing"] = 0
+                RESULT_WRITES_PENDING.dec(len(batch))
+                self._condition.notify_all()
@@ -0,0 +1,211 @@
+"""
+This module implements the emotion analytics behind the web app's /analytics routes.
+Every time an emotion is written to fs.files, the hourly bucket it falls in is
+updated in the emotion_rollups collection with $inc, so a distribution over
+any time window only reads one small document per hour instead of scanning
+the recordings. Listing recordings by emotion uses an (emotion, uploadDate)
+index on fs.files.
+Functions:
+    as_utc(when):
+    bucket_start(when):
+    rollup_increment(when, emotion):
+    record_emotion(rollups, when, emotion):
+    ensure_indexes(db):
+    emotion_distribution(rollups, start, end, bucket):
+    recordings_with_emotion(files, emotion, start, end, limit):
+    rebuild_rollups(files, rollups):
+"""
+
+import datetime
+import os
+from collections import Counter
+
+import pymongo
+from pymongo.errors import PyMongoError
+
+BUCKET_SIZES = ("hour", "day")
+
+
+def as_utc(when):
+    """
+    Converts a datetime to timezone-aware UTC.
+
+    Args:
+        when (datetime.datetime): Naive values, as pymongo returns them,
+            are taken to be UTC.
+
+    Returns:
+        datetime.datetime: The same moment in UTC.
+    """
+    if when.tzinfo is None:
+        return when.replace(tzinfo=datetime.timezone.utc)
+    return when.astimezone(datetime.timezone.utc)
+
+
+def bucket_start(when):
+    """
+    The start of the UTC hour a recording falls in.
+
+    Args:
+        when (datetime.datetime): The recording's uploadDate.
+
+    Returns:
+        datetime.datetime: A timezone-aware UTC datetime on the hour.
+    """
+    return as_utc(when).replace(minute=0, second=0, microsecond=0)
+
+
+def rollup_increment(when, emotion):
+    """
+    The filter and update that count a recording in its hourly bucket, for
+    an upserting update_one on the emotion_rollups collection.
+
+    Args:
+        when (datetime.datetime): When the recording was stored.
+        emotion (str): Its emotion.
+
+    Returns:
+        tuple: The filter and the update.
+    """
+    return (
+        {"_id": bucket_start(when)},
+        {"$inc": {f"counts.{emotion}": 1, "total": 1}},
+    )
+
+
+def record_emotion(rollups, when, emotion):
+    """
+    Counts a newly stored recording in its hourly bucket.
+    A failure is logged rather than raised, so it never fails the upload.
+
+    Args:
+        rollups: The emotion_rollups collection.
+        when (datetime.datetime): When the recording was stored.
+        emotion (str): Its emotion.
+    """
+    try:
+        rollups.update_one(*rollup_increment(when, emotion), upsert=True)
+    except PyMongoError as exc:
+        print(f"Failed to update emotion rollups: {exc}")
+
+
+def ensure_indexes(db):
+    """
+    Creates the fs.files indexes the analytics queries rely on.
+
+    Args:
+        db: The audio-analysis database.
+    """
+    db.fs.files.create_index([("emotion", 1), ("uploadDate", -1)])
+    db.fs.files.create_index([("uploadDate", -1)])
+
+
+def emotion_distribution(rollups, start, end, bucket="hour"):
+    """
+    Counts recordings by emotion over a time window.
+
+    Args:
+        rollups: The emotion_rollups collection.
+        start (datetime.datetime): Start of the window, inclusive.
+        end (datetime.datetime): End of the window, exclusive.
+        bucket (str): "hour" or "day", the size of each returned bucket.
+
+    Returns:
+        dict: The per-bucket counts, oldest first, and the window's totals.
+    """
+    buckets = {}
+    for document in rollups.find(
+        {"_id": {"$gte": bucket_start(start), "$lt": end}}
+    ).sort("_id", 1):
+        when = bucket_start(document["_id"])
+        if bucket == "day":
+            when = when.replace(hour=0)
+        counts = buckets.setdefault(when, Counter())
+        counts.update({k: v for k, v in document.get("counts", {}).items() if v})
+    totals = sum(buckets.values(), Counter())
+    return {
+        "buckets": [
+            {"start": when.isoformat(), "counts": dict(counts)}
+            for when, counts in buckets.items()
+        ],
+        "counts": dict(totals),
+        "total": sum(totals.values()),
+    }
+
+
+def recordings_with_emotion(files, emotion, start, end, limit=50):
+    """
+    Lists the newest recordings with an emotion, using the
+    (emotion, uploadDate) index.
+
+    Args:
+        files: The fs.files collection.
+        emotion (str): The emotion to match.
+        start (datetime.datetime): Start of the window, inclusive.
+        end (datetime.datetime): End of the window, exclusive.
+        limit (int): The most recordings to return.
+
+    Returns:
+        list: The id and upload time of each recording, newest first.
+    """
+    cursor = (
+        files.find(
+            {"emotion": emotion, "uploadDate": {"$gte": start, "$lt": end}},
+            {"_id": 1, "uploadDate": 1},
+        )
+        .sort("uploadDate", -1)
+        .limit(limit)
+    )
+    return [
+        {
+            "fileId": str(document["_id"]),
+            "uploadDate": as_utc(document["uploadDate"]).isoformat(),
+        }
+        for document in cursor
+    ]
+
+
+def rebuild_rollups(files, rollups):
+    """
+    Recomputes every hourly bucket from fs.files, for recordings stored
+    before rollups existed.
+
+    Args:
+        files: The fs.files collection.
+        rollups: The emotion_rollups collection.
+
+    Returns:
+        int: The number of buckets written.
+    """
+    buckets = {}
+    pipeline = [
+        {"$match": {"emotion": {"$exists": True}}},
+        {
+            "$group": {
+                "_id": {
+                    "hour": {"$dateTrunc": {"date": "$uploadDate", "unit": "hour"}},
+                    "emotion": "$emotion",
+                },
+                "count": {"$sum": 1},
+            }
+        },
+    ]
+    for group in files.aggregate(pipeline):
+        bucket = buckets.setdefault(group["_id"]["hour"], {"counts": {}, "total": 0})
+        bucket["counts"][group["_id"]["emotion"]] = group["count"]
+        bucket["total"] += group["count"]
+    rollups.delete_many({})
+    if buckets:
+        rollups.insert_many(
+            [{"_id": hour, **bucket} for hour, bucket in sorted(buckets.items())]
+        )
+    return len(buckets)
+
+
+if __name__ == "__main__":
+    database = pymongo.MongoClient(
+        os.getenv("MONGO_URI", "mongodb://localhost/emotions")
+    )["audio-analysis"]
+    ensure_indexes(database)
+    written = rebuild_rollups(database.fs.files, database["emotion_rollups"])
+    print(f"Rebuilt {written} hourly emotion rollups from fs.files")
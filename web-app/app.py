@@ -13,20 +13,61 @@ Constants:
     CHANNELS (int): The number of audio channels.
     FORMAT: The format for audio recording.
     CHUNK_SIZE (int): The chunk size for audio recording.
-    OUTPUT_FILENAME (str): The default filename for the recorded audio.
+    RECORDINGS_PREFIX (str): Recordings are named by their digest under it.
 Functions:
+    audio_digest(file_obj):
+    recording_fields(digest, filename, emotion, model_version):
     store_audio_in_mongodb(filename):
+    store_in_background(data, emotion):
+    parse_window(args):
+    new_job(file_id):
+    enqueue_job(file_id):
+    job_response(job):
+    job_event(job, last_status):
+    ml_failure(response):
+    ml_reply(response):
+    readiness(status_code):
+    emotions_report(args):
+    recordings_report(args):
+    with_advice(result, status_code):
+    check_connection(ping):
     create_flask_app():
 """
 
+import datetime
+import hashlib
+import io
+import json
 import os
 import random
-from flask import Flask, render_template, redirect, url_for, jsonify, request
+import time
+from concurrent.futures import ThreadPoolExecutor
+from flask import (
+    Flask,
+    Response,
+    render_template,
+    redirect,
+    url_for,
+    jsonify,
+    request,
+    stream_with_context,
+)
 import pymongo
 import pyaudio
 import gridfs
 import requests
+from bson import ObjectId, errors
 from pymongo.errors import ConnectionFailure, OperationFailure
+from analytics import (
+    BUCKET_SIZES,
+    emotion_distribution,
+    ensure_indexes,
+    record_emotion,
+    recordings_with_emotion,
+)
+from metrics import STORES_PENDING, instrument, metrics_response, stage
+from ml_transport import MLTransport
+import request_profiler
 
 
 # Constants for audio recording
@@ -34,30 +75,417 @@ SAMPLE_RATE = 16000
 CHANNELS = 1
 FORMAT = pyaudio.paInt16
 CHUNK_SIZE = 1024
-OUTPUT_FILENAME = "static/output.wav"
+RECORDINGS_PREFIX = "recordings/"
+HASH_CHUNK_SIZE = 1024 * 1024
+ML_CLIENT_URL = os.getenv("ML_CLIENT_URL", "http://ml_client:4000")
+
+# Connection pooling, retries and circuit breaking for calls to the ML client
+ML_POOL_SIZE = int(os.getenv("ML_POOL_SIZE", "10"))
+ML_RETRIES = int(os.getenv("ML_RETRIES", "2"))
+ML_BACKOFF_SECONDS = float(os.getenv("ML_BACKOFF_SECONDS", "0.2"))
+ML_TIMEOUT_SECONDS = float(os.getenv("ML_TIMEOUT_SECONDS", "100"))
+ML_BREAKER_FAILURES = int(os.getenv("ML_BREAKER_FAILURES", "5"))
+ML_BREAKER_RESET_SECONDS = float(os.getenv("ML_BREAKER_RESET_SECONDS", "30"))
+ML_TRANSPORT_CONFIG = {
+    "pool_size": ML_POOL_SIZE,
+    "retries": ML_RETRIES,
+    "backoff_seconds": ML_BACKOFF_SECONDS,
+    "timeout": ML_TIMEOUT_SECONDS,
+    "failure_threshold": ML_BREAKER_FAILURES,
+    "reset_seconds": ML_BREAKER_RESET_SECONDS,
+}
+
+# Threads that write recordings to GridFS after /stop has answered
+STORE_WORKERS = int(os.getenv("STORE_WORKERS", "2"))
+
+# "sync" waits for the ML client in /stop, "queue" hands the work to ML workers
+STOP_MODE = os.getenv("STOP_MODE", "sync")
+
+# What the browser uploads to /stop: "opus" sends MediaRecorder's WebM/Opus
+# as recorded, "pcm16" resamples it to SAMPLE_RATE mono 16-bit WAV first
+UPLOAD_FORMAT = os.getenv("UPLOAD_FORMAT", "opus")
+
+# On-demand profiling, see request_profiler.py: requests sending
+# PROFILE_TOKEN in request_profiler.PROFILE_HEADER, and PROFILE_SAMPLE_RATE
+# of all requests, write their profiles to PROFILE_DIR, which keeps the
+# newest PROFILE_KEEP
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "20"))
+
+JOB_EVENTS_INTERVAL = 0.5
+JOB_EVENTS_TIMEOUT = 120
 
 uri = os.getenv("MONGO_URI", "mongodb://localhost/emotions")
 client = pymongo.MongoClient(uri)
 db = client["audio-analysis"]
 fs = gridfs.GridFS(db)
+jobs = db["jobs"]
+emotion_rollups = db["emotion_rollups"]
 
+ml_transport = MLTransport(ML_CLIENT_URL, ML_TRANSPORT_CONFIG)
+store_executor = ThreadPoolExecutor(
+    max_workers=STORE_WORKERS, thread_name_prefix="gridfs-store"
+)
 
-def store_audio_in_mongodb(file_obj, filename):
+
+def audio_digest(file_obj):
+    """
+    Computes the SHA-256 of an uploaded file and rewinds it.
+
+    Args:
+        file_obj: a readable, seekable binary file
+
+    Returns:
+        str: The hex digest of the file contents
+    """
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: file_obj.read(HASH_CHUNK_SIZE), b""):
+        digest.update(chunk)
+    file_obj.seek(0)
+    return digest.hexdigest()
+
+
+def recording_fields(digest, filename=None, emotion=None, model_version=None):
+    """
+    The name and fs.files fields a recording is stored with.
+
+    Args:
+        digest (str): The SHA-256 of the recording.
+        filename (str): The name to store it under; by default its digest
+            under RECORDINGS_PREFIX.
+        emotion (str): The emotion, if it is already known.
+        model_version (str): The ML client's model version that found it.
+
+    Returns:
+        tuple: The filename and the fields.
+    """
+    fields = {"sha256": digest}
+    if emotion is not None:
+        fields["emotion"] = emotion
+        fields["modelVersion"] = model_version
+    return filename or RECORDINGS_PREFIX + digest, fields
+
+
+def store_audio_in_mongodb(file_obj, filename=None, emotion=None, model_version=None):
     """
     Stores an audio file in a MongoDB database using GridFS.
+    The SHA-256 of the contents is saved on the fs.files document so the
+    ML client can reuse results for identical recordings.
 
     Args:
         file_obj: the file to be stored
-        filename (str): The path to the audio file to be stored.
+        filename (str): The name to store it under; by default its digest
+            under RECORDINGS_PREFIX.
+        emotion (str): The emotion, if it is already known.
+        model_version (str): The ML client's model version that found it.
 
     Returns:
         str: The ObjectId of the stored file
     """
-    file_id = fs.put(file_obj, filename=filename)
+    with stage("hash"):
+        filename, fields = recording_fields(
+            audio_digest(file_obj), filename, emotion, model_version
+        )
+    with stage("gridfs_put"):
+        file_id = fs.put(file_obj, filename=filename, **fields)
     print(f"Audio file '{filename}' stored in MongoDB with ObjectId: {file_id}")
+    if emotion is not None:
+        with stage("rollups"):
+            record_emotion(
+                emotion_rollups, datetime.datetime.now(datetime.timezone.utc), emotion
+            )
     return str(file_id)
 
 
+def store_in_background(data, emotion=None, model_version=None):
+    """
+    Stores a recording in GridFS without making the request wait for it.
+
+    Args:
+        data (bytes): The uploaded audio file.
+        emotion (str): The emotion the ML client found, if any.
+        model_version (str): The ML client's model version that found it.
+
+    Returns:
+        Future: Resolves to the ObjectId of the stored file.
+    """
+
+    def report_failure(future):
+        STORES_PENDING.dec()
+        if future.exception() is not None:
+            print(f"Failed to store recording in MongoDB: {future.exception()}")
+
+    STORES_PENDING.inc()
+    future = store_executor.submit(
+        store_audio_in_mongodb,
+        io.BytesIO(data),
+        None,
+        emotion,
+        model_version,
+    )
+    future.add_done_callback(report_failure)
+    return future
+
+
+def new_job(file_id):
+    """
+    Builds the job document that queues a stored recording.
+
+    Args:
+        file_id (str): The ObjectId of the stored recording.
+
+    Returns:
+        dict: The job, queued now with no attempts yet.
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return {
+        "fileId": ObjectId(file_id),
+        "status": "queued",
+        "attempts": 0,
+        "createdAt": now,
+        "updatedAt": now,
+    }
+
+
+def enqueue_job(file_id):
+    """
+    Queues a stored recording for the ML workers to classify.
+
+    Args:
+        file_id (str): The ObjectId of the stored recording.
+
+    Returns:
+        str: The ObjectId of the job
+    """
+    with stage("enqueue"):
+        result = jobs.insert_one(new_job(file_id))
+    return str(result.inserted_id)
+
+
+def job_response(job):
+    """
+    Builds what the browser sees of a job.
+
+    Args:
+        job (dict): The job document.
+
+    Returns:
+        dict: The job status, plus the emotion and advice once it is done or
+        the error if it failed.
+    """
+    body = {"jobId": str(job["_id"]), "status": job["status"]}
+    if job["status"] == "done":
+        body["emotion"] = job["emotion"]
+        body["advice"] = get_advice(job["emotion"])
+    elif job["status"] == "failed":
+        body["error"] = job.get("error", "Emotion detection failed")
+    return body
+
+
+def job_event(job, last_status):
+    """
+    Builds the next server-sent event of /jobs/<id>/events.
+
+    Args:
+        job (dict): The job document, or None if it is gone.
+        last_status (str): The status sent last, or None.
+
+    Returns:
+        tuple: The event to send, or None if nothing changed, the status
+        sent, and whether the stream is finished.
+    """
+    if job is None:
+        message = json.dumps({"message": "Job not found"})
+        return f"event: error\ndata: {message}\n\n", last_status, True
+    event = None
+    if job["status"] != last_status:
+        event = f"data: {json.dumps(job_response(job))}\n\n"
+    return event, job["status"], job["status"] in ("done", "failed")
+
+
+def ml_failure(response):
+    """
+    What /stop answers when the ML client did not classify a recording.
+
+    Args:
+        response: The ML client's response, or None if it was not reached.
+
+    Returns:
+        tuple: The body, the status and the headers. A 422 means nothing
+        was said, so the recording is not worth storing.
+    """
+    if getattr(response, "status_code", None) == 422:
+        return {"message": "No speech was detected"}, 422, {}
+    headers = {}
+    if response is not None and "Retry-After" in response.headers:
+        # The ML client is shedding load and said when to come back
+        headers["Retry-After"] = response.headers["Retry-After"]
+    return {"message": "Emotion detection is unavailable"}, 503, headers
+
+
+def ml_reply(response):
+    """
+    The ML client's JSON answer to a stream request, or what /stop answers
+    when the reply is not JSON, such as a proxy's HTML error page.
+
+    Args:
+        response: The ML client's response.
+
+    Returns:
+        tuple: The body, the status and the headers.
+    """
+    try:
+        return response.json(), response.status_code, {}
+    except ValueError:
+        print(f"The ML client answered {response.status_code} without JSON")
+        return ml_failure(response)
+
+
+def readiness(status_code):
+    """
+    What /readyz answers.
+
+    Args:
+        status_code (int): The status of the ML client's /readyz, or None
+            if it could not be reached.
+
+    Returns:
+        tuple: The body and the status.
+    """
+    if status_code is None:
+        return {"status": "ml client unreachable"}, 503
+    if status_code != 200:
+        return {"status": "ml client not ready"}, 503
+    return {"status": "ready"}, 200
+
+
+def emotions_report(args):
+    """
+    What /analytics/emotions answers.
+
+    Args:
+        args: The request's query parameters: bucket, start and end.
+
+    Returns:
+        tuple: The body and the status.
+    """
+    bucket = args.get("bucket", "hour")
+    if bucket not in BUCKET_SIZES:
+        return {"message": f"bucket must be one of {BUCKET_SIZES}"}, 400
+    try:
+        start, end = parse_window(args)
+    except ValueError as exc:
+        return {"message": str(exc)}, 400
+    distribution = emotion_distribution(emotion_rollups, start, end, bucket)
+    distribution.update(
+        {"start": start.isoformat(), "end": end.isoformat(), "bucket": bucket}
+    )
+    return distribution, 200
+
+
+def recordings_report(args):
+    """
+    What /analytics/recordings answers.
+
+    Args:
+        args: The request's query parameters: emotion, start, end and limit.
+
+    Returns:
+        tuple: The body and the status.
+    """
+    emotion = args.get("emotion")
+    if not emotion:
+        return {"message": "emotion is required"}, 400
+    try:
+        start, end = parse_window(args)
+        limit = int(args.get("limit", 50))
+    except ValueError as exc:
+        return {"message": str(exc)}, 400
+    recordings = recordings_with_emotion(
+        db.fs.files, emotion, start, end, max(1, min(limit, 500))
+    )
+    return {"emotion": emotion, "recordings": recordings}, 200
+
+
+def with_advice(result, status_code):
+    """
+    Adds advice to the ML client's answer to /stream/<id>/finish.
+
+    Args:
+        result (dict): The ML client's response body.
+        status_code (int): Its status; only a 200 has an emotion.
+
+    Returns:
+        dict: The result, with advice if it has an emotion.
+    """
+    if status_code == 200:
+        result["advice"] = get_advice(result["emotion"])
+    return result
+
+
+def check_connection(ping):
+    """
+    Runs a ping against MongoDB and reports whether it worked.
+
+    Args:
+        ping (callable): Pings the deployment.
+
+    Returns:
+        bool: Whether the deployment answered.
+    """
+    try:
+        ping()
+    except ConnectionFailure:
+        print("Failed to connect to MongoDB. Please check your connection.")
+        return False
+    except OperationFailure:
+        print(
+            "Operation failed. Please verify your credentials or database configuration."
+        )
+        return False
+    print("Pinged your deployment. You successfully connected to MongoDB!")
+    return True
+
+
+def parse_window(args):
+    """
+    Reads the time window of an analytics request.
+
+    Args:
+        args: The request's query parameters. start and end are ISO 8601
+            times, taken as UTC when they have no offset. end defaults to
+            now and start to 24 hours before end.
+
+    Returns:
+        tuple: The start and end as timezone-aware datetimes.
+
+    Raises:
+        ValueError: If a time cannot be parsed or start is not before end.
+    """
+
+    def parse(value):
+        when = datetime.datetime.fromisoformat(value)
+        if when.tzinfo is None:
+            when = when.replace(tzinfo=datetime.timezone.utc)
+        return when
+
+    end = (
+        parse(args["end"])
+        if args.get("end")
+        else datetime.datetime.now(datetime.timezone.utc)
+    )
+    start = (
+        parse(args["start"])
+        if args.get("start")
+        else end - datetime.timedelta(hours=24)
+    )
+    if start >= end:
+        raise ValueError("start must be before end")
+    return start, end
+
+
 def get_advice(emotion):
     """
     Get advice based on the detected emotion.
@@ -144,7 +572,7 @@ def get_advice(emotion):
     return advice
 
 
-def create_flask_app():
+def create_flask_app():  # pylint: disable=too-many-statements
     """
     Create and configure the Flask application.
     This function sets up the Flask app and defines the routes for the web application.
@@ -154,19 +582,38 @@ def create_flask_app():
         /: Redirects to the index page.
         /index: Renders the index.html template.
         /stop: Stops the audio recording process.
+        /stream/<id>/chunk: Forwards a slice of an in-progress recording to the
+            ML client and returns the emotion detected so far.
+        /stream/<id>/finish: Ends a streamed recording and returns its emotion
+            and advice.
+        /jobs/<id>: Reports the status of a queued recording.
+        /jobs/<id>/events: Streams the status of a queued recording as
+            server-sent events until it is done.
+        /healthz: Reports that the process is up.
+        /readyz: Reports whether the ML client is ready to classify audio.
+        /analytics/emotions: Counts recordings by emotion over a time window.
+        /analytics/recordings: Lists the newest recordings with an emotion.
+        /metrics: Per-stage latency histograms, request counts and gauges in
+            the Prometheus text format.
+    Requests sending PROFILE_TOKEN in request_profiler.PROFILE_HEADER, and a
+    PROFILE_SAMPLE_RATE share of the rest, are profiled into PROFILE_DIR.
+    A profiled /stop asks the ML client to profile the recording too.
     """
     flask_app = Flask(__name__)
     flask_app.secret_key = "KEY"
+    instrument(flask_app)
+    request_profiler.install(
+        flask_app,
+        {
+            "directory": PROFILE_DIR,
+            "token": PROFILE_TOKEN,
+            "sample_rate": PROFILE_SAMPLE_RATE,
+            "keep": PROFILE_KEEP,
+        },
+    )
 
-    try:
-        client.admin.command("ping")
-        print("Pinged your deployment. You successfully connected to MongoDB!")
-    except ConnectionFailure:
-        print("Failed to connect to MongoDB. Please check your connection.")
-    except OperationFailure:
-        print(
-            "Operation failed. Please verify your credentials or database configuration."
-        )
+    if check_connection(lambda: client.admin.command("ping")):
+        ensure_indexes(db)
 
     ################### Routes ###################
     @flask_app.route("/")
@@ -175,7 +622,9 @@ def create_flask_app():
 
     @flask_app.route("/index", methods=["GET"])
     def index():
-        return render_template("index.html")
+        return render_template(
+            "index.html", upload_format=UPLOAD_FORMAT, sample_rate=SAMPLE_RATE
+        )
 
     @flask_app.route("/stop", methods=["GET", "POST"])
     def stop():
@@ -187,14 +636,113 @@ def create_flask_app():
         if file.filename == "":
             return jsonify({"message": "No file selected"}), 400
 
-        file_id = store_audio_in_mongodb(file, filename=OUTPUT_FILENAME)
-        url = "http://ml_client:4000/detect-emotion"
-        params = {"fileId": str(file_id)}
-        response = requests.post(url, json=params, timeout=100)
-        emotion = response.json()["emotion"]
+        if STOP_MODE == "queue":
+            file_id = store_audio_in_mongodb(file)
+            job_id = enqueue_job(file_id)
+            return jsonify({"jobId": job_id, "status": "queued"}), 202
+
+        # Hand the audio straight to the ML client and store it afterwards
+        with stage("upload_read"):
+            data = file.read()
+        try:
+            with stage("ml_request"):
+                result = ml_transport.classify_audio(
+                    data, headers=request_profiler.forward_headers()
+                )
+        except requests.RequestException as exc:
+            body, status, headers = ml_failure(exc.response)
+            if status != 422:
+                print(f"Emotion detection failed: {exc}")
+                store_in_background(data)
+            return jsonify(body), status, headers
+        emotion = result["emotion"]
+        store_in_background(data, emotion, result.get("modelVersion"))
         advice = get_advice(emotion)
         return jsonify({"emotion": emotion, "advice": advice})
 
+    @flask_app.route("/jobs/<job_id>", methods=["GET"])
+    def job_status(job_id):
+        try:
+            job = jobs.find_one({"_id": ObjectId(job_id)})
+        except errors.InvalidId:
+            return jsonify({"message": "Invalid job id"}), 400
+        if job is None:
+            return jsonify({"message": "Job not found"}), 404
+        return jsonify(job_response(job))
+
+    @flask_app.route("/jobs/<job_id>/events", methods=["GET"])
+    def job_events(job_id):
+        try:
+            job_oid = ObjectId(job_id)
+        except errors.InvalidId:
+            return jsonify({"message": "Invalid job id"}), 400
+
+        def events():
+            last_status = None
+            deadline = time.monotonic() + JOB_EVENTS_TIMEOUT
+            while time.monotonic() < deadline:
+                event, last_status, finished = job_event(
+                    jobs.find_one({"_id": job_oid}), last_status
+                )
+                if event:
+                    yield event
+                if finished:
+                    return
+                time.sleep(JOB_EVENTS_INTERVAL)
+
+        return Response(stream_with_context(events()), mimetype="text/event-stream")
+
+    @flask_app.route("/healthz", methods=["GET"])
+    def healthz():
+        return jsonify({"status": "ok"}), 200
+
+    @flask_app.route("/readyz", methods=["GET"])
+    def readyz():
+        try:
+            status_code = ml_transport.probe("/readyz").status_code
+        except requests.RequestException:
+            status_code = None
+        body, status = readiness(status_code)
+        return jsonify(body), status
+
+    @flask_app.route("/analytics/emotions", methods=["GET"])
+    def analytics_emotions():
+        body, status = emotions_report(request.args)
+        return jsonify(body), status
+
+    @flask_app.route("/analytics/recordings", methods=["GET"])
+    def analytics_recordings():
+        body, status = recordings_report(request.args)
+        return jsonify(body), status
+
+    @flask_app.route("/metrics", methods=["GET"])
+    def metrics():
+        return metrics_response()
+
+    @flask_app.route("/stream/<session_id>/chunk", methods=["POST"])
+    def stream_chunk(session_id):
+        try:
+            with stage("ml_request"):
+                response = ml_transport.post(
+                    f"/stream/{session_id}/chunk",
+                    data=request.get_data(),
+                    headers={"Content-Type": "application/octet-stream"},
+                )
+        except requests.RequestException:
+            return jsonify({"error": "Emotion detection is unavailable"}), 503
+        body, status, headers = ml_reply(response)
+        return jsonify(body), status, headers
+
+    @flask_app.route("/stream/<session_id>/finish", methods=["POST"])
+    def stream_finish(session_id):
+        try:
+            with stage("ml_request"):
+                response = ml_transport.post(f"/stream/{session_id}/finish")
+        except requests.RequestException:
+            return jsonify({"error": "Emotion detection is unavailable"}), 503
+        body, status, headers = ml_reply(response)
+        return jsonify(with_advice(body, status)), status, headers
+
     return flask_app
 
 
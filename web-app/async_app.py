@@ -0,0 +1,336 @@
+"""
+This module implements the web app's async serving mode: the routes of app.py
+on Quart, served by an ASGI server. Recordings are written to GridFS with
+pymongo's AsyncMongoClient and sent to the ML client with httpx, so a /stop
+waiting up to ML_TIMEOUT_SECONDS for inference holds a coroutine instead of
+a thread. Thousands of them fit in one process, and the page and health
+routes keep answering while they wait. The analytics routes use the
+synchronous client and run on Quart's thread pool.
+Run with:
+    uvicorn --factory async_app:create_async_app --host 0.0.0.0 --port 3000
+Functions:
+    store_audio_async(data, filename, emotion, model_version):
+    store_in_background_async(data, emotion, model_version):
+    enqueue_job_async(file_id):
+    respond(body, status, headers):
+    create_async_app():
+"""
+
+import asyncio
+import datetime
+import hashlib
+import time
+
+import gridfs
+import httpx
+from bson import ObjectId, errors
+from prometheus_client import CONTENT_TYPE_LATEST
+from pymongo import AsyncMongoClient
+from pymongo.errors import PyMongoError
+from quart import Quart, Response, jsonify, redirect, render_template, request, url_for
+from analytics import ensure_indexes, rollup_increment
+from app import (
+    JOB_EVENTS_INTERVAL,
+    JOB_EVENTS_TIMEOUT,
+    ML_CLIENT_URL,
+    ML_TRANSPORT_CONFIG,
+    PROFILE_TOKEN,
+    SAMPLE_RATE,
+    STOP_MODE,
+    UPLOAD_FORMAT,
+    check_connection,
+    db,
+    emotions_report,
+    get_advice,
+    job_event,
+    job_response,
+    ml_failure,
+    ml_reply,
+    new_job,
+    readiness,
+    recording_fields,
+    recordings_report,
+    uri,
+    with_advice,
+)
+from metrics import STORES_PENDING, instrument_quart, metrics_payload, stage
+from ml_transport import AsyncMLTransport, CircuitOpenError
+import request_profiler
+
+# Connects on first use, inside the server's event loop
+async_client = AsyncMongoClient(uri)
+async_db = async_client["audio-analysis"]
+async_fs = gridfs.AsyncGridFS(async_db)
+async_jobs = async_db["jobs"]
+async_rollups = async_db["emotion_rollups"]
+
+ml_transport_async = AsyncMLTransport(ML_CLIENT_URL, ML_TRANSPORT_CONFIG)
+
+# Stores still running after /stop answered; the event loop only keeps weak
+# references to tasks
+background_stores = set()
+
+
+async def store_audio_async(data, filename=None, emotion=None, model_version=None):
+    """
+    Stores a recording in GridFS without blocking the event loop, like
+    app.store_audio_in_mongodb.
+
+    Args:
+        data (bytes): The uploaded audio file.
+        filename (str): The name to store it under; by default its digest
+            under RECORDINGS_PREFIX.
+        emotion (str): The emotion, if it is already known.
+        model_version (str): The ML client's model version that found it.
+
+    Returns:
+        str: The ObjectId of the stored file
+    """
+    with stage("hash"):
+        filename, fields = recording_fields(
+            hashlib.sha256(data).hexdigest(), filename, emotion, model_version
+        )
+    with stage("gridfs_put"):
+        file_id = await async_fs.put(data, filename=filename, **fields)
+    print(f"Audio file '{filename}' stored in MongoDB with ObjectId: {file_id}")
+    if emotion is not None:
+        with stage("rollups"):
+            try:
+                await async_rollups.update_one(
+                    *rollup_increment(
+                        datetime.datetime.now(datetime.timezone.utc), emotion
+                    ),
+                    upsert=True,
+                )
+            except PyMongoError as exc:
+                print(f"Failed to update emotion rollups: {exc}")
+    return str(file_id)
+
+
+def store_in_background_async(data, emotion=None, model_version=None):
+    """
+    Stores a recording in GridFS after the request has been answered.
+
+    Args:
+        data (bytes): The uploaded audio file.
+        emotion (str): The emotion the ML client found, if any.
+        model_version (str): The ML client's model version that found it.
+
+    Returns:
+        asyncio.Task: Resolves to the ObjectId of the stored file, or None
+        if storing it failed.
+    """
+
+    async def store():
+        try:
+            return await store_audio_async(data, None, emotion, model_version)
+        except PyMongoError as exc:
+            print(f"Failed to store recording in MongoDB: {exc}")
+            return None
+        finally:
+            STORES_PENDING.dec()
+
+    STORES_PENDING.inc()
+    task = asyncio.create_task(store())
+    background_stores.add(task)
+    task.add_done_callback(background_stores.discard)
+    return task
+
+
+async def enqueue_job_async(file_id):
+    """
+    Queues a stored recording for the ML workers, like app.enqueue_job.
+
+    Args:
+        file_id (str): The ObjectId of the stored recording.
+
+    Returns:
+        str: The ObjectId of the job
+    """
+    with stage("enqueue"):
+        result = await async_jobs.insert_one(new_job(file_id))
+    return str(result.inserted_id)
+
+
+def respond(body, status, headers=None):
+    """
+    Turns what the shared route helpers of app.py return into a response.
+
+    Args:
+        body (dict): The JSON body.
+        status (int): The HTTP status code.
+        headers (dict): Response headers, if any.
+
+    Returns:
+        tuple: The Quart response, its status code and headers
+    """
+    return jsonify(body), status, headers or {}
+
+
+def create_async_app():  # pylint: disable=too-many-statements
+    """
+    Create and configure the Quart application.
+    It serves the same routes as app.create_flask_app(), with the same
+    requests and responses. A /stop sending PROFILE_TOKEN in
+    request_profiler.PROFILE_HEADER asks the ML client for a profile, but
+    is not profiled here, see request_profiler.
+    Returns:
+        Quart app: The configured Quart application instance.
+    """
+    quart_app = Quart(__name__)
+    quart_app.secret_key = "KEY"
+    instrument_quart(quart_app)
+    request_profiler.install_quart(quart_app, PROFILE_TOKEN)
+
+    @quart_app.before_serving
+    async def connect():
+        # Once, before the first request, so the synchronous client is fine
+        if await asyncio.to_thread(check_connection, lambda: db.command("ping")):
+            await asyncio.to_thread(ensure_indexes, db)
+
+    @quart_app.after_serving
+    async def disconnect():
+        # Recordings already answered for are still written
+        await asyncio.gather(*background_stores, return_exceptions=True)
+        await ml_transport_async.aclose()
+        await async_client.close()
+
+    ################### Routes ###################
+    @quart_app.route("/")
+    async def home():
+        return redirect(url_for("index"))
+
+    @quart_app.route("/index", methods=["GET"])
+    async def index():
+        return await render_template(
+            "index.html", upload_format=UPLOAD_FORMAT, sample_rate=SAMPLE_RATE
+        )
+
+    @quart_app.route("/stop", methods=["GET", "POST"])
+    async def stop():
+        files = await request.files
+        if "file" not in files:
+            return jsonify({"message": "No file part in request"}), 400
+
+        file = files["file"]
+        if file.filename == "":
+            return jsonify({"message": "No file selected"}), 400
+
+        with stage("upload_read"):
+            data = file.read()
+        if STOP_MODE == "queue":
+            file_id = await store_audio_async(data)
+            job_id = await enqueue_job_async(file_id)
+            return jsonify({"jobId": job_id, "status": "queued"}), 202
+
+        # Hand the audio straight to the ML client and store it afterwards
+        try:
+            with stage("ml_request"):
+                result = await ml_transport_async.classify_audio(
+                    data, headers=request_profiler.forward_headers()
+                )
+        except (httpx.HTTPError, CircuitOpenError) as exc:
+            # Only HTTPStatusError carries the ML client's response
+            body, status, headers = ml_failure(getattr(exc, "response", None))
+            if status != 422:
+                print(f"Emotion detection failed: {exc!r}")
+                store_in_background_async(data)
+            return jsonify(body), status, headers
+        emotion = result["emotion"]
+        store_in_background_async(data, emotion, result.get("modelVersion"))
+        return jsonify({"emotion": emotion, "advice": get_advice(emotion)})
+
+    @quart_app.route("/jobs/<job_id>", methods=["GET"])
+    async def job_status(job_id):
+        try:
+            job_oid = ObjectId(job_id)
+        except errors.InvalidId:
+            return respond({"message": "Invalid job id"}, 400)
+        job = await async_jobs.find_one({"_id": job_oid})
+        if job is None:
+            return respond({"message": "Job not found"}, 404)
+        return jsonify(job_response(job))
+
+    @quart_app.route("/jobs/<job_id>/events", methods=["GET"])
+    async def job_events(job_id):
+        try:
+            job_oid = ObjectId(job_id)
+        except errors.InvalidId:
+            return respond({"message": "Invalid job id"}, 400)
+
+        async def events():
+            last_status = None
+            deadline = time.monotonic() + JOB_EVENTS_TIMEOUT
+            while time.monotonic() < deadline:
+                job = await async_jobs.find_one({"_id": job_oid})
+                event, last_status, finished = job_event(job, last_status)
+                if event:
+                    yield event.encode()
+                if finished:
+                    return
+                await asyncio.sleep(JOB_EVENTS_INTERVAL)
+
+        response = Response(events(), mimetype="text/event-stream")
+        # Quart cuts responses off after RESPONSE_TIMEOUT; events() stops
+        # itself after JOB_EVENTS_TIMEOUT
+        response.timeout = None
+        return response
+
+    @quart_app.route("/healthz", methods=["GET"])
+    async def healthz():
+        return jsonify({"status": "ok"}), 200
+
+    @quart_app.route("/readyz", methods=["GET"])
+    async def readyz():
+        try:
+            status_code = (await ml_transport_async.probe("/readyz")).status_code
+        except httpx.HTTPError:
+            status_code = None
+        return respond(*readiness(status_code))
+
+    # The analytics queries use the synchronous client; Quart runs views
+    # that are not coroutines on its thread pool
+    @quart_app.route("/analytics/emotions", methods=["GET"])
+    def analytics_emotions():
+        return respond(*emotions_report(request.args))
+
+    @quart_app.route("/analytics/recordings", methods=["GET"])
+    def analytics_recordings():
+        return respond(*recordings_report(request.args))
+
+    @quart_app.route("/metrics", methods=["GET"])
+    async def metrics():
+        return metrics_payload(), 200, {"Content-Type": CONTENT_TYPE_LATEST}
+
+    @quart_app.route("/stream/<session_id>/chunk", methods=["POST"])
+    async def stream_chunk(session_id):
+        data = await request.get_data()
+        try:
+            with stage("ml_request"):
+                response = await ml_transport_async.post(
+                    f"/stream/{session_id}/chunk",
+                    content=data,
+                    headers={"Content-Type": "application/octet-stream"},
+                )
+        except (httpx.HTTPError, CircuitOpenError):
+            return jsonify({"error": "Emotion detection is unavailable"}), 503
+        return respond(*ml_reply(response))
+
+    @quart_app.route("/stream/<session_id>/finish", methods=["POST"])
+    async def stream_finish(session_id):
+        try:
+            with stage("ml_request"):
+                response = await ml_transport_async.post(f"/stream/{session_id}/finish")
+        except (httpx.HTTPError, CircuitOpenError):
+            return jsonify({"error": "Emotion detection is unavailable"}), 503
+        body, status, headers = ml_reply(response)
+        return respond(with_advice(body, status), status, headers)
+
+    return quart_app
+
+
+if __name__ == "__main__":
+    # Only needed to run this module directly
+    import uvicorn  # pylint: disable=import-outside-toplevel
+
+    uvicorn.run("async_app:create_async_app", factory=True, host="0.0.0.0", port=3000)
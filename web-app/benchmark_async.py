@@ -0,0 +1,262 @@
+"""
+Benchmark of /stop under many concurrent recordings, served by the Flask
+development server (one thread per connection) and by async_app on uvicorn.
+
+A stand-in ML client answers /classify after --ml-delay seconds, as the
+real one does while it waits for inference, so each server holds every
+request for at least that long. For each server and each --concurrency it
+posts --requests recordings, that many at a time, and prints the
+throughput, the p50/p95 latency, the requests that failed, and the most
+threads and resident memory the server used while answering them.
+Recordings are stored in the MongoDB at --mongo; if it cannot be reached
+the stores fail after /stop has answered, which does not change the
+numbers much.
+
+Usage:
+    python benchmark_async.py --concurrency 100 1000 --requests 2000
+Functions:
+    fake_ml(scope, receive, send):
+    start_server(command, port, env):
+    process_usage(pid):
+    percentile(latencies, pct):
+    run_load(url, data, requests_count, concurrency, pid):
+    main():
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+import httpx
+
+ML_DELAY_SECONDS = float(os.getenv("ML_DELAY_SECONDS", "1.0"))
+SERVERS = {
+    "flask": [
+        sys.executable,
+        "-c",
+        "import os, app; app.create_flask_app().run("
+        "port=int(os.environ['PORT']), threaded=True)",
+    ],
+    "async": [
+        sys.executable,
+        "-m",
+        "uvicorn",
+        "--factory",
+        "async_app:create_async_app",
+        "--log-level",
+        "warning",
+    ],
+}
+
+
+async def fake_ml(scope, receive, send):
+    """
+    An ASGI app standing in for the ML client: /classify answers "happy"
+    after ML_DELAY_SECONDS, everything else answers at once.
+
+    Args:
+        scope (dict): The ASGI connection scope.
+        receive (callable): Receives the request body.
+        send (callable): Sends the response.
+    """
+    if scope["type"] != "http":
+        return
+    while (await receive()).get("more_body"):
+        pass
+    if scope["path"] == "/classify":
+        await asyncio.sleep(ML_DELAY_SECONDS)
+    body = json.dumps({"emotion": "happy", "modelVersion": "benchmark"}).encode()
+    await send(
+        {
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [(b"content-type", b"application/json")],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+def start_server(command, port, env):
+    """
+    Starts a server and waits until it answers /healthz.
+
+    Args:
+        command (list): The command that runs it.
+        port (int): The port it listens on.
+        env (dict): Its environment.
+
+    Returns:
+        subprocess.Popen: The running server.
+    """
+    if "uvicorn" in command:
+        command = command + ["--port", str(port)]
+    process = subprocess.Popen(  # pylint: disable=consider-using-with
+        command,
+        env={**env, "PORT": str(port)},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/healthz").status_code == 200:
+                return process
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f"{command} did not start")
+
+
+def process_usage(pid):
+    """
+    Reads a process's thread count and resident memory from /proc.
+
+    Args:
+        pid (int): The process.
+
+    Returns:
+        tuple: Its threads and its resident memory in MiB.
+    """
+    usage = {}
+    with open(f"/proc/{pid}/status", encoding="utf-8") as status:
+        for line in status:
+            key, _, value = line.partition(":")
+            usage[key] = value.split()
+    return int(usage["Threads"][0]), int(usage["VmRSS"][0]) / 1024
+
+
+def percentile(latencies, pct):
+    """
+    Returns a percentile of latencies, by the nearest rank.
+
+    Args:
+        latencies (list): Latencies in seconds.
+        pct (float): The percentile, from 0 to 100.
+
+    Returns:
+        float: The percentile in milliseconds, 0 if there are none.
+    """
+    if not latencies:
+        return 0.0
+    ranked = sorted(latencies)
+    return ranked[min(len(ranked) - 1, int(len(ranked) * pct / 100))] * 1000
+
+
+async def run_load(url, data, requests_count, concurrency, pid):
+    """
+    Posts requests_count recordings to url, concurrency at a time, while
+    sampling the server's threads and memory.
+
+    Args:
+        url (str): The /stop route to post to.
+        data (bytes): The recording.
+        requests_count (int): How many to post.
+        concurrency (int): How many are in flight at once.
+        pid (int): The server's process, to sample.
+
+    Returns:
+        dict: The wall-clock seconds, the latencies of the requests that
+        succeeded, how many failed, and the most threads and MiB used.
+    """
+    latencies, failures, peaks = [], 0, [0, 0.0]
+    cursor = iter(range(requests_count))
+
+    async def caller():
+        nonlocal failures
+        # A client, and so a connection, per caller: callers sharing one
+        # httpx pool slow each other down long before the server does
+        async with httpx.AsyncClient(timeout=120.0) as client:
+            for _ in cursor:
+                started = time.perf_counter()
+                try:
+                    response = await client.post(url, files={"file": ("r.wav", data)})
+                    response.raise_for_status()
+                    latencies.append(time.perf_counter() - started)
+                except httpx.HTTPError:
+                    failures += 1
+
+    async def sample():
+        while True:
+            threads, rss = process_usage(pid)
+            peaks[0], peaks[1] = max(peaks[0], threads), max(peaks[1], rss)
+            await asyncio.sleep(0.1)
+
+    sampler = asyncio.create_task(sample())
+    started = time.perf_counter()
+    await asyncio.gather(*(caller() for _ in range(concurrency)))
+    seconds = time.perf_counter() - started
+    sampler.cancel()
+    return {
+        "seconds": seconds,
+        "latencies": latencies,
+        "failures": failures,
+        "threads": peaks[0],
+        "rss": peaks[1],
+    }
+
+
+def main():
+    """Parse arguments, start the servers and load each of them in turn."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", maxsplit=1)[0])
+    parser.add_argument("--servers", nargs="+", choices=sorted(SERVERS))
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[100, 1000])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--ml-delay", type=float, default=ML_DELAY_SECONDS)
+    parser.add_argument("--mongo", default="mongodb://localhost:27017")
+    parser.add_argument("--port", type=int, default=3100)
+    args = parser.parse_args()
+
+    env = {
+        **os.environ,
+        "ML_DELAY_SECONDS": str(args.ml_delay),
+        "ML_CLIENT_URL": f"http://127.0.0.1:{args.port + 1}",
+        "MONGO_URI": args.mongo + "/?serverSelectionTimeoutMS=500",
+        "STOP_MODE": "sync",
+        "ML_TIMEOUT_SECONDS": str(args.ml_delay * 30 + 10),
+    }
+    ml_client = start_server(
+        SERVERS["async"][:3] + ["benchmark_async:fake_ml", "--log-level", "warning"],
+        args.port + 1,
+        env,
+    )
+    data = os.urandom(64 * 1024)
+    print(
+        f"{'server':<8} {'conc':>6} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} "
+        f"{'errors':>7} {'threads':>8} {'MiB':>7}"
+    )
+    try:
+        for name in args.servers or ["flask", "async"]:
+            server = start_server(SERVERS[name], args.port, env)
+            try:
+                for concurrency in args.concurrency:
+                    result = asyncio.run(
+                        run_load(
+                            f"http://127.0.0.1:{args.port}/stop",
+                            data,
+                            args.requests,
+                            concurrency,
+                            server.pid,
+                        )
+                    )
+                    print(
+                        f"{name:<8} {concurrency:>6} "
+                        f"{len(result['latencies']) / result['seconds']:>8.1f} "
+                        f"{percentile(result['latencies'], 50):>9.1f} "
+                        f"{percentile(result['latencies'], 95):>9.1f} "
+                        f"{result['failures']:>7} {result['threads']:>8} "
+                        f"{result['rss']:>7.1f}"
+                    )
+            finally:
+                server.terminate()
+                server.wait()
+    finally:
+        ml_client.terminate()
+        ml_client.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+"""
+This module implements the Prometheus metrics the web app serves at /metrics.
+Constants:
+    STAGES (tuple): The stages of handling an upload that are timed.
+Functions:
+    stage(name):
+    outcome(status_code):
+    instrument(flask_app):
+    instrument_quart(quart_app):
+    record_request(status_code):
+    count_request(route, status_code, started):
+    metrics_payload():
+    metrics_response():
+"""
+
+import os
+import time
+
+import quart
+from flask import Response, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+# From 1 ms, a cached answer, to 60 s, a long recording classified in windows
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+# upload_read is reading the uploaded file from the request, ml_request
+# the whole HTTP hop to the ML client, retries included
+STAGES = (
+    "upload_read",
+    "hash",
+    "ml_request",
+    "gridfs_put",
+    "rollups",
+    "enqueue",
+)
+
+STAGE_SECONDS = Histogram(
+    "web_stage_seconds",
+    "Time spent in each stage of handling a recording",
+    ["stage"],
+    buckets=LATENCY_BUCKETS,
+)
+REQUEST_SECONDS = Histogram(
+    "web_request_seconds",
+    "Time to answer a request, by route",
+    ["route"],
+    buckets=LATENCY_BUCKETS,
+)
+REQUESTS = Counter(
+    "web_requests_total",
+    "Requests answered, by route and outcome",
+    ["route", "outcome"],
+)
+IN_FLIGHT = Gauge(
+    "web_requests_in_flight", "Requests being handled", multiprocess_mode="livesum"
+)
+STORES_PENDING = Gauge(
+    "web_stores_pending",
+    "Recordings waiting to be written to GridFS in the background",
+    multiprocess_mode="livesum",
+)
+
+# Bound once, so timing a stage costs two clock reads and one observe()
+_STAGE_TIMERS = {name: STAGE_SECONDS.labels(name) for name in STAGES}
+
+
+def stage(name):
+    """
+    Time a block as one of STAGES.
+    Usage:
+        with stage("gridfs_put"):
+            file_id = fs.put(file_obj)
+    """
+    return _STAGE_TIMERS[name].time()
+
+
+def outcome(status_code):
+    """Group a status code into success, client_error or server_error."""
+    if status_code < 400:
+        return "success"
+    return "client_error" if status_code < 500 else "server_error"
+
+
+def instrument(flask_app):
+    """
+    Count every request of a Flask app by route and outcome, time it, and
+    track how many are in flight. Flask runs after_request for the 500
+    response of a view that raised, so errors are counted too.
+    """
+
+    @flask_app.before_request
+    def start_request():
+        IN_FLIGHT.inc()
+        request.environ["metrics.in_flight"] = True
+        request.environ["metrics.started"] = time.perf_counter()
+
+    @flask_app.after_request
+    def count_response(response):
+        record_request(response.status_code)
+        return response
+
+    @flask_app.teardown_request
+    def finish_request(_exc):
+        # Only requests counted on the way in; a context can be torn down
+        # without before_request having run
+        if request.environ.pop("metrics.in_flight", False):
+            IN_FLIGHT.dec()
+
+
+def instrument_quart(quart_app):
+    """
+    instrument() for the Quart app of the async serving mode. Quart has no
+    WSGI environ, so the request's start is kept on g instead.
+    """
+
+    @quart_app.before_request
+    async def start_request():
+        IN_FLIGHT.inc()
+        quart.g.metrics_in_flight = True
+        quart.g.metrics_started = time.perf_counter()
+
+    @quart_app.after_request
+    async def count_response(response):
+        rule = quart.request.url_rule
+        count_request(
+            rule.rule if rule else "unmatched",
+            response.status_code,
+            quart.g.get("metrics_started"),
+        )
+        return response
+
+    @quart_app.teardown_request
+    async def finish_request(_exc):
+        if quart.g.pop("metrics_in_flight", False):
+            IN_FLIGHT.dec()
+
+
+def record_request(status_code):
+    """Count and time the current request."""
+    count_request(
+        request.url_rule.rule if request.url_rule else "unmatched",
+        status_code,
+        request.environ.get("metrics.started"),
+    )
+
+
+def count_request(route, status_code, started):
+    """
+    Count a request by route and outcome, and time it.
+
+    Args:
+        route (str): The matched URL rule, or "unmatched".
+        status_code (int): The response's status.
+        started (float): time.perf_counter() when it arrived, or None.
+    """
+    REQUESTS.labels(route, outcome(status_code)).inc()
+    if started is not None:
+        REQUEST_SECONDS.labels(route).observe(time.perf_counter() - started)
+
+
+def metrics_payload():
+    """
+    Render every metric in the Prometheus text format. Under gunicorn with
+    PROMETHEUS_MULTIPROC_DIR set, the workers' metrics are merged.
+
+    Returns:
+        bytes: The exposition, served with CONTENT_TYPE_LATEST.
+    """
+    registry = REGISTRY
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry)
+
+
+def metrics_response():
+    """The Flask response for /metrics, see metrics_payload()."""
+    return Response(metrics_payload(), content_type=CONTENT_TYPE_LATEST)
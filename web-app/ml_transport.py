@@ -0,0 +1,304 @@
+"""
+This module implements the web app's connection to the machine learning client.
+Requests go through one pooled, keep-alive session, failed connections are
+retried with backoff, and a circuit breaker stops calling the ML client for a
+while once it keeps failing, so /stop fails fast instead of piling up.
+Classes:
+    CircuitOpenError: Raised instead of calling an ML client that keeps failing.
+    CircuitBreaker: Counts consecutive failures and decides when to try again.
+    MLTransport: Sends requests to the ML client.
+    AsyncMLTransport: Sends requests to the ML client from the async app.
+"""
+
+import asyncio
+import threading
+import time
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class CircuitOpenError(requests.RequestException):
+    """Raised instead of calling an ML client that keeps failing."""
+
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive failures and rejects calls for
+    reset_seconds. After that a single trial call is let through: success
+    closes the circuit again, failure keeps it open for another period.
+    """
+
+    def __init__(self, failure_threshold=5, reset_seconds=30.0):
+        """
+        Args:
+            failure_threshold (int): Consecutive failures that open the circuit.
+            reset_seconds (float): How long the circuit stays open.
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        """One of "closed", "open" or "half-open"."""
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.reset_seconds:
+            return "open"
+        return "half-open"
+
+    def allow(self):
+        """
+        Returns:
+            bool: Whether a call may go through now.
+        """
+        with self._lock:
+            if self.state == "open":
+                return False
+            if self.state == "half-open":
+                # Let one trial call through and hold the rest back
+                self.opened_at = time.monotonic()
+            return True
+
+    def record_success(self):
+        """Close the circuit."""
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_response(self, response):
+        """
+        Count a response from the ML client. Server errors are failures,
+        except for ones carrying Retry-After: the ML client sends those when
+        it sheds load on purpose, which shows it is up.
+        Args:
+            response: A requests or httpx response.
+        """
+        if response.status_code >= 500 and "Retry-After" not in response.headers:
+            self.record_failure()
+        else:
+            self.record_success()
+
+    def record_failure(self):
+        """Count a failure, opening the circuit once there are enough."""
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+class MLTransport:
+    """
+    Sends requests to the ML client over a pooled session.
+    Only failed connections and gateway errors are retried, so a request the
+    ML client has already started working on is never sent twice.
+    """
+
+    def __init__(self, base_url, config):
+        """
+        Args:
+            base_url (str): Where the ML client listens, e.g. http://ml_client:4000.
+            config (dict): pool_size, retries, backoff_seconds, timeout,
+                failure_threshold and reset_seconds.
+        """
+        self.base_url = base_url
+        self.timeout = config["timeout"]
+        self.breaker = CircuitBreaker(
+            config["failure_threshold"], config["reset_seconds"]
+        )
+        retry = Retry(
+            total=config["retries"],
+            read=0,
+            status_forcelist=(502, 504),
+            allowed_methods=None,
+            backoff_factor=config["backoff_seconds"],
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=config["pool_size"], max_retries=retry
+        )
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def request(self, method, path, **kwargs):
+        """
+        Send a request to the ML client through the circuit breaker.
+        Args:
+            method (str): The HTTP method.
+            path (str): The path on the ML client, starting with a slash.
+            **kwargs: Passed on to requests; timeout defaults to self.timeout.
+        Returns:
+            requests.Response: The ML client's response.
+        Raises:
+            CircuitOpenError: If the ML client has been failing.
+            requests.RequestException: If the ML client could not be reached.
+        """
+        if not self.breaker.allow():
+            raise CircuitOpenError(f"ML client circuit is {self.breaker.state}")
+        kwargs.setdefault("timeout", self.timeout)
+        try:
+            response = self.session.request(method, f"{self.base_url}{path}", **kwargs)
+        except requests.RequestException:
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_response(response)
+        return response
+
+    def post(self, path, **kwargs):
+        """Send a POST request, see request()."""
+        return self.request("POST", path, **kwargs)
+
+    def probe(self, path, timeout=2):
+        """
+        GET a health endpoint over the pooled session. Probes bypass the
+        circuit breaker, so a client that is still loading does not trip it.
+        Returns:
+            requests.Response: The ML client's response.
+        """
+        return self.session.get(f"{self.base_url}{path}", timeout=timeout)
+
+    def classify_audio(self, data, headers=None):
+        """
+        Send a recording straight to the ML client for classification.
+        The ML client is told how long this side will wait, so it can turn
+        the recording away at once, or drop it before inference, rather
+        than classify it after nobody is waiting.
+        Args:
+            data (bytes): The uploaded audio file.
+            headers (dict): Extra headers to send, such as the one asking
+                the ML client for a profile.
+        Returns:
+            dict: The ML client's result, with at least the emotion.
+        Raises:
+            requests.RequestException: If the ML client could not be reached
+                or could not classify the recording.
+        """
+        response = self.post(
+            "/classify",
+            data=data,
+            headers={
+                "Content-Type": "application/octet-stream",
+                "X-Request-Timeout": str(self.timeout),
+                **(headers or {}),
+            },
+        )
+        response.raise_for_status()
+        return response.json()
+
+
+class AsyncMLTransport:
+    """
+    MLTransport for the async serving mode: the same circuit breaker and
+    retry rules over an httpx.AsyncClient, so a request waiting for the ML
+    client holds a coroutine instead of a thread.
+    Errors are httpx's: HTTPStatusError carries the ML client's response,
+    like requests.HTTPError does for MLTransport. CircuitOpenError is raised
+    as it is there.
+    """
+
+    def __init__(self, base_url, config):
+        """
+        Args:
+            base_url (str): Where the ML client listens, e.g. http://ml_client:4000.
+            config (dict): pool_size, retries, backoff_seconds, timeout,
+                failure_threshold and reset_seconds, as for MLTransport.
+        """
+        self.base_url = base_url
+        self.timeout = config["timeout"]
+        self.retries = config["retries"]
+        self.backoff_seconds = config["backoff_seconds"]
+        self.breaker = CircuitBreaker(
+            config["failure_threshold"], config["reset_seconds"]
+        )
+        # Like MLTransport's pool, pool_size connections are kept alive and
+        # any more are opened as needed rather than waited for
+        self.client = httpx.AsyncClient(
+            base_url=base_url,
+            timeout=self.timeout,
+            limits=httpx.Limits(
+                max_connections=None, max_keepalive_connections=config["pool_size"]
+            ),
+        )
+
+    async def request(self, method, path, **kwargs):
+        """
+        Send a request to the ML client through the circuit breaker.
+        Failed connections, 502 and 504 are retried with doubling backoff.
+        Args:
+            method (str): The HTTP method.
+            path (str): The path on the ML client, starting with a slash.
+            **kwargs: Passed on to httpx; timeout defaults to self.timeout.
+        Returns:
+            httpx.Response: The ML client's response.
+        Raises:
+            CircuitOpenError: If the ML client has been failing.
+            httpx.HTTPError: If the ML client could not be reached.
+        """
+        if not self.breaker.allow():
+            raise CircuitOpenError(f"ML client circuit is {self.breaker.state}")
+        for attempt in range(self.retries + 1):
+            if attempt:
+                await asyncio.sleep(self.backoff_seconds * 2 ** (attempt - 1))
+            try:
+                response = await self.client.request(method, path, **kwargs)
+            except (httpx.ConnectError, httpx.ConnectTimeout):
+                if attempt < self.retries:
+                    continue
+                self.breaker.record_failure()
+                raise
+            except httpx.HTTPError:
+                self.breaker.record_failure()
+                raise
+            if response.status_code not in (502, 504) or attempt == self.retries:
+                break
+        self.breaker.record_response(response)
+        return response
+
+    async def post(self, path, **kwargs):
+        """Send a POST request, see request()."""
+        return await self.request("POST", path, **kwargs)
+
+    async def probe(self, path, timeout=2):
+        """
+        GET a health endpoint, bypassing the circuit breaker, see
+        MLTransport.probe.
+        Returns:
+            httpx.Response: The ML client's response.
+        """
+        return await self.client.get(path, timeout=timeout)
+
+    async def classify_audio(self, data, headers=None):
+        """
+        Send a recording straight to the ML client for classification, see
+        MLTransport.classify_audio.
+        Args:
+            data (bytes): The uploaded audio file.
+            headers (dict): Extra headers to send.
+        Returns:
+            dict: The ML client's result, with at least the emotion.
+        Raises:
+            CircuitOpenError: If the ML client has been failing.
+            httpx.HTTPError: If the ML client could not be reached or could
+                not classify the recording.
+        """
+        response = await self.post(
+            "/classify",
+            content=data,
+            headers={
+                "Content-Type": "application/octet-stream",
+                "X-Request-Timeout": str(self.timeout),
+                **(headers or {}),
+            },
+        )
+        response.raise_for_status()
+        return response.json()
+
+    async def aclose(self):
+        """Close the pooled connections."""
+        await self.client.aclose()
@@ -0,0 +1,272 @@
+"""
+This module profiles single requests of the web app on demand.
+A request is profiled when it sends PROFILE_HEADER with the configured token,
+or at random at the configured sample rate. cProfile runs for the whole
+request, and each profile is written as <name>.pstats, for pstats or
+snakeviz, and <name>.collapsed, collapsed stacks for flamegraph.pl or
+speedscope. Only the newest profiles are kept. A profiled /stop forwards the
+header to the ML client, whose profile of the same recording also has a
+Chrome trace of decoding and inference.
+With no token and a zero sample rate install adds nothing to the app.
+The Quart app of the async serving mode only forwards the header: cProfile
+watches a whole thread, and on an event loop that would mix in every other
+request awaiting alongside, so the web app's own part is not profiled.
+Constants:
+    PROFILE_HEADER (str): The request header that asks for a profile.
+    PROFILE_ID_HEADER (str): The response header naming the profile.
+    SUFFIXES (tuple): The files each profile is written as.
+Functions:
+    active():
+    forward_headers():
+    frame_label(function):
+    collapsed_stacks(stats):
+    prune(directory, keep):
+    wanted(token, sample_rate):
+    install(flask_app, options):
+    install_quart(quart_app, token):
+Classes:
+    RequestProfile: cProfile over one request.
+"""
+
+import cProfile
+import hmac
+import os
+import pstats
+import random
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+import quart
+from flask import request
+
+PROFILE_HEADER = "X-Profile"
+PROFILE_ID_HEADER = "X-Profile-Id"
+SUFFIXES = (".pstats", ".collapsed")
+# Paths through the call graph shorter than this are left out of the
+# collapsed stacks, which keeps them small
+MIN_FOLDED_SECONDS = 1e-6
+
+# The profile of the request the current thread is handling, if any
+_current = threading.local()
+
+
+def active():
+    """
+    Whether the current thread is handling a profiled request.
+    """
+    return getattr(_current, "profile", None) is not None
+
+
+def forward_headers():
+    """
+    Headers that ask the ML client to profile its part of the current
+    request: PROFILE_HEADER with the token, when the request is profiled
+    and a token is configured, or in the Quart app when the request sent
+    the token.
+
+    Returns:
+        dict: The headers, empty when there is nothing to forward.
+    """
+    profile = getattr(_current, "profile", None)
+    if profile is not None and profile.token:
+        return {PROFILE_HEADER: profile.token}
+    if quart.has_app_context() and quart.g.get("profile_token"):
+        return {PROFILE_HEADER: quart.g.profile_token}
+    return {}
+
+
+def frame_label(function):
+    """
+    A cProfile function key as one frame of a collapsed stack.
+    """
+    filename, line, name = function
+    if filename == "~":
+        # Built-ins have no file
+        return name.replace(";", ",")
+    return f"{os.path.basename(filename)}:{name}:{line}".replace(";", ",")
+
+
+def collapsed_stacks(stats):
+    """
+    Fold cProfile's call graph into collapsed stacks.
+    cProfile keeps the time of each caller and callee pair, not whole stacks,
+    so a function's time is split between the paths that reach it in
+    proportion to the time it spent under each caller.
+
+    Args:
+        stats (pstats.Stats): The profile.
+
+    Returns:
+        list: "frame;frame;frame microseconds" lines, outermost frame first.
+    """
+    entries = stats.stats
+    callees = defaultdict(list)
+    for function, (_, _, _, _, callers) in entries.items():
+        for caller, caller_stats in callers.items():
+            callees[caller].append((function, caller_stats[3]))
+    folded = defaultdict(float)
+    # Functions with no recorded caller were on the stack when it started
+    pending = [
+        ((function,), 1.0) for function, entry in entries.items() if not entry[4]
+    ]
+    while pending:
+        path, share = pending.pop()
+        folded[path] += entries[path[-1]][2] * share
+        for callee, under_caller in callees[path[-1]]:
+            total = entries[callee][3]
+            if callee in path or total <= 0:
+                continue
+            callee_share = share * under_caller / total
+            if callee_share * total >= MIN_FOLDED_SECONDS:
+                pending.append((path + (callee,), callee_share))
+    return [
+        f"{';'.join(frame_label(function) for function in path)} {round(seconds * 1e6)}"
+        for path, seconds in sorted(folded.items())
+        if round(seconds * 1e6) > 0
+    ]
+
+
+def prune(directory, keep):
+    """
+    Delete all but the newest keep profiles in directory. Profile names start
+    with the time they were taken, so they sort oldest first.
+    """
+    names = sorted(
+        {
+            name.split(".", 1)[0]
+            for name in os.listdir(directory)
+            if name.endswith(SUFFIXES)
+        }
+    )
+    for name in names[: max(0, len(names) - keep)]:
+        for suffix in SUFFIXES:
+            try:
+                os.remove(os.path.join(directory, name + suffix))
+            except FileNotFoundError:
+                # Pruned by another worker
+                pass
+
+
+class RequestProfile:
+    """
+    cProfile over one request.
+    """
+
+    def __init__(self, name, token):
+        """
+        Args:
+            name (str): Names the profile's files.
+            token (str): The profile token, forwarded to the ML client.
+        """
+        self.name = name
+        self.token = token
+        self.python = cProfile.Profile()
+
+    def start(self):
+        """
+        Start the profiler.
+        """
+        self.python.enable()
+
+    def stop(self):
+        """
+        Stop the profiler.
+        """
+        self.python.disable()
+
+    def write(self, directory):
+        """
+        Write the profile's files to directory.
+
+        Returns:
+            list: The paths written.
+        """
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, self.name)
+        self.python.dump_stats(path + ".pstats")
+        with open(path + ".collapsed", "w", encoding="utf-8") as file:
+            lines = collapsed_stacks(pstats.Stats(self.python))
+            file.write("\n".join(lines) + "\n")
+        return [path + suffix for suffix in SUFFIXES]
+
+
+def wanted(token, sample_rate):
+    """
+    Whether to profile the current request.
+
+    Args:
+        token (str): The value PROFILE_HEADER must have, or "" to ignore it.
+        sample_rate (float): The share of other requests to profile.
+    """
+    sent = request.headers.get(PROFILE_HEADER)
+    if token and sent is not None and hmac.compare_digest(sent, token):
+        return True
+    return sample_rate > 0 and random.random() < sample_rate
+
+
+def install(flask_app, options):
+    """
+    Profile the requests of a Flask app that ask for it or are sampled.
+
+    Args:
+        flask_app (Flask): The app.
+        options (dict): "directory" to write the profiles to, "token" and
+            "sample_rate" as for wanted, and "keep", the number of newest
+            profiles to keep.
+    """
+    if not options["token"] and options["sample_rate"] <= 0:
+        return
+
+    @flask_app.before_request
+    def start_profile():
+        if not wanted(options["token"], options["sample_rate"]):
+            return
+        stamp = time.strftime("%Y%m%dT%H%M%S", time.gmtime())
+        endpoint = (request.endpoint or "unmatched").replace(".", "-")
+        profile = RequestProfile(
+            f"{stamp}-{endpoint}-{uuid.uuid4().hex[:8]}", options["token"]
+        )
+        _current.profile = profile
+        profile.start()
+
+    @flask_app.after_request
+    def finish_profile(response):
+        profile = getattr(_current, "profile", None)
+        if profile is None:
+            return response
+        _current.profile = None
+        profile.stop()
+        profile.write(options["directory"])
+        prune(options["directory"], options["keep"])
+        response.headers[PROFILE_ID_HEADER] = profile.name
+        print(f"Profiled {request.path} as {profile.name}")
+        return response
+
+    @flask_app.teardown_request
+    def drop_profile(_exc):
+        # A request that failed before after_request leaves its profiler on
+        profile = getattr(_current, "profile", None)
+        if profile is not None:
+            _current.profile = None
+            profile.stop()
+
+
+def install_quart(quart_app, token):
+    """
+    Have the Quart app forward PROFILE_HEADER to the ML client for requests
+    that send the token, see forward_headers. Nothing is added without one.
+
+    Args:
+        quart_app (Quart): The app.
+        token (str): The value PROFILE_HEADER must have.
+    """
+    if not token:
+        return
+
+    @quart_app.before_request
+    async def forward_profile():
+        sent = quart.request.headers.get(PROFILE_HEADER)
+        if sent is not None and hmac.compare_digest(sent, token):
+            quart.g.profile_token = token
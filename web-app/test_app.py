@@ -1,12 +1,33 @@
 """Module for web app tests"""
 
-from unittest.mock import patch
+import asyncio
+import datetime
+import hashlib
+import os
+from unittest.mock import AsyncMock, MagicMock, patch
 from io import BytesIO
 import pytest
 from flask import Flask
 from flask.testing import FlaskClient
+from werkzeug.datastructures import FileStorage
 
-from app import create_flask_app, store_audio_in_mongodb, get_advice
+import httpx
+import requests
+from bson import ObjectId
+from prometheus_client import REGISTRY
+
+from app import (
+    create_flask_app,
+    store_audio_in_mongodb,
+    get_advice,
+    audio_digest,
+    enqueue_job,
+    store_in_background,
+)
+from analytics import bucket_start, emotion_distribution
+from async_app import create_async_app, store_audio_async
+from ml_transport import AsyncMLTransport, CircuitBreaker, CircuitOpenError, MLTransport
+import request_profiler
 
 
 @pytest.fixture(name="app")
@@ -38,7 +59,21 @@ def test_store_audio_in_mongodb(mock_fs_put):
     result = store_audio_in_mongodb(file_obj, filename)
 
     assert result == "mock_file_id"
-    mock_fs_put.assert_called_once_with(file_obj, filename=filename)
+    mock_fs_put.assert_called_once_with(
+        file_obj,
+        filename=filename,
+        sha256=hashlib.sha256(b"mock_audio_data").hexdigest(),
+    )
+
+
+def test_audio_digest_rewinds_file():
+    """Test that hashing an upload leaves it ready to be stored."""
+    file_obj = BytesIO(b"mock_audio_data")
+
+    digest = audio_digest(file_obj)
+
+    assert digest == hashlib.sha256(b"mock_audio_data").hexdigest()
+    assert file_obj.read() == b"mock_audio_data"
 
 
 def test_home_redirect(client: FlaskClient):
@@ -55,13 +90,15 @@ def test_index_page(client: FlaskClient):
     assert b"Emotion Recognizer" in response.data
 
 
-@patch("app.store_audio_in_mongodb")
-@patch("app.requests.post")
-def test_stop_route_success(mock_requests_post, mock_store_audio, client: FlaskClient):
-    """Test the /stop route with successful emotion detection."""
-    mock_store_audio.return_value = "mock_file_id"
-    mock_requests_post.return_value.status_code = 200
-    mock_requests_post.return_value.json.return_value = {"emotion": "happy"}
+@patch("app.store_in_background")
+@patch("app.ml_transport.session.request")
+def test_stop_route_success(mock_request, mock_store, client: FlaskClient):
+    """Test that /stop sends the audio to the ML client before storing it."""
+    mock_request.return_value.status_code = 200
+    mock_request.return_value.json.return_value = {
+        "emotion": "happy",
+        "modelVersion": "model:v1",
+    }
 
     audio_data = BytesIO(b"mock_audio_data")
     data = {"file": (audio_data, "recording.wav")}
@@ -69,14 +106,394 @@ def test_stop_route_success(mock_requests_post, mock_store_audio, client: FlaskC
     response = client.post("/stop", data=data, content_type="multipart/form-data")
 
     assert response.status_code == 200
+    assert response.json["emotion"] == "happy"
+
+    mock_request.assert_called_once_with(
+        "POST",
+        "http://ml_client:4000/classify",
+        data=b"mock_audio_data",
+        headers={
+            "Content-Type": "application/octet-stream",
+            "X-Request-Timeout": "100.0",
+        },
+        timeout=100.0,
+    )
+    mock_store.assert_called_once_with(b"mock_audio_data", "happy", "model:v1")
+
+
+@patch("app.store_in_background")
+@patch("app.ml_transport.session.request")
+def test_stop_route_ml_client_down(mock_request, mock_store, client: FlaskClient):
+    """Test that /stop still keeps the recording when the ML client fails."""
+    mock_request.side_effect = requests.ConnectionError("refused")
+    data = {"file": (BytesIO(b"mock_audio_data"), "recording.wav")}
+
+    response = client.post("/stop", data=data, content_type="multipart/form-data")
+
+    assert response.status_code == 503
+    mock_store.assert_called_once_with(b"mock_audio_data")
+
+
+@patch("app.store_in_background")
+@patch("app.ml_transport.session.request")
+def test_stop_route_no_speech(mock_request, mock_store, client: FlaskClient):
+    """Test that /stop discards a recording the ML client found no speech in."""
+    silent = requests.Response()
+    silent.status_code = 422
+    mock_request.return_value = silent
+    data = {"file": (BytesIO(b"mock_audio_data"), "recording.wav")}
 
-    mock_store_audio.assert_called_once()
+    response = client.post("/stop", data=data, content_type="multipart/form-data")
+
+    assert response.status_code == 422
+    assert response.json == {"message": "No speech was detected"}
+    mock_store.assert_not_called()
+
+
+@patch("app.store_in_background")
+@patch("app.ml_transport.session.request")
+def test_stop_route_passes_on_retry_after(
+    mock_request, mock_store, client: FlaskClient
+):
+    """Test that /stop tells the browser when a busy ML client can take more."""
+    busy = requests.Response()
+    busy.status_code = 429
+    busy.headers["Retry-After"] = "7"
+    mock_request.return_value = busy
+    data = {"file": (BytesIO(b"mock_audio_data"), "recording.wav")}
+
+    response = client.post("/stop", data=data, content_type="multipart/form-data")
+
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "7"
+    mock_store.assert_called_once_with(b"mock_audio_data")
+
+
+@patch("app.emotion_rollups")
+@patch("app.fs.put")
+def test_store_in_background_saves_emotion(mock_fs_put, mock_rollups):
+    """Test that the background store records the digest and emotion."""
+    mock_fs_put.return_value = "mock_file_id"
+
+    future = store_in_background(b"audio", "sad", "model:v1")
+    assert future.result(timeout=5) == "mock_file_id"
+    assert mock_fs_put.call_args.kwargs == {
+        "filename": "recordings/" + hashlib.sha256(b"audio").hexdigest(),
+        "sha256": hashlib.sha256(b"audio").hexdigest(),
+        "emotion": "sad",
+        "modelVersion": "model:v1",
+    }
+    update = mock_rollups.update_one.call_args
+    assert update.args[1] == {"$inc": {"counts.sad": 1, "total": 1}}
+    assert update.kwargs == {"upsert": True}
+
+
+@patch("time.monotonic")
+def test_circuit_breaker_opens_and_half_opens(mock_monotonic):
+    """Test that the breaker rejects calls until its reset period is over."""
+    mock_monotonic.return_value = 100.0
+    breaker = CircuitBreaker(failure_threshold=2, reset_seconds=30)
+
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+
+    mock_monotonic.return_value = 131.0
+    assert breaker.allow()
+    # Only one trial call goes through while half-open
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed"
+
+
+def test_transport_fails_fast_when_circuit_open():
+    """Test that an open circuit rejects calls without touching the network."""
+    transport = MLTransport(
+        "http://ml_client:4000",
+        {
+            "pool_size": 2,
+            "retries": 0,
+            "backoff_seconds": 0,
+            "timeout": 1,
+            "failure_threshold": 1,
+            "reset_seconds": 60,
+        },
+    )
+    with patch.object(transport.session, "request") as mock_request:
+        mock_request.return_value.status_code = 500
+        transport.post("/classify", data=b"audio")
+        with pytest.raises(CircuitOpenError):
+            transport.post("/classify", data=b"audio")
+
+    assert mock_request.call_count == 1
+
+
+def test_transport_shed_responses_do_not_open_circuit():
+    """Test that the ML client shedding load with Retry-After is not a failure."""
+    transport = MLTransport(
+        "http://ml_client:4000",
+        {
+            "pool_size": 2,
+            "retries": 0,
+            "backoff_seconds": 0,
+            "timeout": 1,
+            "failure_threshold": 1,
+            "reset_seconds": 60,
+        },
+    )
+    with patch.object(transport.session, "request") as mock_request:
+        mock_request.return_value.status_code = 503
+        mock_request.return_value.headers = {"Retry-After": "2"}
+        for _ in range(3):
+            assert transport.post("/classify", data=b"audio").status_code == 503
+
+    assert mock_request.call_count == 3
+    assert transport.breaker.state == "closed"
+
+
+@patch("app.ml_transport.post")
+def test_stream_chunk_forwards_audio(mock_requests_post, client: FlaskClient):
+    """Test that a recording slice is passed straight to the ML client."""
+    mock_requests_post.return_value.status_code = 200
+    mock_requests_post.return_value.json.return_value = {
+        "emotion": "sad",
+        "seconds": 3.0,
+        "timeline": [],
+    }
+
+    response = client.post("/stream/abc-123/chunk", data=b"slice")
+
+    assert response.status_code == 200
+    assert response.json["emotion"] == "sad"
     mock_requests_post.assert_called_once_with(
-        "http://ml_client:4000/detect-emotion",
-        json={"fileId": "mock_file_id"},
-        timeout=100,
+        "/stream/abc-123/chunk",
+        data=b"slice",
+        headers={"Content-Type": "application/octet-stream"},
+    )
+
+
+@patch("app.ml_transport.post")
+def test_stream_finish_adds_advice(mock_requests_post, client: FlaskClient):
+    """Test that the final streamed emotion comes back with advice."""
+    mock_requests_post.return_value.status_code = 200
+    mock_requests_post.return_value.json.return_value = {
+        "emotion": "happy",
+        "fileId": "mock_file_id",
+        "timeline": [],
+    }
+
+    response = client.post("/stream/abc-123/finish")
+
+    assert response.status_code == 200
+    assert response.json["emotion"] == "happy"
+    assert response.json["advice"] != "Unknown emotion."
+
+
+@patch("app.ml_transport.post")
+def test_stream_finish_passes_errors_through(mock_requests_post, client: FlaskClient):
+    """Test that an unknown stream is reported without advice."""
+    mock_requests_post.return_value.status_code = 404
+    mock_requests_post.return_value.json.return_value = {"error": "Unknown stream"}
+
+    response = client.post("/stream/abc-123/finish")
+
+    assert response.status_code == 404
+    assert response.json == {"error": "Unknown stream"}
+
+
+@pytest.mark.parametrize("route", ["chunk", "finish"])
+@patch("app.ml_transport.post")
+def test_stream_routes_handle_non_json_errors(mock_requests_post, route, client):
+    """Test that an HTML error page from the ML side gets /stop's JSON error."""
+    mock_requests_post.return_value.status_code = 502
+    mock_requests_post.return_value.headers = {"Retry-After": "5"}
+    mock_requests_post.return_value.json.side_effect = requests.JSONDecodeError(
+        "Expecting value", "<html>502 Bad Gateway</html>", 0
     )
 
+    response = client.post(f"/stream/abc-123/{route}", data=b"slice")
+
+    assert response.status_code == 503
+    assert response.json == {"message": "Emotion detection is unavailable"}
+    assert response.headers["Retry-After"] == "5"
+
+
+@patch("app.ml_transport.session.get")
+def test_readyz_follows_ml_client(mock_requests_get, client: FlaskClient):
+    """Test that the web app is only ready once the ML client is."""
+    mock_requests_get.return_value.status_code = 503
+    assert client.get("/readyz").status_code == 503
+
+    mock_requests_get.return_value.status_code = 200
+    assert client.get("/readyz").status_code == 200
+    mock_requests_get.assert_called_with("http://ml_client:4000/readyz", timeout=2)
+
+    assert client.get("/healthz").status_code == 200
+
+
+@patch("app.STOP_MODE", "queue")
+@patch("app.enqueue_job")
+@patch("app.store_audio_in_mongodb")
+@patch("app.ml_transport.post")
+def test_stop_route_queue_mode(
+    mock_requests_post, mock_store_audio, mock_enqueue_job, client: FlaskClient
+):
+    """Test that /stop only queues a job when the queue mode is enabled."""
+    mock_store_audio.return_value = "mock_file_id"
+    mock_enqueue_job.return_value = "mock_job_id"
+    data = {"file": (BytesIO(b"mock_audio_data"), "recording.wav")}
+
+    response = client.post("/stop", data=data, content_type="multipart/form-data")
+
+    assert response.status_code == 202
+    assert response.json == {"jobId": "mock_job_id", "status": "queued"}
+    mock_enqueue_job.assert_called_once_with("mock_file_id")
+    mock_requests_post.assert_not_called()
+
+
+@patch("app.jobs")
+def test_enqueue_job(mock_jobs):
+    """Test that a queued job points at the stored recording."""
+    file_id = ObjectId()
+    mock_jobs.insert_one.return_value.inserted_id = "mock_job_id"
+
+    assert enqueue_job(str(file_id)) == "mock_job_id"
+
+    job = mock_jobs.insert_one.call_args[0][0]
+    assert job["fileId"] == file_id
+    assert job["status"] == "queued"
+    assert job["attempts"] == 0
+
+
+@patch("app.jobs")
+def test_job_status_done(mock_jobs, client: FlaskClient):
+    """Test polling a finished job returns the emotion and advice."""
+    job_id = ObjectId()
+    mock_jobs.find_one.return_value = {
+        "_id": job_id,
+        "status": "done",
+        "emotion": "sad",
+    }
+
+    response = client.get(f"/jobs/{job_id}")
+
+    assert response.status_code == 200
+    assert response.json["status"] == "done"
+    assert response.json["emotion"] == "sad"
+    assert response.json["advice"] != "Unknown emotion."
+
+
+@patch("app.jobs")
+def test_job_status_errors(mock_jobs, client: FlaskClient):
+    """Test polling with a malformed or unknown job id."""
+    mock_jobs.find_one.return_value = None
+
+    assert client.get("/jobs/not-an-id").status_code == 400
+    assert client.get(f"/jobs/{ObjectId()}").status_code == 404
+
+
+@patch("app.JOB_EVENTS_INTERVAL", 0)
+@patch("app.jobs")
+def test_job_events_stream_until_done(mock_jobs, client: FlaskClient):
+    """Test that status changes are pushed as server-sent events."""
+    job_id = ObjectId()
+    mock_jobs.find_one.side_effect = [
+        {"_id": job_id, "status": "queued"},
+        {"_id": job_id, "status": "running"},
+        {"_id": job_id, "status": "running"},
+        {"_id": job_id, "status": "done", "emotion": "happy"},
+    ]
+
+    response = client.get(f"/jobs/{job_id}/events")
+    body = response.get_data(as_text=True)
+
+    assert response.mimetype == "text/event-stream"
+    events = [line for line in body.splitlines() if line.startswith("data: ")]
+    assert len(events) == 3
+    assert '"status": "done"' in events[-1]
+
+
+def test_emotion_distribution_merges_hours_into_days():
+    """Test that hourly rollups are summed into daily buckets."""
+    utc = datetime.timezone.utc
+    rollups = [
+        {"_id": datetime.datetime(2024, 5, 1, 9), "counts": {"sad": 2, "happy": 1}},
+        {"_id": datetime.datetime(2024, 5, 1, 17), "counts": {"sad": 1, "angry": 0}},
+        {"_id": datetime.datetime(2024, 5, 2, 3), "counts": {"happy": 4}},
+    ]
+    collection = MagicMock()
+    collection.find.return_value.sort.return_value = rollups
+
+    result = emotion_distribution(
+        collection,
+        datetime.datetime(2024, 5, 1, 8, 30, tzinfo=utc),
+        datetime.datetime(2024, 5, 3, tzinfo=utc),
+        "day",
+    )
+
+    query = collection.find.call_args.args[0]
+    assert query["_id"]["$gte"] == datetime.datetime(2024, 5, 1, 8, tzinfo=utc)
+    assert result["buckets"] == [
+        {"start": "2024-05-01T00:00:00+00:00", "counts": {"sad": 3, "happy": 1}},
+        {"start": "2024-05-02T00:00:00+00:00", "counts": {"happy": 4}},
+    ]
+    assert result["counts"] == {"sad": 3, "happy": 5}
+    assert result["total"] == 8
+    assert bucket_start(
+        datetime.datetime(
+            2024, 5, 1, 10, 45, tzinfo=datetime.timezone(datetime.timedelta(hours=2))
+        )
+    ) == datetime.datetime(2024, 5, 1, 8, tzinfo=utc)
+
+
+@patch("app.emotion_distribution")
+def test_analytics_emotions_route(mock_distribution, client: FlaskClient):
+    """Test the analytics window parameters and their validation."""
+    mock_distribution.return_value = {"buckets": [], "counts": {}, "total": 0}
+
+    response = client.get(
+        "/analytics/emotions?start=2024-05-01T00:00:00&end=2024-05-02T00:00:00"
+        "&bucket=day"
+    )
+
+    assert response.status_code == 200
+    assert response.json["start"] == "2024-05-01T00:00:00+00:00"
+    assert response.json["bucket"] == "day"
+    start, end, bucket = mock_distribution.call_args.args[1:]
+    assert end - start == datetime.timedelta(days=1)
+    assert bucket == "day"
+    assert client.get("/analytics/emotions?bucket=week").status_code == 400
+    assert client.get("/analytics/emotions?start=yesterday").status_code == 400
+    assert (
+        client.get(
+            "/analytics/emotions?start=2024-05-02T00:00:00&end=2024-05-01T00:00:00"
+        ).status_code
+        == 400
+    )
+    assert client.get("/analytics/recordings").status_code == 400
+
+
+@patch("app.ml_transport.session.request")
+def test_metrics_times_stages_and_counts_outcomes(mock_request, client: FlaskClient):
+    """Test that /metrics reports the ML hop and each request's outcome."""
+    mock_request.side_effect = requests.ConnectionError("refused")
+    outcome = {"route": "/stop", "outcome": "server_error"}
+    hop = {"stage": "ml_request"}
+    failures = REGISTRY.get_sample_value("web_requests_total", outcome) or 0
+    hops = REGISTRY.get_sample_value("web_stage_seconds_count", hop) or 0
+
+    with patch("app.store_in_background"):
+        data = {"file": (BytesIO(b"mock_audio_data"), "recording.wav")}
+        client.post("/stop", data=data, content_type="multipart/form-data")
+    response = client.get("/metrics")
+
+    assert response.status_code == 200
+    assert REGISTRY.get_sample_value("web_requests_total", outcome) == failures + 1
+    assert REGISTRY.get_sample_value("web_stage_seconds_count", hop) == hops + 1
+    assert "web_stores_pending" in response.get_data(as_text=True)
+
 
 def test_stop_route_no_file(client: FlaskClient):
     """Test the /stop route when no file is provided."""
@@ -127,3 +544,164 @@ def test_get_advice_unknown_emotion():
     assert (
         advice == "Unknown emotion."
     ), f"Unexpected advice for unknown emotion: {advice}"
+
+
+def post_recording_async(data, headers=None):
+    """Post a recording to the async app's /stop and return the response."""
+
+    async def post():
+        client = create_async_app().test_client()
+        response = await client.post(
+            "/stop",
+            files={"file": FileStorage(BytesIO(data), "recording.webm")},
+            headers=headers,
+        )
+        return response.status_code, response.headers, await response.get_json()
+
+    return asyncio.run(post())
+
+
+@patch("async_app.store_in_background_async")
+@patch("async_app.ml_transport_async.classify_audio", new_callable=AsyncMock)
+def test_async_stop_route_classifies_then_stores(mock_classify, mock_store):
+    """Test that the async /stop answers with the emotion and stores afterwards."""
+    mock_classify.return_value = {"emotion": "happy", "modelVersion": "model:v1"}
+
+    status, _, body = post_recording_async(b"mock_audio_data")
+
+    assert status == 200
+    assert body["emotion"] == "happy"
+    assert body["advice"] != "Unknown emotion."
+    mock_classify.assert_awaited_once_with(b"mock_audio_data", headers={})
+    mock_store.assert_called_once_with(b"mock_audio_data", "happy", "model:v1")
+
+
+@patch("async_app.store_in_background_async")
+@patch("async_app.ml_transport_async.classify_audio", new_callable=AsyncMock)
+def test_async_stop_route_passes_on_retry_after(mock_classify, mock_store):
+    """Test that the async /stop handles a busy ML client like the Flask app."""
+    busy = httpx.Response(
+        429,
+        headers={"Retry-After": "7"},
+        request=httpx.Request("POST", "http://ml/classify"),
+    )
+    mock_classify.side_effect = httpx.HTTPStatusError(
+        "busy", request=busy.request, response=busy
+    )
+
+    status, headers, _ = post_recording_async(b"mock_audio_data")
+
+    assert status == 503
+    assert headers["Retry-After"] == "7"
+    mock_store.assert_called_once_with(b"mock_audio_data")
+
+
+@patch("async_app.async_rollups")
+@patch("async_app.async_fs")
+def test_store_audio_async_saves_emotion(mock_fs, mock_rollups):
+    """Test that the async store records the digest, emotion and rollup."""
+    mock_fs.put = AsyncMock(return_value="mock_file_id")
+    mock_rollups.update_one = AsyncMock()
+
+    file_id = asyncio.run(store_audio_async(b"audio", None, "sad", "model:v1"))
+
+    assert file_id == "mock_file_id"
+    assert mock_fs.put.call_args.kwargs == {
+        "filename": "recordings/" + hashlib.sha256(b"audio").hexdigest(),
+        "sha256": hashlib.sha256(b"audio").hexdigest(),
+        "emotion": "sad",
+        "modelVersion": "model:v1",
+    }
+    mock_rollups.update_one.assert_awaited_once()
+
+
+def test_async_ml_transport_retries_gateway_errors():
+    """Test that the async transport retries a 502 and then trips the breaker."""
+    statuses = [502, 200, 500]
+
+    def handler(_request):
+        return httpx.Response(statuses.pop(0), json={"emotion": "sad"})
+
+    transport = AsyncMLTransport(
+        "http://ml",
+        {
+            "pool_size": 2,
+            "retries": 1,
+            "backoff_seconds": 0,
+            "timeout": 5,
+            "failure_threshold": 1,
+            "reset_seconds": 60,
+        },
+    )
+    transport.client = httpx.AsyncClient(
+        base_url="http://ml", transport=httpx.MockTransport(handler)
+    )
+
+    async def run():
+        result = await transport.classify_audio(b"audio")
+        with pytest.raises(httpx.HTTPStatusError):
+            await transport.classify_audio(b"audio")
+        with pytest.raises(CircuitOpenError):
+            await transport.classify_audio(b"audio")
+        return result
+
+    assert asyncio.run(run()) == {"emotion": "sad"}
+    assert not statuses
+
+
+@patch("app.store_in_background")
+@patch("app.ml_transport.session.request")
+def test_stop_route_profiles_and_forwards_the_token(
+    mock_request, _mock_store, tmp_path
+):
+    """Test that a profiled /stop is written out and asks the ML client too."""
+    mock_request.return_value.status_code = 200
+    mock_request.return_value.json.return_value = {"emotion": "happy"}
+    with patch("app.PROFILE_TOKEN", "secret"), patch("app.PROFILE_DIR", str(tmp_path)):
+        app = create_flask_app()
+
+    with app.test_client() as client:
+        profiled = client.post(
+            "/stop",
+            data={"file": (BytesIO(b"audio"), "recording.wav")},
+            headers={request_profiler.PROFILE_HEADER: "secret"},
+        )
+        forwarded = mock_request.call_args.kwargs["headers"]
+        plain = client.post("/stop", data={"file": (BytesIO(b"audio"), "a.wav")})
+
+    name = profiled.headers[request_profiler.PROFILE_ID_HEADER]
+    assert profiled.json["emotion"] == "happy"
+    assert forwarded[request_profiler.PROFILE_HEADER] == "secret"
+    assert (
+        request_profiler.PROFILE_HEADER not in mock_request.call_args.kwargs["headers"]
+    )
+    assert request_profiler.PROFILE_ID_HEADER not in plain.headers
+    assert sorted(os.listdir(tmp_path)) == [name + ".collapsed", name + ".pstats"]
+    assert "app.py:stop:" in (tmp_path / (name + ".collapsed")).read_text()
+
+
+@patch("async_app.PROFILE_TOKEN", "secret")
+@patch("async_app.store_in_background_async")
+@patch("async_app.ml_transport_async.classify_audio", new_callable=AsyncMock)
+def test_async_stop_route_forwards_the_profile_token(mock_classify, _mock_store):
+    """Test that the async /stop asks the ML client for a profile when asked."""
+    mock_classify.return_value = {"emotion": "happy"}
+
+    post_recording_async(b"audio", {request_profiler.PROFILE_HEADER: "secret"})
+    profiled = mock_classify.await_args.kwargs["headers"]
+    post_recording_async(b"audio", {request_profiler.PROFILE_HEADER: "guess"})
+
+    assert profiled == {request_profiler.PROFILE_HEADER: "secret"}
+    assert mock_classify.await_args.kwargs["headers"] == {}
+
+
+@patch("async_app.ml_transport_async.post", new_callable=AsyncMock)
+def test_async_stream_finish_handles_non_json_errors(mock_post):
+    """Test that the async stream routes also survive an HTML error page."""
+    mock_post.return_value = httpx.Response(504, text="<html>Gateway Timeout</html>")
+
+    async def post():
+        response = await create_async_app().test_client().post("/stream/a/finish")
+        return response.status_code, await response.get_json()
+
+    assert asyncio.run(post()) == (503, {"message": "Emotion detection is unavailable"})